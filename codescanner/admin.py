@@ -2,27 +2,145 @@
 from __future__ import unicode_literals
 
 from django.contrib import admin
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.urls import reverse
+from django.utils.html import format_html
 
 from . import models
 
-class ApexClassInline(admin.TabularInline):
 
-    fields = ['class_id', 'class_member_id','name',]
-    readonly_fields = ['class_id', 'class_member_id','name',]
-    model = models.ApexClass
-    extra = 0
+# Large columns that are never shown in a changelist
+CLASS_DEFERRED_FIELDS = ['body', 'line_offsets', 'symbol_table_json', 'referenced_by_json']
 
 
-class ApexPageComponentInline(admin.TabularInline):
+def count_subquery(model, **filters):
+    """
+    Build a subquery counting the rows of a model for each job.
+    Used instead of annotating Count over joins, which multiplies the rows of each join together
+    """
+    return Subquery(
+        model.objects
+        .filter(job=OuterRef('pk'), **filters)
+        .order_by()
+        .values('job')
+        .annotate(count=Count('pk'))
+        .values('count'),
+        output_field=IntegerField()
+    )
 
-    fields = ['sf_id','name','type','controller']
-    readonly_fields = ['sf_id','name','type','controller']
-    model = models.ApexPageComponent
-    extra = 0
 
 # Register your models here.
 @admin.register(models.Job)
 class JobAdmin(admin.ModelAdmin):
+    """
+    The classes and pages for a job can run to thousands of rows, so rather than inlines
+    they're linked to their own (paginated) changelists, filtered to the job
+    """
 
-    list_display = ['slug', 'created_date', 'username', 'status']
-    inlines = [ApexClassInline, ApexPageComponentInline]
\ No newline at end of file
+    list_display = ['slug', 'created_date', 'username', 'status', 'class_count', 'page_count', 'referenced_count']
+    list_filter = ['status']
+    search_fields = ['slug', 'username', 'org_id']
+    readonly_fields = ['class_links']
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super(JobAdmin, self).get_queryset(request).without_results().annotate(
+            class_count=count_subquery(models.ApexClass),
+            page_count=count_subquery(models.ApexPageComponent),
+            trigger_count=count_subquery(models.ApexTrigger),
+            referenced_count=count_subquery(models.ApexClass, is_referenced_externally=True),
+        )
+
+    def class_count(self, job):
+        return job.class_count or 0
+    class_count.short_description = 'Classes'
+    class_count.admin_order_field = 'class_count'
+
+    def page_count(self, job):
+        return job.page_count or 0
+    page_count.short_description = 'Pages and Components'
+    page_count.admin_order_field = 'page_count'
+
+    def referenced_count(self, job):
+        return job.referenced_count or 0
+    referenced_count.short_description = 'Referenced Classes'
+    referenced_count.admin_order_field = 'referenced_count'
+
+    def class_links(self, job):
+        return format_html(
+            '<a href="{}?job__id__exact={}">{} classes</a> / <a href="{}?job__id__exact={}">{} triggers</a> / <a href="{}?job__id__exact={}">{} pages and components</a>',
+            reverse('admin:codescanner_apexclass_changelist'), job.pk, job.class_count or 0,
+            reverse('admin:codescanner_apextrigger_changelist'), job.pk, job.trigger_count or 0,
+            reverse('admin:codescanner_apexpagecomponent_changelist'), job.pk, job.page_count or 0,
+        )
+    class_links.short_description = 'Classes'
+
+
+@admin.register(models.ApexClass)
+class ApexClassAdmin(admin.ModelAdmin):
+
+    list_display = ['name', 'class_id', 'job_id', 'is_referenced_externally', 'visualforce_count', 'classes_count', 'methods_count', 'variables_count', 'properties_count']
+    list_filter = ['is_referenced_externally']
+    search_fields = ['name', 'class_id']
+    raw_id_fields = ['job']
+    readonly_fields = ['job', 'class_id', 'class_member_id', 'name']
+    show_full_result_count = False
+    list_per_page = 100
+
+    def get_queryset(self, request):
+        return super(ApexClassAdmin, self).get_queryset(request).defer(*CLASS_DEFERRED_FIELDS)
+
+
+@admin.register(models.ApexTrigger)
+class ApexTriggerAdmin(admin.ModelAdmin):
+
+    list_display = ['name', 'object_name', 'trigger_id', 'job_id']
+    search_fields = ['name', 'object_name', 'trigger_id']
+    raw_id_fields = ['job']
+    readonly_fields = ['job', 'trigger_id', 'trigger_member_id', 'name', 'object_name']
+    show_full_result_count = False
+    list_per_page = 100
+
+    def get_queryset(self, request):
+        return super(ApexTriggerAdmin, self).get_queryset(request).defer('body', 'line_offsets', 'symbol_table_json')
+
+
+@admin.register(models.LightningComponent)
+class LightningComponentAdmin(admin.ModelAdmin):
+
+    list_display = ['name', 'type', 'controller', 'bundle_id', 'job_id']
+    list_filter = ['type']
+    search_fields = ['name', 'controller']
+    raw_id_fields = ['job']
+    readonly_fields = ['job', 'bundle_id', 'name', 'type', 'controller']
+    show_full_result_count = False
+    list_per_page = 100
+
+    def get_queryset(self, request):
+        return super(LightningComponentAdmin, self).get_queryset(request).defer('apex_methods_json')
+
+
+@admin.register(models.ApexPageComponent)
+class ApexPageComponentAdmin(admin.ModelAdmin):
+
+    list_display = ['name', 'type', 'controller', 'sf_id', 'job_id', 'is_referenced_externally']
+    list_filter = ['type', 'is_referenced_externally']
+    search_fields = ['name', 'controller']
+    raw_id_fields = ['job']
+    readonly_fields = ['job', 'sf_id', 'name', 'type', 'controller']
+    show_full_result_count = False
+    list_per_page = 100
+
+    def get_queryset(self, request):
+        return super(ApexPageComponentAdmin, self).get_queryset(request).defer('body', 'referenced_by_json')
+
+
+@admin.register(models.JobCallback)
+class JobCallbackAdmin(admin.ModelAdmin):
+
+    list_display = ['url', 'job_id', 'status', 'attempts', 'created_date', 'delivered_date']
+    list_filter = ['status']
+    search_fields = ['url']
+    raw_id_fields = ['job']
+    readonly_fields = ['job', 'attempts', 'delivered_date', 'last_error']
+    exclude = ['secret']
@@ -0,0 +1,691 @@
+"""
+CPU bound helpers used while scanning an Org.
+
+Everything in here is a plain function working on plain Python values (strings, lists
+and tuples), so it can be run in a child process by the scan executor without needing
+access to the database or the Django models.
+"""
+
+from bs4 import BeautifulSoup
+
+import array
+import itertools
+import json
+import operator
+import re
+import zlib
+
+
+# The different types of references held against each class
+REFERENCE_TYPES = ['visualforce', 'classes', 'methods', 'variables', 'properties']
+
+
+def get_empty_references():
+    """
+    Build an empty reference object for a class
+    """
+    return {
+        'visualforce': [],
+        'classes': {},
+        'methods': {},
+        'variables': {},
+        'properties': {},
+    }
+
+
+# The version of the compact reference format stored in referenced_by_json
+REFERENCES_VERSION = 2
+
+LINE_DESCRIPTION_PATTERN = re.compile(r'Line (\d+) Column (\d+)')
+
+
+def get_line_description(line):
+    """
+    Build the line description for each reference
+    """
+    return 'Line %d Column %d' % (line[0], line[1])
+
+
+def parse_line_description(description):
+    """
+    Get the (line, column) back from a line description
+    """
+    match = LINE_DESCRIPTION_PATTERN.match(description)
+    return (int(match.group(1)), int(match.group(2)))
+
+
+# Triggers are callers in the references the same as classes, but are named with their type (like
+# Visualforce) so they can't be mistaken for a class with the same name
+TRIGGER_CALLER_SUFFIX = ' (Trigger)'
+
+
+def get_trigger_caller(trigger_name):
+    return trigger_name + TRIGGER_CALLER_SUFFIX
+
+
+def is_trigger_caller(caller):
+    return caller.endswith(TRIGGER_CALLER_SUFFIX)
+
+
+# Lightning components are named with their type too. Like Visualforce, they have no line numbers
+LIGHTNING_CALLER_SUFFIXES = (' (Aura)', ' (LWC)')
+
+
+def get_lightning_caller(bundle_name, bundle_type):
+    return '%s (%s)' % (bundle_name, bundle_type)
+
+
+def is_lightning_caller(caller):
+    return caller.endswith(LIGHTNING_CALLER_SUFFIXES)
+
+
+# Visualforce pages and components are named with their type, eg. "AccountPage (Page)"
+VISUALFORCE_CALLER_SUFFIXES = (' (Page)', ' (Component)')
+
+
+def get_caller_type(caller):
+    """
+    Get the type of a caller (class, trigger, visualforce or lightning) from its name. Everything
+    but a class is named with its type, and Apex names can't have spaces, so they can't be mixed up.
+    Whether the caller has locations isn't enough, as classes can use a member without a line number
+    """
+    if is_trigger_caller(caller):
+        return 'trigger'
+    if is_lightning_caller(caller):
+        return 'lightning'
+    if caller.endswith(VISUALFORCE_CALLER_SUFFIXES):
+        return 'visualforce'
+    return 'class'
+
+
+def get_extensions_from_body(body):
+    """
+    Retrieve the extensions for a VisualForce page body
+    """
+
+    extensions_list = []
+
+    # Load a soup object for the VF page
+    # BeautifulSoup is an HTML parser
+    # VF is pretty close to HTML, so going to leverage
+    # that library to find any controllers or extensions for the VF
+    soup = BeautifulSoup(body or '', 'html.parser')
+
+    # Load the apex:page attribute
+    page_attribute = soup.findAll({'apex:page'})
+
+    if page_attribute:
+
+        page_attribute = page_attribute[0]
+
+        # Load the extensions from the attribute
+        extensions = page_attribute.get('extensions','').strip()
+
+        if extensions:
+            # There could be multiple extensions (seperated by comma), so process
+            # them individually
+            for extension in extensions.split(','):
+                # Trim any whitespace and add to the list to reutrn
+                extensions_list.append(extension.strip())
+
+    return extensions_list
+
+
+def map_class_references(apex_class):
+    """
+    Map the SymbolTable of a single class to a flat list of references.
+
+    The input is a tuple of (class name, SymbolTable JSON, visualforce) where visualforce is
+    a list of (VisualForce name, VisualForce body) tuples for the pages and components that use
+    the class as a controller or extension.
+
+    Each reference returned is a tuple of:
+        (target class, reference type, member name, caller, (line, column))
+
+    The member name is None for visualforce and class references, and the location is None
+    where there is no line to report (eg. a method used in a VisualForce page).
+    A reference of (target class, None, None, None, None) just flags the target class as
+    referenced.
+    """
+
+    class_name, symbol_table_json, visualforce = apex_class
+
+    references = []
+
+    if not symbol_table_json:
+        return references
+
+    # Load the JSON SymbolTable into a Python dict.
+    # We need to traverse this to build a dict of all the external references, and
+    # map back to the class
+    symbol_table = json.loads(symbol_table_json) or {}
+
+    # Add any VF pages as class references
+    if visualforce:
+
+        for vf_name, vf_body in visualforce:
+            references.append((class_name, 'visualforce', None, vf_name, None))
+
+        # Let's see what methods and properties are used in VisualForce
+        for reference_type, members in (('methods', symbol_table.get('methods')), ('properties', symbol_table.get('properties'))):
+
+            for member in members or []:
+
+                # Get the VF merge field name
+                member_vf_name = '{!' + member.get('name') + '}'
+
+                for vf_name, vf_body in visualforce:
+
+                    # Determine if the member name is found in the VF page
+                    if vf_body and member_vf_name in vf_body:
+                        references.append((class_name, reference_type, member.get('name'), vf_name, None))
+
+    # Now, load any external references for the class.
+    # This is all Apex that this class CALLS OUT to, not what references it
+    for external_reference in symbol_table.get('externalReferences') or []:
+
+        # We don't want to include anything with a namespace
+        if external_reference.get('namespace'):
+            continue
+
+        target = external_reference.get('name')
+
+        # Flag the class as referenced, even if there are no lines to report
+        references.append((target, None, None, None, None))
+
+        # Now add in the line and method references
+        # These are any references to a class that isn't a method or property
+        # Eg. Calling the class or constructor: MyClass myClass = new MyClass();
+        for line in external_reference.get('references') or []:
+            references.append((target, 'classes', None, class_name, (line.get('line'), line.get('column'))))
+
+        # Now iterate over all the methods and variables to determine the references
+        for reference_type in ('methods', 'variables'):
+
+            for member in external_reference.get(reference_type) or []:
+
+                # Always add the caller, even if the member has no lines
+                references.append((target, reference_type, member.get('name'), class_name, None))
+
+                for line in member.get('references') or []:
+                    references.append((target, reference_type, member.get('name'), class_name, (line.get('line'), line.get('column'))))
+
+    return references
+
+
+# The Apex used by Lightning components:
+#   controller="ClassName" on the aura:component (or aura:application) markup
+#   "c.methodName" actions in the Aura JavaScript, which call methods on that controller
+#   @salesforce/apex/ClassName.methodName imports in LWC JavaScript
+# Namespaced classes (eg. controller="ns.ClassName") aren't in the Org, so don't match
+AURA_CONTROLLER_PATTERN = re.compile(r'\bcontroller\s*=\s*["\'](\w+)["\']', re.IGNORECASE)
+AURA_ACTION_PATTERN = re.compile(r'["\']c\.(\w+)["\']')
+LWC_APEX_IMPORT_PATTERN = re.compile(r'["\']@salesforce/apex(?:Continuation)?/(\w+)\.(\w+)["\']')
+
+# The Aura definitions holding markup, and those holding JavaScript that can call the controller
+AURA_MARKUP_TYPES = ('COMPONENT', 'APPLICATION')
+AURA_SCRIPT_TYPES = ('CONTROLLER', 'HELPER', 'RENDERER')
+
+
+def extract_lightning_apex(source_type, source):
+    """
+    Find the Apex used by a single Lightning source file.
+
+    The source type is the DefType of an AuraDefinition, or the FilePath of a LightningComponentResource.
+    Returns a tuple of (controller class, [action names], [(class, method)]), only reading the
+    source if it's a type that can use Apex
+    """
+    controller = None
+    actions = []
+    imports = []
+
+    if not source:
+        pass
+
+    elif source_type in AURA_MARKUP_TYPES:
+        match = AURA_CONTROLLER_PATTERN.search(source)
+        controller = match.group(1) if match else None
+
+    elif source_type in AURA_SCRIPT_TYPES:
+        actions = AURA_ACTION_PATTERN.findall(source)
+
+    elif source_type.endswith(('.js', '.ts')):
+        imports = LWC_APEX_IMPORT_PATTERN.findall(source)
+
+    return controller, actions, imports
+
+
+def map_lightning_references(lightning_component):
+    """
+    Map the Apex used by a Lightning component to a flat list of references, in the same form
+    as map_class_references.
+
+    The input is a tuple of (caller name, [(class, method)]), where the method is None for a class
+    used as the controller. Like Visualforce, each class used is referenced by the component, and
+    each method is used without a line
+    """
+    caller, apex_methods = lightning_component
+
+    references = []
+    classes = set()
+
+    for class_name, method in apex_methods:
+        if class_name not in classes:
+            classes.add(class_name)
+            references.append((class_name, 'visualforce', None, caller, None))
+        if method:
+            references.append((class_name, 'methods', method, caller, None))
+
+    return references
+
+
+def map_class_symbols(apex_class):
+    """
+    Get the symbols defined in a class from its SymbolTable, for the symbol search index.
+
+    The input is a tuple of (class name, SymbolTable JSON). Each symbol returned is a tuple of:
+        (class name, kind, member name, line)
+    where kind is 'class', 'method' or 'property', and the member name is None for the class itself
+    """
+
+    class_name, symbol_table_json = apex_class
+
+    symbol_table = (json.loads(symbol_table_json) if symbol_table_json else None) or {}
+
+    def get_line(symbol):
+        return ((symbol or {}).get('location') or {}).get('line')
+
+    symbols = [(class_name, 'class', None, get_line(symbol_table.get('tableDeclaration')))]
+
+    for kind, members in (('method', symbol_table.get('methods')), ('property', symbol_table.get('properties'))):
+        for member in members or []:
+            symbols.append((class_name, kind, member.get('name'), get_line(member)))
+
+    return symbols
+
+
+def map_class_methods(apex_class):
+    """
+    Get the line each method (and constructor) of a class starts on, from its SymbolTable, for
+    working out which method a reference was made from.
+
+    The input is a tuple of (class name, SymbolTable JSON). Each method returned is a tuple of:
+        (class name, method name, line)
+    Overloaded methods are returned once for each overload
+    """
+
+    class_name, symbol_table_json = apex_class
+
+    symbol_table = (json.loads(symbol_table_json) if symbol_table_json else None) or {}
+
+    methods = []
+
+    for member in (symbol_table.get('constructors') or []) + (symbol_table.get('methods') or []):
+        line = (member.get('location') or {}).get('line')
+        if line:
+            methods.append((class_name, member.get('name'), line))
+
+    return methods
+
+
+# Apex comments, and the tokens left once they're removed. Apex is case insensitive, so tokens are lower cased
+APEX_COMMENT_PATTERN = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+APEX_TOKEN_PATTERN = re.compile(r"[a-z_][a-z0-9_]*|\d+|'(?:[^'\\]|\\.)*'|\S")
+
+# Number of tokens in each shingle, and the number of values in each MinHash signature
+SHINGLE_SIZE = 5
+MINHASH_SIZE = 128
+
+# Shingle hashes are cut down to 30 bits, which Python handles much faster than bigger ints.
+# At around 1000 shingles a class, two classes sharing a hash by chance is rare enough not to matter
+SHINGLE_MASK = (1 << 30) - 1
+
+class TokenHashes(dict):
+    """
+    Maps each token to a hash of it, working out each one the first time it's seen.
+    crc32 is used rather than hash(), as it's the same in every process
+    """
+
+    def __missing__(self, token):
+        value = self[token] = zlib.crc32(token.encode('utf-8'))
+        return value
+
+
+_token_hashes = TokenHashes()
+
+
+def get_apex_tokens(body):
+    """
+    Split the body of a class into its tokens, ignoring comments, whitespace and case
+    """
+    return APEX_TOKEN_PATTERN.findall(APEX_COMMENT_PATTERN.sub(' ', (body or '').lower()))
+
+
+def get_shingles(tokens):
+    """
+    Get the set of hashes of each run of SHINGLE_SIZE tokens, as 30 bit ints.
+    Each shingle is hashed as a tuple of its token hashes, which (unlike strings) hash the same in every process
+    """
+    token_hashes = list(map(_token_hashes.__getitem__, tokens))
+    shingles = map(hash, zip(*(token_hashes[offset:] for offset in range(SHINGLE_SIZE))))
+    return set(map(operator.and_, shingles, itertools.repeat(SHINGLE_MASK)))
+
+
+def get_minhash_signature(shingles):
+    """
+    Build the MinHash signature for a set of shingle hashes, with one permutation hashing: each hash
+    goes into one of MINHASH_SIZE bins, and the signature is the smallest value in each bin. So each
+    shingle is only hashed once, rather than once per value in the signature.
+    Empty bins take the value of the next bin that isn't empty (plus how far away it is), so
+    small classes still have comparable signatures
+    """
+
+    # Going from the largest down, the value left in each bin is the smallest
+    ordered = sorted(shingles, reverse=True)
+    sizes = itertools.repeat(MINHASH_SIZE)
+    bins = dict(zip(map(operator.mod, ordered, sizes), map(operator.floordiv, ordered, sizes)))
+
+    signature = []
+
+    for position in range(MINHASH_SIZE):
+        distance = 0
+        while (position + distance) % MINHASH_SIZE not in bins:
+            distance += 1
+        signature.append(bins[(position + distance) % MINHASH_SIZE] + (distance << 30))
+
+    return signature
+
+
+def map_class_minhash(apex_class):
+    """
+    Build the MinHash signature for the body of a class, for finding near duplicates.
+
+    The input is a tuple of (class name, body). Returns a list with a single tuple of:
+        (class name, number of tokens, signature, shingle hashes)
+    or an empty list if the class is too short to have any shingles
+    """
+
+    class_name, body = apex_class
+
+    tokens = get_apex_tokens(body)
+    if len(tokens) < SHINGLE_SIZE:
+        return []
+
+    shingles = get_shingles(tokens)
+
+    # The shingles are kept as a compact array, as they're held for every class in the job
+    return [(class_name, len(tokens), get_minhash_signature(shingles), array.array('I', shingles))]
+
+
+# Everything in Visualforce markup that uses another page or component, in one pattern so each body
+# is only read once. Comments are matched (and ignored) so anything commented out isn't counted:
+#   <c:Name> for components, $Page.Name merge fields (eg. URLFOR($Page.Name)), the pageName of
+#   apex:include and template of apex:composition, and /apex/Name links
+# Bodies are lower cased first, and the lookahead skips anywhere that can't start a match without
+# trying each alternative, which more than halves the time taken
+VISUALFORCE_USAGE_PATTERN = re.compile(
+    r'(?=[<$pt/])(?:'
+    r'<!--.*?-->'
+    r'|<c:(\w+)'
+    r'|\$page\.(\w+)'
+    r'|\b(?:pagename|template)\s*=\s*["\'](\w+)["\']'
+    r'|/apex/(\w+))',
+    re.DOTALL
+)
+
+# The same for Apex: Page.Name references, Component.c.Name dynamic components, and /apex/Name in strings.
+# Strings are matched whole, so a // in a URL isn't taken for a comment
+APEX_USAGE_PATTERN = re.compile(
+    r"(?=[/'pc])(?:"
+    r"//[^\n]*|/\*.*?\*/"
+    r"|'((?:[^'\\]|\\.)*)'"
+    r"|\bpage\.(\w+)"
+    r"|\bcomponent\.c\.(\w+))",
+    re.DOTALL
+)
+
+PAGE_URL_PATTERN = re.compile(r'/apex/(\w+)')
+
+
+def map_visualforce_usage(visualforce):
+    """
+    Find the pages and components used by a Visualforce page or component.
+
+    The input is a tuple of (VisualForce name, body). Each usage returned is a tuple of:
+        (VisualForce name, 'Page' or 'Component', lower cased name used)
+    once for each page or component used, whatever its case in the markup
+    """
+
+    vf_name, body = visualforce
+
+    usages = set()
+
+    for component, page, included, url in VISUALFORCE_USAGE_PATTERN.findall((body or '').lower()):
+        if component:
+            usages.add((vf_name, 'Component', component))
+        elif page or included or url:
+            usages.add((vf_name, 'Page', page or included or url))
+
+    return sorted(usages)
+
+
+def map_class_usage(apex_class):
+    """
+    Find the pages and (dynamic) components used by an Apex class.
+
+    The input is a tuple of (class name, body), and the usages are returned in the same form as map_visualforce_usage
+    """
+
+    class_name, body = apex_class
+
+    usages = set()
+
+    for string, page, component in APEX_USAGE_PATTERN.findall((body or '').lower()):
+        if page:
+            usages.add((class_name, 'Page', page))
+        elif component:
+            usages.add((class_name, 'Component', component))
+        elif '/apex/' in string:
+            usages.update((class_name, 'Page', url) for url in PAGE_URL_PATTERN.findall(string))
+
+    return sorted(usages)
+
+
+def reduce_references(references, references_dict=None):
+    """
+    Merge a stream of references built by map_class_references into a dict of
+    target class name => reference object.
+    The reference objects have the legacy structure, but with (line, column) locations.
+    Use encode_references to get the compact structure stored in referenced_by_json
+    """
+
+    if references_dict is None:
+        references_dict = {}
+
+    for target, reference_type, member, caller, location in references:
+
+        if target not in references_dict:
+            references_dict[target] = get_empty_references()
+
+        reference_object = references_dict[target]
+
+        if reference_type == 'visualforce':
+            reference_object['visualforce'].append(caller)
+
+        elif reference_type == 'classes':
+            reference_object['classes'].setdefault(caller, []).append(location)
+
+        elif reference_type == 'properties':
+            # Properties are only ever referenced from VisualForce, so are a flat list of pages
+            property_references = reference_object['properties'].setdefault(member, [])
+            if caller not in property_references:
+                property_references.append(caller)
+
+        elif reference_type in ('methods', 'variables'):
+            lines = reference_object[reference_type].setdefault(member, {}).setdefault(caller, [])
+            if location:
+                lines.append(location)
+
+    return references_dict
+
+
+class StringTable(dict):
+    """
+    Maps each string to its position in a list of strings, adding any it hasn't seen yet.
+    Used for the per job string table of class, page and member names, so each name is only stored once
+    """
+
+    def __init__(self, strings=None):
+        self.strings = list(strings or [])
+        super(StringTable, self).__init__((string, index) for index, string in enumerate(self.strings))
+
+    def __missing__(self, string):
+        self[string] = len(self.strings)
+        self.strings.append(string)
+        return self[string]
+
+
+def get_reference_strings(references_dict):
+    """
+    Get the sorted list of every caller and member name used in a dict of reference objects
+    """
+    strings = set()
+
+    for reference_object in references_dict.values():
+        strings.update(reference_object['visualforce'])
+        strings.update(reference_object['classes'])
+        for reference_type in ('methods', 'variables', 'properties'):
+            for member, callers in reference_object[reference_type].items():
+                strings.add(member)
+                strings.update(callers)
+
+    return sorted(strings)
+
+
+def get_unique(items):
+    """
+    Remove duplicates from a list, keeping the order
+    """
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
+
+def encode_locations(locations):
+    """
+    Sort and de-duplicate a list of (line, column) locations
+    """
+    return [[line, column] for line, column in sorted(set(tuple(location) for location in locations))]
+
+
+def encode_references(reference_object, string_table):
+    """
+    Build the compact (v2) structure for a reference object from reduce_references.
+    Names are replaced with their index in the job's string table, and locations are [line, column] pairs:
+        {
+            "v": 2,
+            "visualforce": [page, ...],
+            "classes": [[caller, [[line, column], ...]], ...],
+            "methods": [[member, [[caller, [[line, column], ...]], ...]], ...],
+            "variables": [[member, [[caller, [[line, column], ...]], ...]], ...],
+            "properties": [[member, [page, ...]], ...]
+        }
+    """
+    return {
+        'v': REFERENCES_VERSION,
+        'visualforce': [string_table[caller] for caller in get_unique(reference_object['visualforce'])],
+        'classes': [
+            [string_table[caller], encode_locations(locations)]
+            for caller, locations in reference_object['classes'].items()
+        ],
+        'methods': [
+            [string_table[member], [[string_table[caller], encode_locations(locations)] for caller, locations in callers.items()]]
+            for member, callers in reference_object['methods'].items()
+        ],
+        'variables': [
+            [string_table[member], [[string_table[caller], encode_locations(locations)] for caller, locations in callers.items()]]
+            for member, callers in reference_object['variables'].items()
+        ],
+        'properties': [
+            [string_table[member], [string_table[caller] for caller in callers]]
+            for member, callers in reference_object['properties'].items()
+        ],
+    }
+
+
+def decode_references(references, strings):
+    """
+    Build the legacy structure (with 'Line X Column Y' descriptions) from the stored references.
+    References stored before the compact format are returned as they are
+    """
+    if references is None or references.get('v') != REFERENCES_VERSION:
+        return references
+
+    def describe(locations):
+        return [get_line_description(location) for location in locations]
+
+    return {
+        'visualforce': [strings[caller] for caller in references['visualforce']],
+        'classes': dict(
+            (strings[caller], describe(locations))
+            for caller, locations in references['classes']
+        ),
+        'methods': dict(
+            (strings[member], dict((strings[caller], describe(locations)) for caller, locations in callers))
+            for member, callers in references['methods']
+        ),
+        'variables': dict(
+            (strings[member], dict((strings[caller], describe(locations)) for caller, locations in callers))
+            for member, callers in references['variables']
+        ),
+        'properties': dict(
+            (strings[member], [strings[caller] for caller in callers])
+            for member, callers in references['properties']
+        ),
+    }
+
+
+def upgrade_references(references, string_table):
+    """
+    Build the compact structure for references stored before the compact format existed
+    """
+    if references is None or references.get('v') == REFERENCES_VERSION:
+        return references
+
+    def parse(descriptions):
+        return [parse_line_description(description) for description in descriptions]
+
+    return encode_references(
+        {
+            'visualforce': references.get('visualforce') or [],
+            'classes': dict((caller, parse(lines)) for caller, lines in (references.get('classes') or {}).items()),
+            'methods': dict(
+                (member, dict((caller, parse(lines)) for caller, lines in callers.items()))
+                for member, callers in (references.get('methods') or {}).items()
+            ),
+            'variables': dict(
+                (member, dict((caller, parse(lines)) for caller, lines in callers.items()))
+                for member, callers in (references.get('variables') or {}).items()
+            ),
+            'properties': references.get('properties') or {},
+        },
+        string_table
+    )
+
+
+def count_references(reference_object):
+    """
+    Count the callers or members of each type for a reference object from reduce_references.
+    Keyed by the ApexClass field holding each count, so the results can be summarised without
+    loading the references themselves
+    """
+    return dict(
+        ('%s_count' % reference_type, len(get_unique(reference_object[reference_type])))
+        for reference_type in REFERENCE_TYPES
+    )
+
+
+def dumps_references(references):
+    """
+    Serialise the compact references for storage, without any whitespace
+    """
+    return json.dumps(references, separators=(',', ':'))
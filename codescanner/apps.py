@@ -2,7 +2,12 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class CodescannerConfig(AppConfig):
     name = 'codescanner'
+
+    def ready(self):
+        from .fields import keep_jsonb_text
+        connection_created.connect(keep_jsonb_text)
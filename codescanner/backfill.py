@@ -0,0 +1,99 @@
+"""
+Builds the results of finished jobs that were scanned before each result existed.
+
+New scans build everything before they finish. Older jobs have a missing result built on a
+worker the first time it's asked for, rather than while handling the request, as each build
+reads every class in the job through the scan executor. Until it's built, the API returns 202
+and the client tries again.
+
+Each build is claimed with a JobBuild row, so it's only queued once at a time across every web
+process, and is skipped if the result has been built since. The claim is released once the build
+finishes (or fails), and a claim older than BUILD_LOCK_TIMEOUT is assumed to be from a worker that
+died, so can be taken over.
+"""
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import Job, JobBuild
+
+from datetime import timedelta
+from . import cycles
+from . import duplicates
+from . import symbols
+from . import usage
+
+# How long (in seconds) a requested build is assumed to be running, so it isn't queued again
+BUILD_LOCK_TIMEOUT = 10 * 60
+
+
+def is_field_set(field):
+    """
+    Get a check for a result stored in a Job field
+    """
+    def is_set(job):
+        return Job.objects.filter(pk=job.pk, **{'%s__isnull' % field: False}).exists()
+    return is_set
+
+
+# The function that builds each result, and the check for whether it's been built
+RESULTS = {
+    'symbols': (symbols.build_symbol_index, is_field_set('symbol_index_json')),
+    'cycles': (cycles.build_cycles, is_field_set('cycles_json')),
+    'duplicates': (duplicates.build_duplicates, is_field_set('duplicates_json')),
+    'usage': (usage.build_usage, usage.is_built),
+}
+
+
+def is_built(job, result):
+    """
+    Whether a result has been built for a job
+    """
+    build_result, check_built = RESULTS[result]
+    return check_built(job)
+
+
+def request_build(job, result):
+    """
+    Queue the build of a result for a finished job, unless it's already queued
+    """
+
+    # Imported here as the tasks module depends on this one
+    from .tasks import build_job_result
+
+    if claim_build(job, result):
+        build_job_result.apply_async((job.pk, result), queue=job.queue or settings.SCANNER_SMALL_QUEUE)
+
+
+def claim_build(job, result):
+    """
+    Claim the build of a result for a job. Returns False if it's already been claimed, and the claim
+    isn't old enough to have been abandoned
+    """
+    now = timezone.now()
+
+    # Take over an abandoned claim, in a single conditional UPDATE
+    if JobBuild.objects.filter(job=job, result=result, requested_date__lt=now - timedelta(seconds=BUILD_LOCK_TIMEOUT)).update(requested_date=now):
+        return True
+
+    # Otherwise the unique constraint only lets one request create the claim
+    try:
+        with transaction.atomic():
+            JobBuild.objects.create(job=job, result=result, requested_date=now)
+    except IntegrityError:
+        return False
+
+    return True
+
+
+def build(job, result):
+    """
+    Build a result for a job, unless it's been built since it was requested
+    """
+    try:
+        if not is_built(job, result):
+            build_result, check_built = RESULTS[result]
+            build_result(job)
+    finally:
+        JobBuild.objects.filter(job=job, result=result).delete()
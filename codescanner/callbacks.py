@@ -0,0 +1,284 @@
+"""
+Completion webhooks for jobs started through the API.
+
+A job can be given any number of callback URLs (one per API request that was coalesced onto it).
+When the job finishes, or fails, each URL is sent a POST with a compact JSON notice of the
+result. The notice is signed with HMAC-SHA256 using the callback's secret, so the receiver can
+check it came from us:
+
+    X-Signature-Timestamp: 1700000000
+    X-Signature: sha256=HMAC(secret, "<timestamp>.<body>")
+
+Failed deliveries are retried by the Celery task, backing off each time.
+
+Callback URLs have to resolve to public addresses, checked when the URL is given and again
+before each delivery, so they can't be used to reach the private network the workers run on
+(eg. the cloud metadata service at 169.254.169.254). Each notice is sent to the address that was
+checked, rather than letting requests resolve the host again, which could give a private address
+by then (DNS rebinding).
+
+Callbacks are claimed (marked as sending) before they're delivered. A callback that hasn't been
+attempted in much longer than the longest wait between retries has lost its worker, so is
+released to be sent again (see requeue_stale_callbacks).
+"""
+
+from django.conf import settings
+from django.db.models import Count, Q
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import ApexClass, JobCallback
+
+from datetime import timedelta
+
+import hashlib
+import hmac
+import ipaddress
+import json
+import requests
+import secrets
+import socket
+import time
+import urllib.parse
+
+
+class CallbackError(Exception):
+    """
+    A callback couldn't be delivered. retry is True if it's worth trying again later
+    """
+
+    def __init__(self, message, retry=False):
+        super(CallbackError, self).__init__(message)
+        self.retry = retry
+
+
+def generate_secret():
+    return secrets.token_urlsafe(32)
+
+
+def get_signature(secret, timestamp, body):
+    """
+    Sign the body of a notice
+    """
+    message = ('%s.' % timestamp).encode('utf-8') + body
+    return 'sha256=' + hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret, timestamp, body, signature, tolerance=300):
+    """
+    Check the signature of a notice, and that it was sent within tolerance seconds
+    """
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+    except (TypeError, ValueError):
+        return False
+
+    return hmac.compare_digest(get_signature(secret, timestamp, body), signature or '')
+
+
+def check_url(url):
+    """
+    Make sure a callback URL only resolves to public addresses, and return the address to send to.
+    Raises CallbackError if it doesn't, or if the host can't be resolved (which is worth retrying).
+    Returns None if private addresses are allowed, so the host is resolved as normal
+    """
+    if settings.SCANNER_CALLBACK_ALLOW_PRIVATE:
+        return None
+
+    host = urllib.parse.urlsplit(url).hostname
+    if not host:
+        raise CallbackError('The callback URL has no host')
+
+    try:
+        addresses = [address_info[4][0] for address_info in socket.getaddrinfo(host, None)]
+    except (socket.gaierror, UnicodeError) as ex:
+        raise CallbackError('Could not resolve %s: %s' % (host, ex), retry=True)
+
+    for address in addresses:
+
+        # Drop the scope from IPv6 addresses, and check IPv4 addresses mapped into IPv6 as IPv4
+        ip = ipaddress.ip_address(address.split('%')[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+
+        # Covers private, loopback, link-local, shared and reserved addresses
+        if not ip.is_global or ip.is_multicast:
+            raise CallbackError('The callback URL resolves to a private address (%s)' % ip)
+
+    return addresses[0].split('%')[0]
+
+
+class PinnedAddressAdapter(requests.adapters.HTTPAdapter):
+    """
+    Connects to an address that's already been checked, for requests sent to that address in place
+    of the host. HTTPS is still verified (and sent SNI) for the host, rather than the address
+    """
+
+    def __init__(self, host, **kwargs):
+        self.host = host
+        super(PinnedAddressAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['server_hostname'] = self.host
+        kwargs['assert_hostname'] = self.host
+        super(PinnedAddressAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+def post(url, address, **kwargs):
+    """
+    POST to a URL, connecting to the given address instead of resolving the host again
+    """
+    if not address:
+        return requests.post(url, **kwargs)
+
+    parts = urllib.parse.urlsplit(url)
+    netloc = '[%s]' % address if ':' in address else address
+    if parts.port:
+        netloc += ':%d' % parts.port
+    pinned_url = urllib.parse.urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment))
+
+    kwargs['headers'] = dict(kwargs.get('headers') or {}, Host=parts.netloc.rpartition('@')[2])
+
+    with requests.Session() as session:
+        session.mount('%s://' % parts.scheme, PinnedAddressAdapter(parts.hostname))
+        return session.post(pinned_url, **kwargs)
+
+
+def register_callback(job, url, secret=None):
+    """
+    Add a callback for a job. If the job has already finished, it's sent straight away
+    """
+
+    # Imported here as the tasks module depends on this one
+    from .tasks import send_job_callbacks
+
+    callback = JobCallback.objects.create(job=job, url=url, secret=secret or generate_secret())
+
+    # The job may have finished before the callback was added, in which case nothing else will send it
+    if job.__class__.objects.filter(pk=job.pk, status__in=['Finished', 'Error']).exists():
+        send_job_callbacks.delay(job.pk)
+
+    return callback
+
+
+def claim_callbacks(job_id):
+    """
+    Get the ids of the callbacks for a job that are waiting to be sent, marking them as sending
+    so they're only ever sent once
+    """
+    claimed = []
+    for callback_id in JobCallback.objects.filter(job_id=job_id, status='Pending').values_list('id', flat=True):
+        if JobCallback.objects.filter(pk=callback_id, status='Pending').update(status='Sending', attempted_date=timezone.now()):
+            claimed.append(callback_id)
+    return claimed
+
+
+def get_stale_cutoff():
+    """
+    Callbacks still sending that haven't been attempted since this have lost their worker (eg. it
+    was killed mid delivery), as it's twice the longest wait between retries
+    """
+    return timezone.now() - timedelta(seconds=2 * get_retry_delay(settings.SCANNER_CALLBACK_MAX_RETRIES))
+
+
+def requeue_stale_callbacks():
+    """
+    Release callbacks that lost their worker, so they're sent again. Those that have used up all
+    their attempts are failed instead. Returns the ids of the jobs with callbacks to send
+    """
+    stale_callbacks = JobCallback.objects.filter(status='Sending', attempted_date__lt=get_stale_cutoff())
+    job_ids = set()
+
+    for callback_id, job_id, attempts in stale_callbacks.values_list('id', 'job_id', 'attempts'):
+
+        # Only if it's still stale, in case it was attempted in the meantime
+        callback = JobCallback.objects.filter(pk=callback_id, status='Sending', attempted_date__lt=get_stale_cutoff())
+
+        if attempts > settings.SCANNER_CALLBACK_MAX_RETRIES:
+            callback.update(status='Failed', last_error='The notice stopped being sent')
+        elif callback.update(status='Pending'):
+            job_ids.add(job_id)
+
+    return job_ids
+
+
+def build_notice(job):
+    """
+    Build the compact notice of the job result
+    """
+    counts = ApexClass.objects.filter(job=job).aggregate(
+        classes=Count('id'),
+        unreferenced=Count('id', filter=Q(is_referenced_externally=False)),
+    )
+
+    return {
+        'event': 'job.finished',
+        'id': job.slug,
+        'status': job.status,
+        'success': job.status == 'Finished',
+        'error': job.error,
+        'classes': counts['classes'],
+        'unreferencedClasses': counts['unreferenced'],
+        'apiCalls': job.api_calls,
+        'finishedDate': job.finished_date.isoformat() if job.finished_date else None,
+        'resultUrl': settings.SITE_URL + reverse('api-job-json', kwargs={'slug': job.slug}),
+    }
+
+
+def deliver(callback):
+    """
+    Send the notice for a callback. Raises CallbackError if it couldn't be delivered
+    """
+    body = json.dumps(build_notice(callback.job), separators=(',', ':')).encode('utf-8')
+    timestamp = str(int(time.time()))
+
+    callback.attempts += 1
+    JobCallback.objects.filter(pk=callback.pk).update(attempts=callback.attempts, attempted_date=timezone.now())
+
+    # The host may resolve somewhere else by now, so it's checked again, and the notice is sent to
+    # the address that was checked
+    address = check_url(callback.url)
+
+    try:
+        response = post(
+            callback.url,
+            address,
+            data=body,
+            headers={
+                'Content-Type': 'application/json',
+                'User-Agent': 'sfcodeclean-webhook',
+                'X-Signature-Timestamp': timestamp,
+                'X-Signature': get_signature(callback.secret, timestamp, body),
+            },
+            timeout=settings.SCANNER_CALLBACK_TIMEOUT,
+            allow_redirects=False,
+        )
+    except (requests.ConnectionError, requests.Timeout) as ex:
+        raise CallbackError('Could not connect: %s' % ex, retry=True)
+    except requests.RequestException as ex:
+        raise CallbackError('Could not send: %s' % ex)
+
+    # Only retry where the receiver might succeed later
+    if response.status_code == 429 or response.status_code >= 500:
+        raise CallbackError('Receiver returned %d' % response.status_code, retry=True)
+
+    if response.status_code >= 300:
+        raise CallbackError('Receiver returned %d' % response.status_code)
+
+    JobCallback.objects.filter(pk=callback.pk).update(status='Delivered', delivered_date=timezone.now(), last_error=None)
+
+
+def get_retry_delay(retries):
+    """
+    Seconds to wait before the next attempt, doubling each time
+    """
+    return settings.SCANNER_CALLBACK_RETRY_BACKOFF * (2 ** retries)
+
+
+def record_error(callback, error):
+    JobCallback.objects.filter(pk=callback.pk).update(last_error=str(error))
+
+
+def mark_failed(callback, error):
+    JobCallback.objects.filter(pk=callback.pk).update(status='Failed', last_error=str(error))
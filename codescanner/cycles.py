@@ -0,0 +1,151 @@
+"""
+Dependency cycles in a job.
+
+Classes that depend on each other, directly or through other classes, can't be removed one at
+a time. Those cycles are the strongly connected components of the reference graph, found with
+the same iterative Tarjan's algorithm as the impact analysis (see graph.py), at two levels:
+
+    - classes, where a class depends on another if it uses it at all
+    - members, where the caller of each reference is the method (or constructor) of the
+      calling class that the reference was made from. The references only hold the calling
+      class and line, so this is the method declared closest above that line, or the class
+      itself for references outside any method
+
+Visualforce and Lightning can't be part of a cycle (nothing uses a page or component), and a class or method using itself
+isn't counted. The cycles are found once the references for a job are built, and stored against
+the job, largest first.
+"""
+
+from django.conf import settings
+
+from .fields import decompress
+from .models import Job, iter_chunked
+from . import analysis
+from . import executor
+from . import graph
+
+import bisect
+import collections
+import json
+
+
+LEVELS = ['classes', 'members']
+
+
+def get_method_lines(job):
+    """
+    Get a dict of class name => (sorted start lines, method names) for the methods of every class in
+    the job. Decoding the SymbolTables is sharded across the scan executor
+    """
+    methods = collections.defaultdict(list)
+
+    class_inputs = (
+        (apex_class.name, apex_class.symbol_table_json)
+        for apex_class in iter_chunked(job.classes().filter(symbol_table_json__isnull=False), ['name', 'symbol_table_json'])
+    )
+
+    with executor.get_executor(job.apexclass_set.count()) as pool:
+        for class_name, method, line in executor.flat_map_batched(pool, analysis.map_class_methods, class_inputs, settings.SCANNER_QUERY_CHUNK_SIZE):
+            methods[class_name].append((line, method))
+
+    method_lines = {}
+    for class_name, class_methods in methods.items():
+        class_methods.sort()
+        method_lines[class_name] = ([line for line, method in class_methods], [method for line, method in class_methods])
+
+    return method_lines
+
+
+def find_cycles(names, edges):
+    """
+    Get the cycles in a graph of numbered nodes, from its (source, target) edges.
+    Each cycle is a sorted list of node names, and the largest cycles come first
+    """
+    adjacency = [[] for _ in names]
+    for source, target in edges:
+        if source != target:
+            adjacency[source].append(target)
+
+    component, component_count = graph.get_components(adjacency)
+
+    members = [[] for _ in range(component_count)]
+    for node, node_component in enumerate(component):
+        members[node_component].append(names[node])
+
+    cycles = [sorted(component_names) for component_names in members if len(component_names) > 1]
+    cycles.sort(key=lambda cycle: (-len(cycle), cycle[0]))
+
+    return cycles
+
+
+def build_cycles(job):
+    """
+    Find and store the cycles for a job. Run once the references for the job have been written
+    """
+    method_lines = get_method_lines(job)
+
+    string_table = analysis.StringTable(job.get_reference_strings())
+    strings = string_table.strings
+
+    # Node numbers for each graph, assigned as names are seen
+    class_nodes = analysis.StringTable()
+    member_nodes = analysis.StringTable()
+    class_edges = set()
+    member_edges = set()
+
+    def get_calling_member(caller, line):
+        lines, methods = method_lines.get(caller, ((), ()))
+        position = bisect.bisect_right(lines, line) - 1
+        return member_nodes['%s.%s' % (caller, methods[position])] if position >= 0 else member_nodes[caller]
+
+    class_references = job.classes().values_list('name', 'referenced_by_json').iterator(chunk_size=settings.SCANNER_QUERY_CHUNK_SIZE)
+
+    for class_name, referenced_by_json in class_references:
+
+        references = json.loads(decompress(referenced_by_json)) if referenced_by_json else None
+        if not references:
+            continue
+
+        # Jobs scanned before the compact format are upgraded, adding their names to the string table
+        references = analysis.upgrade_references(references, string_table)
+
+        target = class_nodes[class_name]
+
+        for caller, locations in references['classes']:
+            class_edges.add((class_nodes[strings[caller]], target))
+            for line, column in locations:
+                member_edges.add((get_calling_member(strings[caller], line), member_nodes[class_name]))
+
+        for reference_type in ['methods', 'variables']:
+            for member, callers in references[reference_type]:
+
+                member_target = member_nodes['%s.%s' % (class_name, strings[member])]
+
+                # Callers without a location are Visualforce or Lightning, which can't be part of a cycle
+                for caller, locations in callers:
+                    if locations:
+                        class_edges.add((class_nodes[strings[caller]], target))
+                    for line, column in locations:
+                        member_edges.add((get_calling_member(strings[caller], line), member_target))
+
+    job.cycles_json = json.dumps({
+        'classes': find_cycles(class_nodes.strings, class_edges),
+        'members': find_cycles(member_nodes.strings, member_edges),
+    }, separators=(',', ':'))
+
+    Job.objects.filter(pk=job.pk).update(cycles_json=job.cycles_json)
+
+    return job.cycles_json
+
+
+def get_cycles(job):
+    """
+    Load the cycles for a job. Returns None if they haven't been found, for jobs that haven't
+    finished or were scanned before cycles were found (see backfill.py)
+    """
+    data = Job.objects.filter(pk=job.pk).values_list('cycles_json', flat=True).first()
+
+    if data is None:
+        return None
+
+    return json.loads(decompress(data))
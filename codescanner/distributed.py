@@ -0,0 +1,229 @@
+"""
+Map-reduce building of the class references across the Celery workers.
+
+For very large Orgs holding every reference for the job in one process doesn't scale, so:
+    - Mapper tasks take a shard of classes (or triggers, or Lightning components), find what
+      each one uses and stage each (target class, type, member, caller, location) reference
+      in the StagedReference table
+    - The string table of every name in the staged references is built for the job, so
+      every reducer refers to names by the same position
+    - Reducer tasks take a partition of target classes, and build the referenced_by_json
+      for each class in the partition from the staged references
+    - The job is then finalised once all the reducers are complete
+"""
+
+from django.conf import settings
+from django.db import transaction
+
+from .fields import decompress
+from .models import ApexClass, Job, StagedReference, iter_chunked
+from . import analysis
+from . import cycles
+from . import duplicates
+from . import symbols
+from . import usage
+
+import json
+import zlib
+
+
+def get_partition(class_name, partitions):
+    """
+    Get the reducer partition that owns a target class
+    """
+    return zlib.crc32(class_name.encode('utf-8')) % partitions
+
+
+def split_shards(record_ids, start=0):
+    """
+    Split a list of ids into shards for the mappers
+    Returns a list of (offset, [ids]), where offset is the position of the first record in the job
+    """
+    shard_size = settings.SCANNER_MAP_SHARD_SIZE
+
+    return [
+        (start + offset, record_ids[offset:offset + shard_size])
+        for offset in range(0, len(record_ids), shard_size)
+    ]
+
+
+def get_shards(job):
+    """
+    Split the classes for the job into shards for the mappers
+    """
+    return split_shards(list(job.classes().filter(symbol_table_json__isnull=False).values_list('id', flat=True)))
+
+
+def get_trigger_shards(job):
+    """
+    Split the triggers for the job into shards, the same as the classes.
+    The triggers come after all the classes, as they do in a local scan
+    """
+    return split_shards(
+        list(job.triggers().filter(symbol_table_json__isnull=False).values_list('id', flat=True)),
+        job.apexclass_set.filter(symbol_table_json__isnull=False).count()
+    )
+
+
+def get_lightning_shards(job):
+    """
+    Split the Lightning components for the job into shards, after the classes and triggers
+    """
+    return split_shards(
+        list(job.lightning().values_list('id', flat=True)),
+        job.apexclass_set.filter(symbol_table_json__isnull=False).count() + job.apextrigger_set.filter(symbol_table_json__isnull=False).count()
+    )
+
+
+def get_vf_usage_for_classes(job, class_names):
+    """
+    Build the same dict as ScanJob.get_class_to_vf_usage_dict, but only for the given classes
+    """
+    apex_to_vf = {}
+
+    for visualforce in iter_chunked(job.visualforce().filter(controller__isnull=False), ['name', 'type', 'controller', 'body']):
+        for controller in visualforce.controller.split(','):
+            if controller in class_names:
+                apex_to_vf.setdefault(controller, []).append(visualforce)
+
+    return apex_to_vf
+
+
+def map_references(job, offset, class_ids, partitions):
+    """
+    Stage the references for a shard of classes
+    """
+
+    classes = list(job.classes().filter(id__in=class_ids).only('name', 'symbol_table_json'))
+    apex_to_vf = get_vf_usage_for_classes(job, set(apex_class.name for apex_class in classes))
+
+    return stage_references(job, offset, partitions, [
+        (
+            apex_class.name,
+            apex_class.symbol_table_json,
+            [(visualforce.name + ' (' + visualforce.type + ')', visualforce.body) for visualforce in apex_to_vf.get(apex_class.name, [])]
+        )
+        for apex_class in classes
+    ])
+
+
+def map_trigger_references(job, offset, trigger_ids, partitions):
+    """
+    Stage the references for a shard of triggers
+    """
+    triggers = job.triggers().filter(id__in=trigger_ids).only('name', 'symbol_table_json')
+
+    return stage_references(job, offset, partitions, [
+        (analysis.get_trigger_caller(apex_trigger.name), apex_trigger.symbol_table_json, [])
+        for apex_trigger in triggers
+    ])
+
+
+def map_lightning_references(job, offset, component_ids, partitions):
+    """
+    Stage the references for a shard of Lightning components
+    """
+    components = job.lightning().filter(id__in=component_ids).values_list('name', 'type', 'apex_methods_json')
+
+    return stage_references(job, offset, partitions, [
+        (analysis.get_lightning_caller(name, bundle_type), json.loads(decompress(apex_methods_json) or '[]'))
+        for name, bundle_type, apex_methods_json in components
+    ], analysis.map_lightning_references)
+
+
+def stage_references(job, offset, partitions, class_inputs, map_references=analysis.map_class_references):
+    """
+    Map the references for each (name, SymbolTable, visualforce) input (or other input for the map function),
+    and stage them for the reducers
+    """
+    staged_references = []
+
+    for ordinal, class_input in enumerate(class_inputs, offset):
+
+        references = map_references(class_input)
+
+        for target, reference_type, member, caller, location in references:
+            staged_references.append(StagedReference(
+                job=job,
+                partition=get_partition(target, partitions),
+                ordinal=ordinal,
+                target=target,
+                reference_type=reference_type,
+                member=member,
+                caller=caller,
+                line=location[0] if location else None,
+                column=location[1] if location else None,
+            ))
+
+    StagedReference.objects.bulk_create(staged_references, batch_size=500)
+
+    return len(staged_references)
+
+
+def build_reference_strings(job):
+    """
+    Once all the mappers have run, store the string table of every caller and member name for the job
+    """
+    staged_references = StagedReference.objects.filter(job=job)
+
+    strings = set(staged_references.exclude(caller__isnull=True).values_list('caller', flat=True).distinct())
+    strings.update(staged_references.exclude(member__isnull=True).values_list('member', flat=True).distinct())
+
+    Job.objects.filter(pk=job.pk).update(reference_strings_json=json.dumps(sorted(strings)))
+
+    return len(strings)
+
+
+def reduce_references(job, partition, partitions):
+    """
+    Build the referenced_by_json for each class in the partition
+    """
+
+    staged_references = (
+        StagedReference.objects
+        .filter(job=job, partition=partition)
+        .order_by('ordinal', 'id')
+        .values_list('target', 'reference_type', 'member', 'caller', 'line', 'column')
+        .iterator()
+    )
+
+    references_dict = analysis.reduce_references(
+        (target, reference_type, member, caller, (line, column) if line is not None else None)
+        for target, reference_type, member, caller, line, column in staged_references
+    )
+
+    string_table = analysis.StringTable(job.get_reference_strings())
+
+    # Write back to the classes in the job. Anything not in the Org (eg. system classes) is ignored
+    updated = 0
+    with transaction.atomic():
+        for class_id, class_name in job.apexclass_set.values_list('id', 'name'):
+            if class_name in references_dict:
+                ApexClass.objects.filter(pk=class_id).update(
+                    is_referenced_externally=True,
+                    referenced_by_json=analysis.dumps_references(
+                        analysis.encode_references(references_dict.get(class_name), string_table)
+                    ),
+                    **analysis.count_references(references_dict.get(class_name))
+                )
+                updated += 1
+
+    return updated
+
+
+def finish_references(job):
+    """
+    Once all the reducers have run, give every class that wasn't referenced empty references,
+    clear out the staged references, index the symbols in the job for searching, and find any
+    cycles, duplicates and the usage of each page and component
+    """
+    job.apexclass_set.filter(referenced_by_json__isnull=True).update(
+        referenced_by_json=analysis.dumps_references(
+            analysis.encode_references(analysis.get_empty_references(), analysis.StringTable())
+        )
+    )
+    StagedReference.objects.filter(job=job).delete()
+    symbols.build_symbol_index(job)
+    cycles.build_cycles(job)
+    duplicates.build_duplicates(job)
+    usage.build_usage(job)
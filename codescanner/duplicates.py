@@ -0,0 +1,158 @@
+"""
+Near duplicate classes in a job.
+
+Copy and pasted classes are found by comparing the sets of shingles (runs of SHINGLE_SIZE
+tokens) in each class body:
+
+    - Each class is tokenised and given a MinHash signature (see analysis.map_class_minhash),
+      sharded across the scan executor
+    - The signatures are split into bands, and classes with the same values in any band are
+      candidates (locality sensitive hashing). Classes with a Jaccard similarity of s share a
+      band with a probability of 1 - (1 - s^rows)^bands, so similar classes almost always
+      meet and dissimilar ones rarely do, without comparing every pair
+    - Each candidate pair is then checked with the exact Jaccard similarity of the shingles
+
+The pairs over the threshold are stored against the job, most similar first, along with the
+groups of classes they link together.
+"""
+
+from django.conf import settings
+
+from .fields import decompress
+from .models import Job
+from . import analysis
+from . import executor
+
+import collections
+import itertools
+import json
+
+
+# The bands and rows of the signatures used for the LSH (using 120 of the 128 values). With 20
+# bands of 6 rows, pairs with a similarity of 0.8 are candidates 99.8% of the time, pairs of 0.5
+# 27% of the time, and pairs of 0.3 only 1.4% of the time
+BANDS = 20
+ROWS = 6
+
+
+def get_signatures(job):
+    """
+    Get a list of (class name, tokens, signature, shingles) for every class in the job with a body
+    long enough to compare
+    """
+    # Read as plain values, as loading the body through model instances refetches it per class
+    class_inputs = (
+        (class_name, decompress(body))
+        for class_name, body in job.classes().values_list('name', 'body').iterator(chunk_size=settings.SCANNER_QUERY_CHUNK_SIZE)
+    )
+
+    with executor.get_executor(job.apexclass_set.count()) as pool:
+        return [
+            signature
+            for signature in executor.flat_map_batched(pool, analysis.map_class_minhash, class_inputs, settings.SCANNER_QUERY_CHUNK_SIZE)
+            if signature[1] >= settings.SCANNER_DUPLICATE_MIN_TOKENS
+        ]
+
+
+def get_candidates(signatures):
+    """
+    Get the pairs of classes that have the same values for any band of their signatures
+    """
+    candidates = set()
+
+    for band in range(BANDS):
+        buckets = collections.defaultdict(list)
+        start = band * ROWS
+
+        for position, (class_name, tokens, signature, shingles) in enumerate(signatures):
+            buckets[tuple(signature[start:start + ROWS])].append(position)
+
+        for positions in buckets.values():
+            if len(positions) > 1:
+                candidates.update(itertools.combinations(positions, 2))
+
+    return candidates
+
+
+def get_groups(pairs):
+    """
+    Join the duplicate pairs into groups of classes, largest first
+    """
+    parents = {}
+
+    def find(name):
+        parents.setdefault(name, name)
+        while parents[name] != name:
+            parents[name] = parents[parents[name]]
+            name = parents[name]
+        return name
+
+    for first, second, similarity, first_tokens, second_tokens in pairs:
+        parents[find(first)] = find(second)
+
+    groups = collections.defaultdict(list)
+    for name in parents:
+        groups[find(name)].append(name)
+
+    return sorted((sorted(group) for group in groups.values()), key=lambda group: (-len(group), group[0]))
+
+
+def build_duplicates(job):
+    """
+    Find and store the near duplicate classes for a job
+    """
+    signatures = get_signatures(job)
+    threshold = settings.SCANNER_DUPLICATE_THRESHOLD
+
+    # The shingles are only turned into sets for the classes that are compared
+    shingle_sets = {}
+
+    def get_shingles(position):
+        if position not in shingle_sets:
+            shingle_sets[position] = frozenset(signatures[position][3])
+        return shingle_sets[position]
+
+    pairs = []
+
+    for first, second in get_candidates(signatures):
+
+        first_shingles = get_shingles(first)
+        second_shingles = get_shingles(second)
+
+        shared = len(first_shingles & second_shingles)
+        similarity = shared / float(len(first_shingles) + len(second_shingles) - shared)
+
+        if similarity >= threshold:
+            first_name, first_tokens = signatures[first][:2]
+            second_name, second_tokens = signatures[second][:2]
+            if second_name < first_name:
+                first_name, first_tokens, second_name, second_tokens = second_name, second_tokens, first_name, first_tokens
+            pairs.append((first_name, second_name, round(similarity, 3), first_tokens, second_tokens))
+
+    # Most similar first, and the biggest classes first where they're as similar
+    pairs.sort(key=lambda pair: (-pair[2], -min(pair[3], pair[4]), pair[0], pair[1]))
+
+    job.duplicates_json = json.dumps({
+        'threshold': threshold,
+        'classes': len(signatures),
+        'pairCount': len(pairs),
+        'pairs': pairs[:settings.SCANNER_DUPLICATE_REPORT_LIMIT],
+        'groups': get_groups(pairs),
+    }, separators=(',', ':'))
+
+    Job.objects.filter(pk=job.pk).update(duplicates_json=job.duplicates_json)
+
+    return job.duplicates_json
+
+
+def get_duplicates(job):
+    """
+    Load the duplicates report for a job. Returns None if it hasn't been built, for jobs that haven't
+    finished or were scanned before duplicates were found (see backfill.py)
+    """
+    data = Job.objects.filter(pk=job.pk).values_list('duplicates_json', flat=True).first()
+
+    if data is None:
+        return None
+
+    return json.loads(decompress(data))
@@ -0,0 +1,125 @@
+"""
+Executors for the CPU bound phases of a scan (parsing VisualForce, decoding SymbolTables and
+building the references).
+
+The Celery task runs in a single process, so anything heavy is farmed out to a billiard
+process pool. Only plain values are sent to the children, and results come back in the
+same order they were sent, so the parent can merge them as if it had done the work itself.
+"""
+
+from django.conf import settings
+
+import billiard
+import itertools
+
+
+def map_chunk(func, chunk):
+    """
+    Run the function over a chunk of items in a child process
+    """
+    return [func(item) for item in chunk]
+
+
+class SerialExecutor(object):
+    """
+    Runs everything in the current process. Used when SCANNER_WORKERS = 1, which is handy for debugging
+    """
+
+    workers = 1
+
+    def map(self, func, iterable, chunksize=None):
+        return map(func, iterable)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ProcessPoolExecutor(object):
+    """
+    Shards the work across a pool of billiard processes
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = billiard.Pool(processes=workers)
+
+    def map(self, func, iterable, chunksize=None):
+        """
+        Map the function over the iterable, preserving order.
+        Each chunk is sent as its own job rather than using imap, as billiard workers wait (for up to 30
+        seconds) on exit until every job they ran has been acknowledged, and imap jobs never are
+        """
+        iterator = iter(iterable)
+        results = []
+
+        while True:
+            chunk = list(itertools.islice(iterator, chunksize or settings.SCANNER_CHUNK_SIZE))
+            if not chunk:
+                break
+            results.append(self.pool.apply_async(map_chunk, (func, chunk)))
+
+        return itertools.chain.from_iterable(result.get() for result in results)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # Don't wait on outstanding work if something went wrong
+        if exc_type:
+            self.pool.terminate()
+            self.pool.join()
+        else:
+            self.close()
+
+
+def get_worker_count():
+    """
+    The number of processes to use. 0 means one per CPU
+    """
+    return settings.SCANNER_WORKERS or billiard.cpu_count()
+
+
+def get_executor(size=None):
+    """
+    Get the executor to run the CPU bound phases of a scan.
+    If the amount of work is known and too small to be worth a pool, run it in-process
+    """
+    workers = get_worker_count()
+
+    if workers <= 1 or (size is not None and size <= settings.SCANNER_CHUNK_SIZE):
+        return SerialExecutor()
+
+    return ProcessPoolExecutor(min(workers, size) if size else workers)
+
+
+def flat_map(executor, func, iterable, chunksize=None):
+    """
+    Map a function that returns a list over the iterable, and chain the results together
+    """
+    return itertools.chain.from_iterable(executor.map(func, iterable, chunksize))
+
+
+def flat_map_batched(executor, func, iterable, batch_size, chunksize=None):
+    """
+    Same as flat_map, but only pulls batch_size items from the iterable at a time.
+    Used when the iterable is a database cursor, which has to be read from this thread
+    and shouldn't be read into memory all at once
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        for result in executor.map(func, batch, chunksize):
+            for item in result:
+                yield item
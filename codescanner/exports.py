@@ -0,0 +1,139 @@
+"""
+Flat exports of the references in a job, for loading into other tools.
+
+Every use of a class or one of its members is one row:
+
+    class, kind, member, caller, caller_type, line, column
+
+where kind is class, method, variable or property, and caller_type is class, trigger, visualforce
+or lightning, going by the caller's name. Member is blank for uses of the class itself, and
+Visualforce and Lightning have no line or column.
+
+Rows are generated from the stored references a chunk of classes at a time, and encoded a
+batch of rows at a time into NDJSON or CSV, so memory stays flat however big the job is.
+"""
+
+from django.conf import settings
+
+from .fields import decompress
+from . import analysis
+
+import csv
+import io
+import itertools
+import json
+
+
+FIELDS = ['class', 'kind', 'member', 'caller', 'caller_type', 'line', 'column']
+
+# Number of rows in each chunk of output
+BATCH_SIZE = 1000
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def iter_class_rows(class_name, references, strings):
+    """
+    Yield the rows for one class from its compact references
+    """
+    for caller in references['visualforce']:
+        yield (class_name, 'class', None, strings[caller], analysis.get_caller_type(strings[caller]), None, None)
+
+    for caller, locations in references['classes']:
+        caller_type = analysis.get_caller_type(strings[caller])
+        for line, column in locations:
+            yield (class_name, 'class', None, strings[caller], caller_type, line, column)
+
+    for reference_type, kind in [('methods', 'method'), ('variables', 'variable')]:
+        for member, callers in references[reference_type]:
+            for caller, locations in callers:
+
+                caller_type = analysis.get_caller_type(strings[caller])
+
+                # Methods used in Visualforce and Lightning (and some used by classes) are stored without a location
+                if not locations:
+                    yield (class_name, kind, strings[member], strings[caller], caller_type, None, None)
+                    continue
+
+                for line, column in locations:
+                    yield (class_name, kind, strings[member], strings[caller], caller_type, line, column)
+
+    for member, callers in references['properties']:
+        for caller in callers:
+            yield (class_name, 'property', strings[member], strings[caller], analysis.get_caller_type(strings[caller]), None, None)
+
+
+def iter_rows(job):
+    """
+    Yield the rows for every class in the job, loading the references a chunk of classes at a time
+    """
+    string_table = analysis.StringTable(job.get_reference_strings())
+
+    class_references = job.classes().filter(
+        referenced_by_json__isnull=False
+    ).values_list('name', 'referenced_by_json').iterator(chunk_size=settings.SCANNER_QUERY_CHUNK_SIZE)
+
+    for class_name, referenced_by_json in class_references:
+
+        # Jobs scanned before the compact format are upgraded, adding their names to the string table
+        references = analysis.upgrade_references(json.loads(decompress(referenced_by_json)), string_table)
+
+        if references:
+            for row in iter_class_rows(class_name, references, string_table.strings):
+                yield row
+
+
+def iter_batches(rows):
+    """
+    Group the rows into lists of BATCH_SIZE, so each chunk of output is encoded in one go
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+# Each NDJSON line is filled in from a template, rather than building and dumping a dict per row
+NDJSON_ROW = '{%s}\n' % ','.join('"%s":%%s' % field for field in FIELDS)
+
+
+def encode_value(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, int):
+        return str(value)
+    return json.dumps(value)
+
+
+def iter_ndjson(rows):
+    for batch in iter_batches(rows):
+        yield ''.join(NDJSON_ROW % tuple(encode_value(value) for value in row) for row in batch)
+
+
+def iter_csv(rows):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(FIELDS)
+
+    for batch in iter_batches(rows):
+        writer.writerows(batch)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+
+    # Only the header, for a job with no references
+    if output.tell():
+        yield output.getvalue()
+
+
+def export(job, export_format):
+    """
+    Get an iterator over the chunks of the export of a job, in ndjson or csv
+    """
+    encode = {'ndjson': iter_ndjson, 'csv': iter_csv}[export_format]
+    return encode(iter_rows(job))
@@ -0,0 +1,244 @@
+"""
+Custom model fields
+"""
+
+from django.conf import settings
+from django.db import models, NotSupportedError
+from django.db.models.query_utils import DeferredAttribute
+
+import gzip
+import json
+import struct
+import zlib
+
+
+# The first byte of every stored value says how the rest of it is stored
+FORMAT_RAW = 0
+FORMAT_ZLIB = 1
+
+# gzip header with no file name or modification time, from an unknown OS
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+class CompressedData(bytes):
+    """
+    A value as stored in the database: a format byte followed by the (possibly compressed) UTF-8 text.
+    The text is only decompressed the first time it's needed
+    """
+
+    @property
+    def format(self):
+        return self[0] if self else FORMAT_RAW
+
+    @property
+    def text(self):
+        if not hasattr(self, '_text'):
+            self._text = decompress(self)
+        return self._text
+
+    def get_zlib_stream(self):
+        """
+        Get the value as a zlib stream, which can be sent as-is to a client with Content-Encoding: deflate
+        """
+        if self.format == FORMAT_ZLIB:
+            return self[1:]
+        return zlib.compress(self[1:])
+
+    def get_gzip_stream(self):
+        """
+        Get the value gzipped, for clients that send Accept-Encoding: gzip.
+        A zlib stream is the same deflate data as a gzip stream with a different header and trailer,
+        so the stored data is re-wrapped rather than compressed again
+        """
+        if self.format != FORMAT_ZLIB:
+            return gzip.compress(self[1:])
+
+        data = self.text.encode('utf-8')
+
+        # Strip the 2 byte zlib header and 4 byte Adler-32 checksum, and add the gzip ones
+        return (
+            GZIP_HEADER
+            + self[3:-4]
+            + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+        )
+
+
+def compress(text):
+    """
+    Compress text into the stored format. Short values aren't worth compressing, so are stored raw
+    """
+    data = text.encode('utf-8')
+
+    if len(data) < settings.SCANNER_COMPRESS_MIN_LENGTH:
+        return CompressedData(bytes([FORMAT_RAW]) + data)
+
+    return CompressedData(bytes([FORMAT_ZLIB]) + zlib.compress(data, settings.SCANNER_COMPRESS_LEVEL))
+
+
+def decompress(data):
+    """
+    Get the text back from the stored format. Also accepts plain text and None, so callers
+    using .values() or .values_list() can pass anything through
+    """
+    if data is None or isinstance(data, str):
+        return data
+
+    data = bytes(data)
+
+    if not data:
+        return ''
+
+    if data[0] == FORMAT_ZLIB:
+        return zlib.decompress(data[1:]).decode('utf-8')
+
+    if data[0] == FORMAT_RAW:
+        return data[1:].decode('utf-8')
+
+    raise ValueError('Unknown compressed data format %d' % data[0])
+
+
+class CompressedAttribute(DeferredAttribute):
+    """
+    Returns the decompressed text for a CompressedTextField.
+    The stored value stays on the instance, so saving an unchanged value doesn't compress it again
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super(CompressedAttribute, self).__get__(instance, cls)
+        if isinstance(value, CompressedData):
+            return value.text
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field_name] = value
+
+
+class CompressedTextField(models.BinaryField):
+    """
+    Stores large text compressed.
+    Behaves like a TextField on the model, but .values() and .values_list() return the stored
+    CompressedData, which can be passed straight through to clients that accept deflate
+    """
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(CompressedTextField, self).contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.attname, CompressedAttribute(self.attname))
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return CompressedData(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, (str, CompressedData)):
+            return value
+        return CompressedData(value)
+
+    def get_prep_value(self, value):
+        if isinstance(value, str):
+            return compress(value)
+        return value
+
+    def pre_save(self, model_instance, add):
+        # Use the stored value if it's unchanged, rather than the decompressed text
+        return model_instance.__dict__.get(self.attname)
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+
+def uses_jsonb(connection):
+    """
+    Whether JSONTextFields are stored as JSONB on a connection, rather than compressed
+    """
+    return connection.vendor == 'postgresql'
+
+
+def keep_jsonb_text(sender, connection, **kwargs):
+    """
+    psycopg2 parses JSONB into Python objects by default. JSONTextFields are used as text
+    (and only parsed where they're needed), so new Postgres connections return JSONB as-is.
+    Connected to connection_created in apps.py
+    """
+    if uses_jsonb(connection):
+        from psycopg2.extras import register_default_jsonb
+        register_default_jsonb(conn_or_curs=connection.connection, loads=lambda value: value)
+
+
+class JSONTextField(CompressedTextField):
+    """
+    Stores a large JSON document.
+    On Postgres it's a JSONB column, which can be indexed (see the json_contains lookup), and
+    elsewhere it's compressed like a CompressedTextField. It behaves the same either way, with
+    .values() and .values_list() returning CompressedData
+    """
+
+    def db_type(self, connection):
+        if uses_jsonb(connection):
+            return 'jsonb'
+        return super(JSONTextField, self).db_type(connection)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None or not uses_jsonb(connection):
+            return super(JSONTextField, self).from_db_value(value, expression, connection)
+
+        # Parsed by a connection that hasn't had keep_jsonb_text run on it
+        if not isinstance(value, str):
+            value = json.dumps(value)
+
+        return CompressedData(bytes([FORMAT_RAW]) + value.encode('utf-8'))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not uses_jsonb(connection):
+            return super(JSONTextField, self).get_db_prep_value(value, connection, prepared)
+
+        # The text is sent as-is, and Postgres parses it into JSONB. It's only compressed if it's
+        # already been prepared (eg. for a lookup), or loaded and saved again unchanged
+        if isinstance(value, CompressedData):
+            return value.text
+        return value
+
+
+@JSONTextField.register_lookup
+class JSONContains(models.Lookup):
+    """
+    Whether a document contains the given value, as Postgres' @> operator (eg. a symbol table
+    contains {"methods": [{"name": "updateOwners"}]} if it declares that method).
+    Only on Postgres, where it can use the GIN index on the column. See models.iter_json_contains
+    for a query that works on any database
+    """
+    lookup_name = 'json_contains'
+    prepare_rhs = False
+
+    def get_prep_lookup(self):
+        return json.dumps(self.rhs, separators=(',', ':'))
+
+    def as_sql(self, compiler, connection):
+        raise NotSupportedError('json_contains is only supported on Postgres')
+
+    def as_postgresql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return '%s @> %s::jsonb' % (lhs, rhs), lhs_params + rhs_params
+
+
+def json_contains(document, value):
+    """
+    Whether a parsed document contains a value, with the same rules as Postgres' @> operator:
+    objects contain objects with a subset of their keys (each containing the value), arrays
+    contain arrays where every item is contained by one of their items, and anything else
+    has to be equal
+    """
+    if isinstance(value, dict):
+        return isinstance(document, dict) and all(
+            key in document and json_contains(document[key], item) for key, item in value.items()
+        )
+
+    if isinstance(value, list):
+        return isinstance(document, list) and all(
+            any(json_contains(document_item, item) for document_item in document) for item in value
+        )
+
+    return not isinstance(document, (dict, list)) and document == value
@@ -0,0 +1,189 @@
+"""
+Governs the requests a job makes to the Salesforce APIs.
+
+Every response from Salesforce carries a Sforce-Limit-Info header (eg. api-usage=18/5000)
+with the Org's daily API usage. The governor tracks that to:
+    - Check up front that the Org has enough calls left to run the scan
+    - Slow down as the Org gets close to its limit, and stop before using it all
+    - Retry idempotent requests that fail with a transient error, backing off each time
+    - Count the calls each job makes
+"""
+
+from django.conf import settings
+
+import re
+import requests
+import time
+
+
+# HTTP statuses worth retrying. Salesforce uses 503 when too many requests are running at once
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Methods that are safe to send again
+IDEMPOTENT_METHODS = ['GET', 'HEAD']
+
+# The Org's usage, eg. api-usage=18/5000; per-app-api-usage=2/250(appName=...). The per app usage is
+# only for the connected app, so isn't matched
+LIMIT_INFO_PATTERN = re.compile(r'(?<![\w-])api-usage=(\d+)/(\d+)')
+
+
+class ApiRequestError(Exception):
+    """
+    A request to Salesforce failed
+    """
+    pass
+
+
+class ApiLimitError(ApiRequestError):
+    """
+    The Org doesn't have enough API calls left to run the scan
+    """
+    pass
+
+
+def estimate_api_calls(class_count):
+    """
+    Estimate the number of API calls needed to scan an Org with the given number of classes (and triggers).
+    One call to create each ApexClassMember (or ApexTriggerMember), plus the queries and polling for the compile
+    """
+    query_pages = (class_count // 200) + 1
+    return class_count + (query_pages * 2) + 50
+
+
+class RequestGovernor(object):
+    """
+    Wraps all requests to Salesforce for a job
+    """
+
+    def __init__(self, headers):
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.calls = 0
+        self.api_usage = None
+        self.api_limit = None
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, retry=True, **kwargs):
+        """
+        Send a request, retrying idempotent requests that fail with a transient error.
+        Pass retry=False to only try once, eg. for requests made while handling a web request
+        """
+        kwargs.setdefault('timeout', settings.SALESFORCE_REQUEST_TIMEOUT)
+        attempts = settings.SALESFORCE_MAX_RETRIES + 1 if retry and method in IDEMPOTENT_METHODS else 1
+
+        for attempt in range(attempts):
+
+            self.throttle()
+
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                if attempt + 1 >= attempts:
+                    raise ApiRequestError('Could not connect to Salesforce: %s' % ex)
+                self.backoff(attempt)
+                continue
+
+            self.calls += 1
+            self.update_limits(response)
+
+            if response.status_code in RETRY_STATUSES and attempt + 1 < attempts:
+                self.backoff(attempt, response.headers.get('Retry-After'))
+                continue
+
+            if response.status_code >= 400:
+                raise ApiRequestError(self.get_error_message(response))
+
+            return response
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Wait before retrying. Honour the Retry-After header if Salesforce sends one
+        """
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = settings.SALESFORCE_RETRY_BACKOFF * (2 ** attempt)
+        time.sleep(delay)
+
+    def update_limits(self, response):
+        """
+        Read the Org's API usage from the response
+        """
+        match = LIMIT_INFO_PATTERN.search(response.headers.get('Sforce-Limit-Info', ''))
+        if match:
+            self.api_usage = int(match.group(1))
+            self.api_limit = int(match.group(2))
+
+    def get_remaining(self):
+        """
+        The number of calls the Org has left today, or None if not known yet
+        """
+        if self.api_limit is None:
+            return None
+        return self.api_limit - self.api_usage
+
+    def get_reserve(self):
+        """
+        The number of calls to always leave for the Org's own use
+        """
+        return int(self.api_limit * settings.SALESFORCE_API_RESERVE)
+
+    def throttle(self):
+        """
+        Slow down as the Org gets close to its daily limit, and stop before it runs out
+        """
+        if not self.api_limit:
+            return
+
+        if self.get_remaining() <= self.get_reserve():
+            raise ApiLimitError(
+                'Stopped scanning as the Org has used %d of its %d daily API calls.' % (self.api_usage, self.api_limit)
+            )
+
+        usage_ratio = float(self.api_usage) / self.api_limit
+        if usage_ratio > settings.SALESFORCE_API_THROTTLE_RATIO:
+            # Scale the delay up the closer the Org is to its limit
+            time.sleep(
+                settings.SALESFORCE_API_THROTTLE_DELAY
+                * (usage_ratio - settings.SALESFORCE_API_THROTTLE_RATIO)
+                / (1 - settings.SALESFORCE_API_THROTTLE_RATIO)
+            )
+
+    def check_budget(self, budget):
+        """
+        Make sure the Org has enough calls left for the job, before starting
+        """
+        remaining = self.get_remaining()
+        if remaining is not None and budget > remaining - self.get_reserve():
+            raise ApiLimitError(
+                'This scan needs around %d API calls, but the Org only has %d of its %d daily API calls left. Please try again later.' % (
+                    budget, remaining, self.api_limit
+                )
+            )
+
+    def get_error_message(self, response):
+        """
+        Build a readable error from a failed response
+        Salesforce returns a list of errors, eg. [{"errorCode": "REQUEST_LIMIT_EXCEEDED", "message": "..."}]
+        """
+        try:
+            errors = response.json()
+        except ValueError:
+            errors = None
+
+        if isinstance(errors, dict):
+            errors = [errors]
+
+        if errors:
+            return '\n'.join(
+                '%s: %s' % (error.get('errorCode', response.status_code), error.get('message', ''))
+                for error in errors
+                if isinstance(error, dict)
+            )
+
+        return 'Salesforce returned %d %s' % (response.status_code, response.reason)
@@ -0,0 +1,284 @@
+"""
+Impact analysis over the reference graph of a job.
+
+Each class, trigger, Visualforce page and Lightning component in the job is a node, numbered from 0, and each node has
+the list of nodes that use it (its dependents). Everything affected by changing a class is then
+the reverse transitive closure of the class: its dependents, their dependents and so on.
+
+Classes that use each other form a cycle (a strongly connected component), and every class in
+a cycle has the same closure. So the components are found once when the graph is built, with
+an iterative version of Tarjan's algorithm, and each closure is worked out for the component
+rather than the class. It's a breadth first search out from every class in the component at
+once, so each dependent has its shortest depth from the component, and the class it was
+reached from, to give a sample path back. Closures are kept (most recently used first) so
+repeated queries on a class, or anything in a cycle with it, are free.
+
+Graphs are built from the stored references the first time they're needed, and the most
+recently used are kept in memory.
+"""
+
+from django.conf import settings
+
+from .fields import decompress
+from . import analysis
+
+import collections
+import json
+
+
+# Loaded graphs, keyed by job id, oldest first
+_loaded_graphs = collections.OrderedDict()
+
+
+def get_components(adjacency):
+    """
+    Find the strongly connected components of a graph with Tarjan's algorithm, using an explicit
+    stack so deep graphs don't hit the recursion limit.
+    Returns the component number of each node, and the number of components
+    """
+    count = len(adjacency)
+
+    index = [-1] * count
+    low = [0] * count
+    on_stack = [False] * count
+    component = [-1] * count
+
+    stack = []
+    next_index = 0
+    component_count = 0
+
+    for root in range(count):
+
+        if index[root] != -1:
+            continue
+
+        index[root] = low[root] = next_index
+        next_index += 1
+        stack.append(root)
+        on_stack[root] = True
+
+        # Each entry is a node, and the position of the next of its edges to follow
+        work = [[root, 0]]
+
+        while work:
+            entry = work[-1]
+            node, position = entry
+            edges = adjacency[node]
+
+            if position < len(edges):
+                entry[1] += 1
+                target = edges[position]
+
+                if index[target] == -1:
+                    index[target] = low[target] = next_index
+                    next_index += 1
+                    stack.append(target)
+                    on_stack[target] = True
+                    work.append([target, 0])
+
+                elif on_stack[target] and index[target] < low[node]:
+                    low[node] = index[target]
+
+                continue
+
+            # All edges followed, so pass the low link back to the parent
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                if low[node] < low[parent]:
+                    low[parent] = low[node]
+
+            # The node is the root of a component, which is everything above it on the stack
+            if low[node] == index[node]:
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component[member] = component_count
+                    if member == node:
+                        break
+                component_count += 1
+
+    return component, component_count
+
+
+class ReferenceGraph(object):
+    """
+    The classes, triggers, pages and Lightning components in a job, and what uses each of them
+    """
+
+    def __init__(self, names, kinds, dependents):
+        self.names = names
+        self.kinds = kinds
+        self.dependents = dependents
+        self.positions = dict((name, position) for position, name in enumerate(names) if kinds[position] == 'class')
+
+        self.component, component_count = get_components(dependents)
+        self.members = [[] for _ in range(component_count)]
+        for node, component in enumerate(self.component):
+            self.members[component].append(node)
+
+        # Closures for each component, most recently used last
+        self.closures = collections.OrderedDict()
+
+    @property
+    def edge_count(self):
+        return sum(len(dependents) for dependents in self.dependents)
+
+    def get_closure(self, component):
+        """
+        Get the reverse transitive closure of a component, as a list of (depth, node) sorted by
+        depth and name, and the node each dependent was reached from
+        """
+        if component in self.closures:
+            self.closures.move_to_end(component)
+            return self.closures[component]
+
+        members = self.members[component]
+        depths = dict.fromkeys(members, 0)
+        parents = {}
+
+        frontier = members
+        depth = 0
+
+        while frontier:
+            depth += 1
+            next_frontier = []
+            for node in frontier:
+                for dependent in self.dependents[node]:
+                    if dependent not in depths:
+                        depths[dependent] = depth
+                        parents[dependent] = node
+                        next_frontier.append(dependent)
+            frontier = next_frontier
+
+        names = self.names
+        closure = (sorted(((node_depth, node) for node, node_depth in depths.items()), key=lambda item: (item[0], names[item[1]])), parents)
+
+        self.closures[component] = closure
+        while len(self.closures) > settings.SCANNER_IMPACT_CLOSURE_CACHE_SIZE:
+            self.closures.popitem(last=False)
+
+        return closure
+
+    def get_path(self, node, parents):
+        """
+        Follow the sample path from a dependent back to the component, and return it starting from the component
+        """
+        path = [node]
+        while path[-1] in parents:
+            path.append(parents[path[-1]])
+        return [self.names[step] for step in reversed(path)]
+
+    def get_impact(self, name, limit, max_depth=None):
+        """
+        Get everything that depends on a class, directly or through other classes
+        """
+        position = self.positions.get(name)
+        if position is None:
+            return None
+
+        component = self.component[position]
+        ordered, parents = self.get_closure(component)
+
+        by_depth = collections.Counter()
+        kinds = collections.Counter()
+        dependents = []
+
+        for depth, node in ordered:
+            if node == position or (max_depth is not None and depth > max_depth):
+                continue
+
+            by_depth[depth] += 1
+            kinds[self.kinds[node]] += 1
+
+            if len(dependents) < limit:
+                dependents.append({
+                    'name': self.names[node],
+                    'kind': self.kinds[node],
+                    'depth': depth,
+                    'path': self.get_path(node, parents) if depth else None,
+                })
+
+        return {
+            'name': name,
+            'cycle': sorted(self.names[member] for member in self.members[component] if member != position),
+            'count': sum(by_depth.values()),
+            'classes': kinds['class'],
+            'triggers': kinds['trigger'],
+            'visualforce': kinds['visualforce'],
+            'lightning': kinds['lightning'],
+            'byDepth': dict((str(depth), count) for depth, count in sorted(by_depth.items())),
+            'dependents': dependents,
+        }
+
+
+def build_graph(job):
+    """
+    Build the reference graph for a job from its stored references
+    """
+    names = []
+    kinds = []
+    dependents = []
+    positions = {}
+
+    def get_position(name, kind):
+        key = (name, kind)
+        if key not in positions:
+            positions[key] = len(names)
+            names.append(name)
+            kinds.append(kind)
+            dependents.append([])
+        return positions[key]
+
+    def get_caller_position(caller):
+        # Triggers, pages and Lightning components are named with their type
+        return get_position(caller, analysis.get_caller_type(caller))
+
+    string_table = analysis.StringTable(job.get_reference_strings())
+    strings = string_table.strings
+
+    class_references = job.classes().values_list('name', 'referenced_by_json').iterator(chunk_size=settings.SCANNER_QUERY_CHUNK_SIZE)
+
+    for class_name, referenced_by_json in class_references:
+
+        position = get_position(class_name, 'class')
+
+        references = json.loads(decompress(referenced_by_json)) if referenced_by_json else None
+        if not references:
+            continue
+
+        # Jobs scanned before the compact format are upgraded, adding their names to the string table
+        references = analysis.upgrade_references(references, string_table)
+
+        callers = set(get_caller_position(strings[page]) for page in references['visualforce'])
+        callers.update(get_caller_position(strings[caller]) for caller, locations in references['classes'])
+
+        for reference_type in ['methods', 'variables']:
+            for member, member_callers in references[reference_type]:
+                callers.update(get_caller_position(strings[caller]) for caller, locations in member_callers)
+
+        for member, pages in references['properties']:
+            callers.update(get_caller_position(strings[page]) for page in pages)
+
+        # A class using its own members isn't a dependency
+        callers.discard(position)
+        dependents[position] = sorted(callers)
+
+    return ReferenceGraph(names, kinds, dependents)
+
+
+def get_graph(job):
+    """
+    Load the reference graph for a finished job, building it if it isn't already in memory
+    """
+    if job.pk in _loaded_graphs:
+        _loaded_graphs.move_to_end(job.pk)
+        return _loaded_graphs[job.pk]
+
+    graph = build_graph(job)
+
+    _loaded_graphs[job.pk] = graph
+    while len(_loaded_graphs) > settings.SCANNER_GRAPH_CACHE_SIZE:
+        _loaded_graphs.popitem(last=False)
+
+    return graph
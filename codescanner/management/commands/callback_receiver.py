@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from codescanner import callbacks
+
+import json
+
+
+class Command(BaseCommand):
+
+    help = u"Run a local HTTP server that receives and verifies job completion notices, for testing callbackUrl"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+        parser.add_argument('--secret', help='The callbackSecret to verify notices with')
+        parser.add_argument('--count', type=int, default=0, help='Stop after receiving this many notices (0 = run until stopped)')
+        parser.add_argument('--status', type=int, default=200, help='Status code to respond with, to test retries')
+
+    def handle(self, *args, **options):
+
+        command = self
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+                if options['secret']:
+                    verified = callbacks.verify_signature(
+                        options['secret'],
+                        self.headers.get('X-Signature-Timestamp'),
+                        body,
+                        self.headers.get('X-Signature'),
+                    )
+                else:
+                    verified = None
+
+                command.stdout.write('%s %s (signature %s)' % (
+                    self.path,
+                    json.dumps(json.loads(body.decode('utf-8')), indent=4),
+                    {True: 'valid', False: 'INVALID', None: 'not checked'}[verified],
+                ))
+
+                # Reject notices that fail the signature check, as a real receiver should
+                status = 401 if verified is False else options['status']
+                self.send_response(status)
+                self.end_headers()
+
+                if status < 300:
+                    received.append(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', options['port']), Handler)
+        self.stdout.write('Listening on http://127.0.0.1:%d/' % options['port'])
+
+        try:
+            while not options['count'] or len(received) < options['count']:
+                server.handle_request()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -1,20 +1,43 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
 
 from datetime import timedelta
 from django.utils import timezone
 
-from codescanner.models import Job
+from codescanner.models import Job, JobSnapshot
+from codescanner import purge
 
 class Command(BaseCommand):
 
-    help = u"Clear all jobs older than 24 hours"
+    help = u"Clear all jobs older than SCANNER_JOB_LIFETIME, and expired snapshots"
 
-    def handle(self, *args, **options):
-
-        # The delete before date. 30 days from now
-        delete_date = timezone.now() - timedelta(days=1)
-
-        # Query for and delete the bookings
-        Job.objects.filter(created_date__lte=delete_date).delete()
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.SCANNER_PURGE_BATCH_SIZE,
+            help='Number of rows to delete in each statement',
+        )
 
+    def handle(self, *args, **options):
 
+        # The delete before date
+        delete_date = timezone.now() - timedelta(seconds=settings.SCANNER_JOB_LIFETIME)
+
+        # Query for and delete the jobs, and all their classes and pages, in batches
+        deleted, seconds = purge.purge(Job.objects.filter(created_date__lte=delete_date), options['batch_size'])
+        self.report(deleted, seconds)
+
+        # Snapshots of the results are kept for much longer, for comparing scans
+        deleted, seconds = purge.purge(
+            JobSnapshot.objects.filter(finished_date__lte=timezone.now() - timedelta(days=settings.SCANNER_SNAPSHOT_LIFETIME)),
+            options['batch_size']
+        )
+        self.report(deleted, seconds)
+
+    def report(self, deleted, seconds):
+        """
+        Output the number of rows deleted for each model
+        """
+        rows = ', '.join('%d %s' % (count, model_name) for model_name, count in sorted(deleted.items())) or 'nothing'
+        self.stdout.write('Deleted %s in %.2f seconds' % (rows, seconds))
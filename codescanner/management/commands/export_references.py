@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from codescanner.models import Job
+from codescanner import exports
+
+import time
+
+
+class Command(BaseCommand):
+
+    help = u"Export every reference in a finished job to a local NDJSON or CSV file, one row per use"
+
+    def add_arguments(self, parser):
+        parser.add_argument('job_id', help='The ID of the job to export')
+        parser.add_argument(
+            '--format',
+            choices=sorted(exports.CONTENT_TYPES),
+            default='ndjson',
+            help='File format to write',
+        )
+        parser.add_argument('--output', help='File to write to. Defaults to <job id>-references.<format>')
+
+    def handle(self, *args, **options):
+
+        job = Job.objects.without_results('reference_strings_json').filter(slug=options['job_id']).first()
+
+        if not job:
+            raise CommandError('Job %s does not exist' % options['job_id'])
+
+        if job.status != 'Finished':
+            raise CommandError('Job %s has not finished' % job.slug)
+
+        output = options['output'] or '%s-references.%s' % (job.slug, options['format'])
+        start = time.time()
+        size = 0
+
+        # The csv module writes its own line endings
+        with open(output, 'w', encoding='utf-8', newline='') as export_file:
+            for chunk in exports.export(job, options['format']):
+                export_file.write(chunk)
+                size += len(chunk)
+
+        self.stdout.write('Wrote %d characters to %s in %.2f seconds' % (size, output, time.time() - start))
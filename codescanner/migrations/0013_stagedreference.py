@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0012_auto_20171212_1230'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedReference',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('partition', models.PositiveIntegerField()),
+                ('ordinal', models.PositiveIntegerField()),
+                ('target', models.CharField(max_length=255)),
+                ('reference_type', models.CharField(blank=True, max_length=20, null=True)),
+                ('member', models.CharField(blank=True, max_length=255, null=True)),
+                ('caller', models.CharField(blank=True, max_length=255, null=True)),
+                ('line', models.PositiveIntegerField(blank=True, null=True)),
+                ('column', models.PositiveIntegerField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='codescanner.Job')),
+            ],
+            options={
+                'index_together': {('job', 'partition')},
+            },
+        ),
+    ]
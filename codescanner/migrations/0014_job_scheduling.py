@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0013_stagedreference'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='estimated_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='queue',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='queued_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='started_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='status',
+            field=models.CharField(choices=[('Not Started', 'Not Started'), ('Queued', 'Queued'), ('Processing', 'Processing'), ('Finished', 'Finished'), ('Error', 'Error')], default='Not Started', max_length=40),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0014_job_scheduling'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='api_calls',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0015_job_api_calls'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='coalesce_key',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='job',
+            constraint=models.UniqueConstraint(condition=models.Q(status__in=['Queued', 'Processing']), fields=('coalesce_key',), name='unique_in_flight_job'),
+        ),
+    ]
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+import codescanner.fields
+import itertools
+
+
+# (model, field, nullable) for each field moving to compressed storage
+COMPRESSED_FIELDS = [
+    ('apexclass', 'body', False),
+    ('apexclass', 'symbol_table_json', True),
+    ('apexclass', 'referenced_by_json', True),
+    ('apexpagecomponent', 'body', False),
+]
+
+
+# Rows copied in each UPDATE. Each row holds a whole class body or SymbolTable, so the batches are
+# kept small enough to hold in memory
+BATCH_SIZE = 200
+
+
+def copy_column(model, source, target):
+    """
+    Copy the text from one column into another, a batch of rows at a time. The new columns start
+    empty, so only rows with a value are copied
+    """
+    rows = model.objects.filter(**{source + '__isnull': False}).values_list('id', source).iterator(chunk_size=BATCH_SIZE)
+
+    while True:
+        batch = [model(pk=pk, **{target: codescanner.fields.decompress(data)}) for pk, data in itertools.islice(rows, BATCH_SIZE)]
+        if not batch:
+            break
+        model.objects.bulk_update(batch, [target])
+
+
+def compress_fields(apps, schema_editor):
+    """
+    Copy the text from each old column into its compressed column
+    """
+    for model_name, field_name, nullable in COMPRESSED_FIELDS:
+        copy_column(apps.get_model('codescanner', model_name), field_name + '_text', field_name)
+
+
+def decompress_fields(apps, schema_editor):
+    """
+    Copy the text back out of the compressed columns
+    """
+    for model_name, field_name, nullable in COMPRESSED_FIELDS:
+        copy_column(apps.get_model('codescanner', model_name), field_name, field_name + '_text')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0016_job_coalesce_key'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='apexclass',
+            old_name='body',
+            new_name='body_text',
+        ),
+        migrations.AddField(
+            model_name='apexclass',
+            name='body',
+            field=codescanner.fields.CompressedTextField(blank=True, null=True),
+        ),
+        migrations.RenameField(
+            model_name='apexclass',
+            old_name='symbol_table_json',
+            new_name='symbol_table_json_text',
+        ),
+        migrations.AddField(
+            model_name='apexclass',
+            name='symbol_table_json',
+            field=codescanner.fields.CompressedTextField(blank=True, null=True),
+        ),
+        migrations.RenameField(
+            model_name='apexclass',
+            old_name='referenced_by_json',
+            new_name='referenced_by_json_text',
+        ),
+        migrations.AddField(
+            model_name='apexclass',
+            name='referenced_by_json',
+            field=codescanner.fields.CompressedTextField(blank=True, null=True),
+        ),
+        migrations.RenameField(
+            model_name='apexpagecomponent',
+            old_name='body',
+            new_name='body_text',
+        ),
+        migrations.AddField(
+            model_name='apexpagecomponent',
+            name='body',
+            field=codescanner.fields.CompressedTextField(blank=True, null=True),
+        ),
+        # The old columns are made nullable, so they can be re-added if the migration is reversed
+        migrations.AlterField(
+            model_name='apexclass',
+            name='body_text',
+            field=models.TextField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='apexpagecomponent',
+            name='body_text',
+            field=models.TextField(null=True),
+        ),
+        migrations.RunPython(compress_fields, decompress_fields),
+        migrations.RemoveField(
+            model_name='apexclass',
+            name='body_text',
+        ),
+        migrations.AlterField(
+            model_name='apexclass',
+            name='body',
+            field=codescanner.fields.CompressedTextField(),
+        ),
+        migrations.RemoveField(
+            model_name='apexclass',
+            name='symbol_table_json_text',
+        ),
+        migrations.RemoveField(
+            model_name='apexclass',
+            name='referenced_by_json_text',
+        ),
+        migrations.RemoveField(
+            model_name='apexpagecomponent',
+            name='body_text',
+        ),
+        migrations.AlterField(
+            model_name='apexpagecomponent',
+            name='body',
+            field=codescanner.fields.CompressedTextField(),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:28
+
+from django.db import migrations, models
+
+import codescanner.fields
+
+import json
+
+
+REFERENCE_TYPES = ['visualforce', 'classes', 'methods', 'variables', 'properties']
+
+
+def count_references(apps, schema_editor):
+    """
+    Fill in the counts for existing classes. Both the original and compact reference
+    formats have one entry per page, caller or member of each type
+    """
+    ApexClass = apps.get_model('codescanner', 'ApexClass')
+    rows = ApexClass.objects.filter(referenced_by_json__isnull=False).values_list('id', 'referenced_by_json').iterator()
+    for pk, data in rows:
+        references = json.loads(codescanner.fields.decompress(data))
+        ApexClass.objects.filter(pk=pk).update(**dict(
+            ('%s_count' % reference_type, len(references.get(reference_type) or []))
+            for reference_type in REFERENCE_TYPES
+        ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0018_job_reference_strings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apexclass',
+            name='classes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='apexclass',
+            name='methods_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='apexclass',
+            name='properties_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='apexclass',
+            name='variables_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='apexclass',
+            name='visualforce_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0019_apexclass_reference_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apexclass',
+            name='line_offsets',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
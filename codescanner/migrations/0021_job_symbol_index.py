@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:33
+
+import codescanner.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0020_apexclass_line_offsets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='symbol_index_json',
+            field=codescanner.fields.CompressedTextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:34
+
+import codescanner.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0021_job_symbol_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_slug', models.SlugField()),
+                ('coalesce_key', models.CharField(db_index=True, max_length=255)),
+                ('org_id', models.CharField(max_length=18)),
+                ('username', models.CharField(blank=True, max_length=120, null=True)),
+                ('finished_date', models.DateTimeField()),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('class_count', models.PositiveIntegerField(default=0)),
+                ('member_count', models.PositiveIntegerField(default=0)),
+                ('unreferenced_count', models.PositiveIntegerField(default=0)),
+                ('fingerprint_json', codescanner.fields.CompressedTextField()),
+                ('job', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='snapshot', to='codescanner.Job')),
+            ],
+            options={
+                'ordering': ['-finished_date'],
+            },
+        ),
+    ]
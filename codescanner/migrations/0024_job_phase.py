@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0023_jobcallback'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='phase',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='progress',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
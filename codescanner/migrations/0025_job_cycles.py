@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:53
+
+import codescanner.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0024_job_phase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='cycles_json',
+            field=codescanner.fields.CompressedTextField(blank=True, null=True),
+        ),
+    ]
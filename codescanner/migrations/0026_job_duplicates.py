@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:54
+
+import codescanner.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0025_job_cycles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='duplicates_json',
+            field=codescanner.fields.CompressedTextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-19 08:01
+
+import codescanner.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0026_job_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apexpagecomponent',
+            name='is_referenced_externally',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='apexpagecomponent',
+            name='referenced_by_json',
+            field=codescanner.fields.CompressedTextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-19 08:04
+
+import codescanner.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0027_apexpagecomponent_usage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApexTrigger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigger_id', models.CharField(max_length=18)),
+                ('trigger_member_id', models.CharField(blank=True, max_length=18, null=True)),
+                ('name', models.CharField(max_length=120)),
+                ('object_name', models.CharField(blank=True, max_length=120, null=True)),
+                ('body', codescanner.fields.CompressedTextField()),
+                ('line_offsets', models.BinaryField(blank=True, null=True)),
+                ('symbol_table_json', codescanner.fields.CompressedTextField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='codescanner.Job')),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+    ]
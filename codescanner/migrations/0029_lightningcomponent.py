@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-19 08:07
+
+import codescanner.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0028_apextrigger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LightningComponent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bundle_id', models.CharField(max_length=18)),
+                ('name', models.CharField(max_length=255)),
+                ('type', models.CharField(choices=[('Aura', 'Aura'), ('LWC', 'LWC')], max_length=10)),
+                ('controller', models.CharField(blank=True, max_length=120, null=True)),
+                ('apex_methods_json', codescanner.fields.CompressedTextField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='codescanner.Job')),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+    ]
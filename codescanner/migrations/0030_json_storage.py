@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+import codescanner.fields
+import itertools
+
+
+# (model, field) for each field moving to JSON storage
+JSON_FIELDS = [
+    ('apexclass', 'symbol_table_json'),
+    ('apexclass', 'referenced_by_json'),
+    ('apextrigger', 'symbol_table_json'),
+]
+
+
+# Rows copied in each UPDATE. Each row holds a whole SymbolTable or set of references, so the
+# batches are kept small enough to hold in memory
+BATCH_SIZE = 200
+
+
+def get_index_name(model_name, field_name):
+    return 'codescanner_%s_%s_gin' % (model_name, field_name)
+
+
+def copy_column(model, source, target):
+    """
+    Copy the text from one column into another, a batch of rows at a time
+    """
+    rows = model.objects.filter(**{source + '__isnull': False}).values_list('id', source).iterator(chunk_size=BATCH_SIZE)
+
+    while True:
+        batch = [model(pk=pk, **{target: codescanner.fields.decompress(data)}) for pk, data in itertools.islice(rows, BATCH_SIZE)]
+        if not batch:
+            break
+        model.objects.bulk_update(batch, [target])
+
+
+def copy_fields(apps, schema_editor):
+    """
+    Copy the text from each old compressed column into its JSON column
+    """
+    for model_name, field_name in JSON_FIELDS:
+        copy_column(apps.get_model('codescanner', model_name), field_name + '_data', field_name)
+
+
+def copy_fields_back(apps, schema_editor):
+    """
+    Copy the text back out of the JSON columns
+    """
+    for model_name, field_name in JSON_FIELDS:
+        copy_column(apps.get_model('codescanner', model_name), field_name, field_name + '_data')
+
+
+def create_indexes(apps, schema_editor):
+    """
+    Index the JSONB columns on Postgres. jsonb_path_ops indexes are smaller and faster than the
+    default, and only support @>, which is all json_contains uses
+    """
+    if not codescanner.fields.uses_jsonb(schema_editor.connection):
+        return
+
+    for model_name, field_name in JSON_FIELDS:
+        schema_editor.execute('CREATE INDEX %s ON %s USING gin (%s jsonb_path_ops)' % (
+            schema_editor.quote_name(get_index_name(model_name, field_name)),
+            schema_editor.quote_name(apps.get_model('codescanner', model_name)._meta.db_table),
+            schema_editor.quote_name(field_name),
+        ))
+
+
+def drop_indexes(apps, schema_editor):
+    if not codescanner.fields.uses_jsonb(schema_editor.connection):
+        return
+
+    for model_name, field_name in JSON_FIELDS:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % schema_editor.quote_name(get_index_name(model_name, field_name)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0029_lightningcomponent'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='apexclass',
+            old_name='symbol_table_json',
+            new_name='symbol_table_json_data',
+        ),
+        migrations.AddField(
+            model_name='apexclass',
+            name='symbol_table_json',
+            field=codescanner.fields.JSONTextField(blank=True, null=True),
+        ),
+        migrations.RenameField(
+            model_name='apexclass',
+            old_name='referenced_by_json',
+            new_name='referenced_by_json_data',
+        ),
+        migrations.AddField(
+            model_name='apexclass',
+            name='referenced_by_json',
+            field=codescanner.fields.JSONTextField(blank=True, null=True),
+        ),
+        migrations.RenameField(
+            model_name='apextrigger',
+            old_name='symbol_table_json',
+            new_name='symbol_table_json_data',
+        ),
+        migrations.AddField(
+            model_name='apextrigger',
+            name='symbol_table_json',
+            field=codescanner.fields.JSONTextField(blank=True, null=True),
+        ),
+        migrations.RunPython(copy_fields, copy_fields_back),
+        migrations.RemoveField(
+            model_name='apexclass',
+            name='symbol_table_json_data',
+        ),
+        migrations.RemoveField(
+            model_name='apexclass',
+            name='referenced_by_json_data',
+        ),
+        migrations.RemoveField(
+            model_name='apextrigger',
+            name='symbol_table_json_data',
+        ),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
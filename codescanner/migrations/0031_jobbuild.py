@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-19 08:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0030_json_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobBuild',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('result', models.CharField(max_length=40)),
+                ('requested_date', models.DateTimeField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='codescanner.Job')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='jobbuild',
+            constraint=models.UniqueConstraint(fields=('job', 'result'), name='unique_job_build'),
+        ),
+    ]
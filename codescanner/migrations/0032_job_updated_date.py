@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-19 08:40
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def set_updated_dates(apps, schema_editor):
+    """
+    Existing jobs were last updated no earlier than when they started (or were created)
+    """
+    Job = apps.get_model('codescanner', 'Job')
+    Job.objects.update(updated_date=Coalesce('started_date', 'created_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0031_jobbuild'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='updated_date',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+        migrations.RunPython(set_updated_dates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-19 08:42
+
+from django.db import migrations, models
+
+
+def set_attempted_dates(apps, schema_editor):
+    """
+    Callbacks already being sent were claimed no earlier than they were created
+    """
+    JobCallback = apps.get_model('codescanner', 'JobCallback')
+    JobCallback.objects.filter(status='Sending').update(attempted_date=models.F('created_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codescanner', '0032_job_updated_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobcallback',
+            name='attempted_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_attempted_dates, migrations.RunPython.noop),
+    ]
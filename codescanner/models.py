@@ -1,11 +1,70 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.urls import reverse
-from django.db import models
+from django.utils import timezone
+from django.db import connections, models
 
+from .fields import CompressedTextField, JSONTextField, decompress, json_contains, uses_jsonb
+
+from datetime import timedelta
+
+import json
 import uuid
 
+
+def iter_chunked(queryset, fields=None, chunk_size=None):
+    """
+    Iterate over a queryset without caching the results, fetching chunk_size rows at a time
+    """
+    if fields:
+        queryset = queryset.only(*fields)
+    return queryset.iterator(chunk_size=chunk_size or settings.SCANNER_QUERY_CHUNK_SIZE)
+
+
+def iter_json_contains(queryset, field, values, fields):
+    """
+    Iterate over the rows of a queryset where a JSONTextField contains any of the values (see
+    fields.JSONContains), as values_list() tuples of the fields.
+    On Postgres this runs in the database against the GIN index on the field. Elsewhere each
+    document is loaded with the fields and checked, a chunk of rows at a time, and the matching
+    rows are returned as they're found
+    """
+    chunk_size = settings.SCANNER_QUERY_CHUNK_SIZE
+
+    if uses_jsonb(connections[queryset.db]):
+        condition = models.Q()
+        for value in values:
+            condition |= models.Q(**{'%s__json_contains' % field: value})
+        yield from queryset.filter(condition).values_list(*fields).iterator(chunk_size=chunk_size)
+        return
+
+    rows = queryset.filter(**{'%s__isnull' % field: False}).values_list(field, *fields)
+
+    for row in rows.iterator(chunk_size=chunk_size):
+        document = json.loads(decompress(row[0]))
+        if any(json_contains(document, value) for value in values):
+            yield row[1:]
+
+
+# Statuses where a job is still to finish. Only one job per Org can be in one of these at a time
+IN_FLIGHT_STATUSES = ['Queued', 'Processing']
+
+# The results stored against each job, which can run to megabytes for big Orgs
+RESULT_FIELDS = ['reference_strings_json', 'symbol_index_json', 'cycles_json', 'duplicates_json']
+
+
+class JobQuerySet(models.QuerySet):
+
+    def without_results(self, *fields):
+        """
+        Defer loading the results stored against each job, apart from any of them in fields.
+        Each is loaded on its own if it's used anyway
+        """
+        return self.defer(*[field for field in RESULT_FIELDS if field not in fields])
+
+
 class Job(models.Model):
     """
     Holds the details about the job run
@@ -27,6 +86,7 @@ class Job(models.Model):
 
     STATUS_CHOICES = (
         ('Not Started', 'Not Started'),
+        ('Queued', 'Queued'),
         ('Processing', 'Processing'),
         ('Finished', 'Finished'),
         ('Error', 'Error'),
@@ -36,12 +96,97 @@ class Job(models.Model):
     error = models.TextField(blank=True, null=True)
     stack_trace = models.TextField(blank=True, null=True)
 
+    # Scheduling details. The size is the number of classes in the Org, used to pick the queue
+    estimated_size = models.PositiveIntegerField(blank=True, null=True)
+    queue = models.CharField(max_length=40, blank=True, null=True)
+    queued_date = models.DateTimeField(blank=True, null=True)
+    started_date = models.DateTimeField(blank=True, null=True)
+
+    # When the job was last saved, dispatched or moved on a phase. A running job that hasn't been
+    # updated in a long time is assumed to have had its worker die (see scheduler.get_stale_cutoff)
+    updated_date = models.DateTimeField(auto_now=True, blank=True, null=True)
+
+    # Number of Salesforce API calls made while running the job
+    api_calls = models.PositiveIntegerField(default=0)
+
+    # What the job is doing, and roughly how far through it is (0-100), for status checks
+    phase = models.CharField(max_length=40, blank=True, null=True)
+    progress = models.PositiveSmallIntegerField(default=0)
+
+    # Identifies the Org being scanned, so duplicate requests for the same Org can share a job
+    coalesce_key = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+
+    # JSON list of the class, page and member names used in the references for the job.
+    # Each class's referenced_by_json refers to names by their position in this list
+    reference_strings_json = CompressedTextField(blank=True, null=True)
+
+    # The symbol search index for the job (see symbols.py)
+    symbol_index_json = CompressedTextField(blank=True, null=True)
+
+    # The dependency cycles between the classes and members in the job (see cycles.py)
+    cycles_json = CompressedTextField(blank=True, null=True)
+
+    # The near duplicate classes in the job (see duplicates.py)
+    duplicates_json = CompressedTextField(blank=True, null=True)
+
+    IN_FLIGHT_STATUSES = IN_FLIGHT_STATUSES
+    RESULT_FIELDS = RESULT_FIELDS
+
+    objects = JobQuerySet.as_manager()
+
+    # The fields returned by status checks, which are queried on their own to keep polling cheap
+    STATUS_FIELDS = ['slug', 'status', 'phase', 'progress', 'error', 'api_calls']
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['coalesce_key'],
+                condition=models.Q(status__in=IN_FLIGHT_STATUSES),
+                name='unique_in_flight_job',
+            ),
+        ]
+
     def classes(self):
         return self.apexclass_set.all().order_by('name')
 
     def visualforce(self):
         return self.apexpagecomponent_set.all().order_by('name')
 
+    def triggers(self):
+        return self.apextrigger_set.all().order_by('name')
+
+    def lightning(self):
+        return self.lightningcomponent_set.all().order_by('name', 'type')
+
+    def iter_classes(self, *fields, **kwargs):
+        """
+        Iterate over the classes in chunks, only loading the given fields.
+        Keeps memory flat for big jobs, where the class bodies alone can be hundreds of MB
+        """
+        return iter_chunked(self.classes(), fields, **kwargs)
+
+    def iter_visualforce(self, *fields, **kwargs):
+        """
+        Iterate over the pages and components in chunks, only loading the given fields
+        """
+        return iter_chunked(self.visualforce(), fields, **kwargs)
+
+    def get_reference_strings(self):
+        """
+        Get the string table for the references. Empty for jobs run before it existed
+        """
+        return json.loads(self.reference_strings_json) if self.reference_strings_json else []
+
+    def set_phase(self, phase, progress, **fields):
+        """
+        Record what the job is doing, along with any other fields given.
+        Written straight to the row, so it's cheap to call while the job is running
+        """
+        fields.update(phase=phase, progress=progress, updated_date=timezone.now())
+        for name, value in fields.items():
+            setattr(self, name, value)
+        Job.objects.filter(pk=self.pk).update(**fields)
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = uuid.uuid4()
@@ -51,28 +196,73 @@ class Job(models.Model):
     def get_absolute_url(self):
         return reverse('job', kwargs={'slug': self.slug})
 
+    def get_expiry_date(self):
+        """
+        When the job will be deleted by clear_jobs
+        """
+        return self.created_date + timedelta(seconds=settings.SCANNER_JOB_LIFETIME)
+
 
 class ApexClass(models.Model):
     """
     Holds all details about an ApexClass
     """
 
-    job = models.ForeignKey(
-    'Categorie',
-    on_delete=models.CASCADE,
-)
+    job = models.ForeignKey('Job', on_delete=models.CASCADE)
 
     class_id = models.CharField(max_length=18)
     class_member_id = models.CharField(max_length=18, blank=True, null=True)
     name = models.CharField(max_length=120)
-    body = models.TextField()
+    body = CompressedTextField()
+
+    # The position each line of the body starts at, packed as 4 byte ints (see snippets.py)
+    line_offsets = models.BinaryField(blank=True, null=True)
 
-    symbol_table_json = models.TextField(blank=True, null=True)
+    # JSONB on Postgres, so the symbol tables and references can be queried in the database
+    symbol_table_json = JSONTextField(blank=True, null=True)
 
     is_referenced_externally = models.BooleanField(default=False)
 
     # Holds a JSON structure of all the external classes that call this class
-    referenced_by_json = models.TextField(blank=True, null=True)
+    referenced_by_json = JSONTextField(blank=True, null=True)
+
+    # The number of pages, callers and members of each type in referenced_by_json.
+    # Used to summarise the results without loading the references for every class.
+    # Lightning bundles are stored with the pages, so are counted in visualforce_count
+    visualforce_count = models.PositiveIntegerField(default=0)
+    classes_count = models.PositiveIntegerField(default=0)
+    methods_count = models.PositiveIntegerField(default=0)
+    variables_count = models.PositiveIntegerField(default=0)
+    properties_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['name']
+
+    def __unicode__(self):
+        return self.name
+
+
+class ApexTrigger(models.Model):
+    """
+    Holds the details about an ApexTrigger. Nothing calls a trigger, but the classes a trigger
+    calls are referenced by it, the same as if they were called from a class
+    """
+
+    job = models.ForeignKey('Job', on_delete=models.CASCADE)
+
+    trigger_id = models.CharField(max_length=18)
+    trigger_member_id = models.CharField(max_length=18, blank=True, null=True)
+    name = models.CharField(max_length=120)
+
+    # The object the trigger is on, eg. Account
+    object_name = models.CharField(max_length=120, blank=True, null=True)
+
+    body = CompressedTextField()
+
+    # The position each line of the body starts at, packed as 4 byte ints (see snippets.py)
+    line_offsets = models.BinaryField(blank=True, null=True)
+
+    symbol_table_json = JSONTextField(blank=True, null=True)
 
     class Meta:
         ordering = ['name']
@@ -86,15 +276,12 @@ class ApexPageComponent(models.Model):
     Hold details about an ApexPage
     """
 
-    job = models.ForeignKey(
-    'Categorie',
-    on_delete=models.CASCADE,
-)
+    job = models.ForeignKey('Job', on_delete=models.CASCADE)
 
     sf_id = models.CharField(max_length=18)
     name = models.CharField(max_length=120)
     controller = models.CharField(max_length=120, blank=True, null=True)
-    body = models.TextField()
+    body = CompressedTextField()
 
     TYPE_CHOICES = (
         ('Page', 'Page'),
@@ -103,9 +290,153 @@ class ApexPageComponent(models.Model):
 
     type = models.CharField(max_length=10, default='Page')
 
+    # Whether any other page, component or class uses this one (see usage.py)
+    is_referenced_externally = models.BooleanField(default=False)
+
+    # Holds a JSON structure of the pages, components and classes that use this one.
+    # Null until the usage has been indexed, which is done at the end of the scan
+    referenced_by_json = CompressedTextField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __unicode__(self):
+        return self.name
+
+
+
+class LightningComponent(models.Model):
+    """
+    An Aura or LWC bundle. Only the Apex the bundle uses is kept, not its source
+    """
+
+    job = models.ForeignKey('Job', on_delete=models.CASCADE)
+
+    bundle_id = models.CharField(max_length=18)
+    name = models.CharField(max_length=255)
+
+    TYPE_CHOICES = (
+        ('Aura', 'Aura'),
+        ('LWC', 'LWC'),
+    )
+
+    type = models.CharField(max_length=10, choices=TYPE_CHOICES)
+
+    # The Apex controller of an Aura component
+    controller = models.CharField(max_length=120, blank=True, null=True)
+
+    # JSON list of the [class, method] used by the bundle. The method is null for the controller itself
+    apex_methods_json = CompressedTextField(blank=True, null=True)
+
     class Meta:
         ordering = ['name']
 
     def __unicode__(self):
         return self.name
 
+
+
+class StagedReference(models.Model):
+    """
+    A single reference emitted by a mapper task when building references across workers.
+    These only live for the duration of the job, and are cleared once each class
+    has had its referenced_by_json built
+    """
+
+    job = models.ForeignKey('Job', on_delete=models.CASCADE)
+
+    # The reducer partition that owns the target class
+    partition = models.PositiveIntegerField()
+
+    # The position of the calling class in the job, so references are reduced in the same order as a local scan
+    ordinal = models.PositiveIntegerField()
+
+    target = models.CharField(max_length=255)
+    reference_type = models.CharField(max_length=20, blank=True, null=True)
+    member = models.CharField(max_length=255, blank=True, null=True)
+    caller = models.CharField(max_length=255, blank=True, null=True)
+    line = models.PositiveIntegerField(blank=True, null=True)
+    column = models.PositiveIntegerField(blank=True, null=True)
+
+    class Meta:
+        index_together = [
+            ('job', 'partition'),
+        ]
+
+
+class JobBuild(models.Model):
+    """
+    A missing result of a finished job queued to be built on a worker (see backfill.py).
+    Claimed in the database, so every web process shares it and a result is only queued once at a time
+    """
+
+    job = models.ForeignKey('Job', on_delete=models.CASCADE)
+    result = models.CharField(max_length=40)
+    requested_date = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'result'], name='unique_job_build'),
+        ]
+
+
+class JobSnapshot(models.Model):
+    """
+    A compact fingerprint of the results of a finished job (see snapshots.py).
+    Kept after the job itself is cleared, so later scans of the same Org can be compared against it
+    """
+
+    job = models.OneToOneField('Job', blank=True, null=True, on_delete=models.SET_NULL, related_name='snapshot')
+
+    # Details of the job, as the job may be gone
+    job_slug = models.SlugField(db_index=True)
+    coalesce_key = models.CharField(max_length=255, db_index=True)
+    org_id = models.CharField(max_length=18)
+    username = models.CharField(max_length=120, blank=True, null=True)
+    finished_date = models.DateTimeField()
+
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    class_count = models.PositiveIntegerField(default=0)
+    member_count = models.PositiveIntegerField(default=0)
+    unreferenced_count = models.PositiveIntegerField(default=0)
+
+    # Sorted JSON list of [symbol hash, kind, name, callers] for every class, method and property in the job
+    fingerprint_json = CompressedTextField()
+
+    class Meta:
+        ordering = ['-finished_date']
+
+    def __unicode__(self):
+        return self.job_slug
+
+
+class JobCallback(models.Model):
+    """
+    A URL to notify when a job finishes, given when the job was started through the API (see callbacks.py)
+    """
+
+    job = models.ForeignKey('Job', on_delete=models.CASCADE)
+
+    url = models.URLField(max_length=1000)
+
+    # Used to sign each notice, so the receiver can verify it
+    secret = models.CharField(max_length=255)
+
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    STATUS_CHOICES = (
+        ('Pending', 'Pending'),
+        ('Sending', 'Sending'),
+        ('Delivered', 'Delivered'),
+        ('Failed', 'Failed'),
+    )
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='Pending')
+    attempts = models.PositiveIntegerField(default=0)
+
+    # When the callback was last claimed or attempted, to find callbacks whose worker died (see callbacks.py)
+    attempted_date = models.DateTimeField(blank=True, null=True)
+
+    delivered_date = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, null=True)
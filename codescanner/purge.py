@@ -0,0 +1,77 @@
+"""
+Bulk deletion of expired jobs.
+
+Deleting jobs through the ORM makes Django collect every related class and page into memory
+before deleting them. For a busy day that's millions of rows, holding locks the whole time.
+Instead, the rows that depend on each batch of jobs are deleted first, a bounded batch of ids
+at a time with a single DELETE each, and then the jobs themselves. Model instances are never
+loaded, and each batch commits on its own so scans writing at the same time aren't held up.
+"""
+
+from django.db import models
+
+import collections
+import time
+
+
+def get_batches(queryset, batch_size):
+    """
+    Yield lists of up to batch_size primary keys from the queryset, until it's empty.
+    The query is re-run each time, as the previous batch has been deleted. It's unordered, as the
+    classes, pages and triggers are ordered by name, which would sort every remaining row each time
+    """
+    while True:
+        ids = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids
+
+
+def purge_dependents(model, ids, batch_size, deleted):
+    """
+    Delete (or detach) everything that refers to the given rows of a model
+    """
+    for relation in model._meta.related_objects:
+
+        related_model = relation.related_model
+        related_rows = related_model._base_manager.filter(**{'%s__in' % relation.field.name: ids})
+
+        if relation.on_delete == models.SET_NULL:
+            related_rows.update(**{relation.field.name: None})
+
+        elif relation.on_delete == models.CASCADE:
+            purge_rows(related_rows, batch_size, deleted)
+
+        else:
+            raise ValueError('Cannot purge %s, as it is referenced by %s' % (model.__name__, related_model.__name__))
+
+
+def purge_rows(queryset, batch_size, deleted=None):
+    """
+    Delete the rows in a queryset in batches, along with everything that depends on them.
+    Returns a Counter of the rows deleted for each model
+    """
+    if deleted is None:
+        deleted = collections.Counter()
+
+    model = queryset.model
+
+    for ids in get_batches(queryset, batch_size):
+        purge_dependents(model, ids, batch_size, deleted)
+
+        # A single DELETE ... WHERE id IN (...), without collecting the rows first. QuerySet.delete()
+        # would load every row to send delete signals and cascade, and _raw_delete is what Django
+        # uses itself when there's neither. Every relation has just been purged above (or this
+        # raised), and nothing in the app listens for delete signals
+        deleted[model.__name__] += model._base_manager.filter(pk__in=ids)._raw_delete(queryset.db)
+
+    return deleted
+
+
+def purge(queryset, batch_size):
+    """
+    Purge the rows in a queryset. Returns a Counter of the rows deleted for each model, and the seconds taken
+    """
+    start = time.time()
+    deleted = purge_rows(queryset, batch_size)
+    return deleted, time.time() - start
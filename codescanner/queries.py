@@ -0,0 +1,62 @@
+"""
+Questions about the classes in a job, answered from their symbol tables and references.
+
+On Postgres the symbol tables and references are stored as JSONB with GIN indexes (see
+fields.JSONTextField), so each question is a containment query run in the database, eg.
+
+    - a class declares a method if its symbol table contains {"methods": [{"name": "save"}]}
+    - a class is used by a caller if its references contain {"classes": [[caller]]}, where
+      caller is the position of the caller's name in the job's string table
+
+Elsewhere each document is loaded and checked in Python instead (see models.iter_json_contains).
+Names are matched as they're declared, as the symbol tables hold them
+"""
+
+from .models import iter_json_contains
+
+
+# The symbol table list each kind of declaration is in
+DECLARATION_KINDS = {
+    'method': 'methods',
+    'property': 'properties',
+    'variable': 'variables',
+    'constructor': 'constructors',
+}
+
+
+def get_declaring_classes(job, name, kind='method', fields=('name',)):
+    """
+    Get the fields of the classes in a job that declare a method (or property, variable or
+    constructor) with the name, either in the class itself or one of its inner classes
+    """
+    declaration = {DECLARATION_KINDS[kind]: [{'name': name}]}
+
+    return iter_json_contains(job.classes(), 'symbol_table_json', [declaration, {'innerClasses': [declaration]}], fields)
+
+
+def get_used_classes(job, caller, fields=('name',)):
+    """
+    Get the fields of the classes in a job that a class, trigger, page or Lightning component uses, from their
+    compact references. The caller is matched by name regardless of case, and triggers, pages and
+    Lightning components are named with their type, eg. "AccountPage (Page)"
+    """
+    caller = caller.lower()
+    positions = [position for position, string in enumerate(job.get_reference_strings()) if string.lower() == caller]
+
+    if not positions:
+        return []
+
+    values = []
+    for position in positions:
+        values.extend([
+            {'visualforce': [position]},
+            # [caller, lines]
+            {'classes': [[position]]},
+            # [member, [[caller, lines], ...]]
+            {'methods': [[[[position]]]]},
+            {'variables': [[[[position]]]]},
+            # [member, [page, ...]]
+            {'properties': [[[position]]]},
+        ])
+
+    return iter_json_contains(job.classes(), 'referenced_by_json', values, fields)
@@ -1,12 +1,21 @@
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 
-from .models import Job, ApexClass, ApexPageComponent
-
-from bs4 import BeautifulSoup
-
+from .fields import decompress
+from .models import Job, ApexClass, ApexPageComponent, ApexTrigger, LightningComponent, iter_chunked
+from . import analysis
+from . import cycles
+from . import duplicates
+from . import executor
+from . import governor
+from . import snippets
+from . import snapshots
+from . import symbols
+from . import usage
+
+import itertools
 import uuid
-import requests
 import time
 import json
 
@@ -33,57 +42,86 @@ class ScanJob(object):
         }
         self.tooling_url = '%s%s' % (self.job.instance_url, settings.SALESFORCE_TOOLING_URL)
 
+        # All requests go through the governor, which keeps the job within the Org's API limits
+        self.governor = governor.RequestGovernor(self.headers)
+        self.starting_api_calls = self.job.api_calls or 0
 
-    def get_all_records(self, object_name):
+
+    def record_api_calls(self, job=None):
         """
-        Queries for all records specified by the object_name
+        Set the number of API calls made for the job, ready to be saved
         """
-        records = []
+        (job or self.job).api_calls = self.starting_api_calls + self.governor.calls
 
-        url = '%squery/?q=SELECT+Id,Name,%s+FROM+%s+WHERE+NamespacePrefix=NULL' % (
-            self.tooling_url, ('Body' if object_name == 'ApexClass' else 'Markup,ControllerKey,ControllerType'), object_name
-        )
 
-        result = requests.get(url, headers=self.headers)
-        records.extend(result.json().get('records'))
+    def query_pages(self, query, api_version=None):
+        """
+        Run a Tooling API query, yielding each page of records as it's returned
+        So callers can process big results without holding them all in memory.
+        Pass api_version to query a newer version of the API than the rest of the scan uses
+        """
+        tooling_url = self.tooling_url
+        if api_version and api_version > settings.SALESFORCE_API_VERSION:
+            tooling_url = '%s/services/data/v%d.0/tooling/' % (self.job.instance_url, api_version)
 
-        # If there are more classes, we need to keep calling for more.
-        while 'nextRecordsUrl' in result.json():
-            result = requests.get(self.job.instance_url + result.json().get('nextRecordsUrl'), headers=self.headers)
-            records.extend(result.json().get('records'))
-        return records
+        result = self.governor.get('%squery/?q=%s' % (tooling_url, query)).json()
+        yield result.get('records')
 
-    def get_extensions_from_body(self, body):
+        # If there are more records, we need to keep calling for more.
+        while 'nextRecordsUrl' in result:
+            result = self.governor.get(self.job.instance_url + result.get('nextRecordsUrl')).json()
+            yield result.get('records')
+
+
+    def query(self, query):
         """
-        Retrieve the extensions for a VisualForce page body
+        Run a Tooling API query, and return all the records
         """
+        records = []
+        for page in self.query_pages(query):
+            records.extend(page)
+        return records
 
-        extensions_list = []
 
-        # Load a soup object for the VF page
-        # BeautifulSoup is an HTML parser
-        # VF is pretty close to HTML, so going to leverage
-        # that library to find any controllers or extensions for the VF
-        soup = BeautifulSoup(body, 'html.parser')
+    # The fields queried for each type of record, besides the Id and Name
+    RECORD_FIELDS = {
+        'ApexClass': 'Body',
+        'ApexTrigger': 'Body,TableEnumOrId',
+        'ApexPage': 'Markup,ControllerKey,ControllerType',
+        'ApexComponent': 'Markup,ControllerKey,ControllerType',
+    }
 
-        # Load the apex:page attribute
-        page_attribute = soup.findAll({'apex:page'})
+    def get_record_pages(self, object_name):
+        """
+        Queries for all records specified by the object_name, yielding a page at a time
+        """
+        return self.query_pages('SELECT+Id,Name,%s+FROM+%s+WHERE+NamespacePrefix=NULL' % (
+            self.RECORD_FIELDS[object_name], object_name
+        ))
 
-        if page_attribute:
 
-            page_attribute = page_attribute[0]
+    def get_all_records(self, object_name):
+        """
+        Queries for all records specified by the object_name
+        """
+        records = []
+        for page in self.get_record_pages(object_name):
+            records.extend(page)
+        return records
 
-            # Load the extensions from the attribute
-            extensions = page_attribute.get('extensions','').strip()
+    def get_class_count(self, object_name='ApexClass', timeout=10, retry=True):
+        """
+        Count the classes (or triggers) in the Org, without pulling back any of the code
+        """
+        url = '%squery/?q=SELECT+COUNT()+FROM+%s+WHERE+NamespacePrefix=NULL' % (self.tooling_url, object_name)
+        result = self.governor.get(url, timeout=timeout, retry=retry)
+        return result.json().get('totalSize')
 
-            if extensions:
-                # There could be multiple extensions (seperated by comma), so process
-                # them individually
-                for extension in extensions.split(','):
-                    # Trim any whitespace and add to the list to reutrn
-                    extensions_list.append(extension.strip())
-                
-        return extensions_list
+    def get_extensions_from_body(self, body):
+        """
+        Retrieve the extensions for a VisualForce page body
+        """
+        return analysis.get_extensions_from_body(body)
 
 
     def get_visualforce(self, object_name):
@@ -91,8 +129,27 @@ class ScanJob(object):
         Generic method for loading all ApexPage and ApexComponent components from the Org
         """
 
+        # Process a page of records at a time, so the markup for the whole Org is never held in memory
+        for records in self.get_record_pages(object_name):
+            self.save_visualforce(object_name, records)
+
+
+    def save_visualforce(self, object_name, records):
+        """
+        Save a page of ApexPage or ApexComponent records
+        """
+
+        # Parsing the page markup for extensions is the slow part, so run it across the executor
+        if object_name == 'ApexPage':
+            with executor.get_executor(len(records)) as pool:
+                extensions = list(pool.map(analysis.get_extensions_from_body, [visualforce.get('Markup') for visualforce in records]))
+        else:
+            extensions = [[] for visualforce in records]
+
+        new_visualforce = []
+
         # Load all VF and Components
-        for visualforce in self.get_all_records(object_name):
+        for visualforce, visualforce_extensions in zip(records, extensions):
             new_vf = ApexPageComponent()
             new_vf.job = self.job
             new_vf.sf_id = visualforce.get('Id')
@@ -107,15 +164,122 @@ class ScanJob(object):
                 controllers.append(visualforce.get('ControllerKey'))
 
             # For ApexPages, we also need to check the extensions to see if there's any values to add
-            if object_name == 'ApexPage':
-                controllers.extend(self.get_extensions_from_body(new_vf.body))
+            controllers.extend(visualforce_extensions)
 
             # Add the controllers to the text field
             if controllers:
                 new_vf.controller = ','.join(controllers)
 
             new_vf.type = 'Page' if object_name == 'ApexPage' else 'Component'
-            new_vf.save()
+            new_visualforce.append(new_vf)
+
+        ApexPageComponent.objects.bulk_create(new_visualforce)
+
+
+    def get_triggers(self, metadata_container_id):
+        """
+        Load all the ApexTriggers from the Org, a page at a time, with a trigger member for each in the container
+        """
+        for records in self.get_record_pages('ApexTrigger'):
+
+            new_triggers = []
+
+            for apex_trigger in records:
+
+                new_trigger = ApexTrigger()
+                new_trigger.job = self.job
+                new_trigger.trigger_id = apex_trigger.get('Id')
+                new_trigger.name = apex_trigger.get('Name')
+                new_trigger.object_name = apex_trigger.get('TableEnumOrId')
+                new_trigger.body = apex_trigger.get('Body')
+                new_trigger.line_offsets = snippets.pack_line_offsets(snippets.get_line_offsets(new_trigger.body))
+                new_trigger.trigger_member_id = self.create_trigger_member(metadata_container_id, new_trigger)
+
+                new_triggers.append(new_trigger)
+
+            ApexTrigger.objects.bulk_create(new_triggers)
+
+
+    # The queries for the Lightning sources, as (bundle type, first API version with the object, query,
+    # bundle id field, bundle field, source type field). Only the kinds of source that can use Apex are
+    # queried, which leaves out the styles, SVGs and docs
+    LIGHTNING_QUERIES = [
+        (
+            'Aura', 32,
+            'SELECT+AuraDefinitionBundleId,AuraDefinitionBundle.DeveloperName,DefType,Source+FROM+AuraDefinition'
+            '+WHERE+AuraDefinitionBundle.NamespacePrefix=NULL+AND+DefType+IN+(%s)' % ','.join(
+                "'%s'" % def_type for def_type in analysis.AURA_MARKUP_TYPES + analysis.AURA_SCRIPT_TYPES
+            ),
+            'AuraDefinitionBundleId', 'AuraDefinitionBundle', 'DefType',
+        ),
+        (
+            'LWC', 45,
+            'SELECT+LightningComponentBundleId,LightningComponentBundle.DeveloperName,FilePath,Source+FROM+LightningComponentResource'
+            '+WHERE+LightningComponentBundle.NamespacePrefix=NULL'
+            '+AND+(FilePath+LIKE+\'%25.js\'+OR+FilePath+LIKE+\'%25.ts\')',
+            'LightningComponentBundleId', 'LightningComponentBundle', 'FilePath',
+        ),
+    ]
+
+    def get_lightning(self):
+        """
+        Load the Apex used by every Aura and LWC bundle in the Org.
+        Each page of sources is read as it arrives and then dropped, so only what each bundle uses is kept
+        """
+        bundles = {}
+
+        for bundle_type, api_version, query, bundle_id_field, bundle_field, source_type_field in self.LIGHTNING_QUERIES:
+
+            # LWC can't be queried with API versions before it existed, so is queried with at least
+            # the version it was added in, whatever version the rest of the scan uses
+            for records in self.query_pages(query, api_version=api_version):
+                for record in records:
+
+                    bundle_id = record.get(bundle_id_field)
+                    if bundle_id not in bundles:
+                        bundles[bundle_id] = {
+                            'name': (record.get(bundle_field) or {}).get('DeveloperName'),
+                            'type': bundle_type,
+                            'controller': None,
+                            'actions': set(),
+                            'imports': set(),
+                        }
+                    bundle = bundles[bundle_id]
+
+                    controller, actions, imports = analysis.extract_lightning_apex(record.get(source_type_field) or '', record.get('Source'))
+                    bundle['controller'] = bundle['controller'] or controller
+                    bundle['actions'].update(actions)
+                    bundle['imports'].update(imports)
+
+        # Apex names aren't case sensitive, so match them to the classes in the Org whatever their case
+        class_names = dict((name.lower(), name) for name in self.job.apexclass_set.values_list('name', flat=True))
+
+        new_components = []
+
+        for bundle_id, bundle in bundles.items():
+
+            controller = class_names.get((bundle['controller'] or '').lower())
+
+            # Aura actions call methods on the component's controller, LWC imports name the class
+            apex_methods = []
+            if controller:
+                apex_methods.append([controller, None])
+                apex_methods.extend([controller, action] for action in sorted(bundle['actions']))
+            apex_methods.extend(
+                [class_names[class_name.lower()], method]
+                for class_name, method in sorted(bundle['imports']) if class_name.lower() in class_names
+            )
+
+            new_components.append(LightningComponent(
+                job=self.job,
+                bundle_id=bundle_id,
+                name=bundle['name'],
+                type=bundle['type'],
+                controller=controller,
+                apex_methods_json=json.dumps(apex_methods),
+            ))
+
+        LightningComponent.objects.bulk_create(new_components, batch_size=500)
 
 
     def get_metadata_container_id(self):
@@ -125,7 +289,7 @@ class ScanJob(object):
         """
 
         url = '%ssobjects/MetadataContainer' % (self.tooling_url)
-        result = requests.post(url, headers=self.headers, json={'Name': str(uuid.uuid4())[:32]})
+        result = self.governor.post(url, json={'Name': str(uuid.uuid4())[:32]})
         return result.json().get('id')
 
 
@@ -140,7 +304,22 @@ class ScanJob(object):
             'ContentEntityId': apex_class.class_id,
             'MetadataContainerId': metadata_container_id
         }
-        result = requests.post(url, headers=self.headers, json=data)
+        result = self.governor.post(url, json=data)
+        return result.json().get('id')
+
+
+    def create_trigger_member(self, metadata_container_id, apex_trigger):
+        """
+        Create a trigger member for the Apex Trigger, so its SymbolTable is built in the same compile as the classes
+        """
+
+        url = '%ssobjects/ApexTriggerMember' % (self.tooling_url)
+        data = {
+            'Body': apex_trigger.body,
+            'ContentEntityId': apex_trigger.trigger_id,
+            'MetadataContainerId': metadata_container_id
+        }
+        result = self.governor.post(url, json=data)
         return result.json().get('id')
 
 
@@ -154,26 +333,61 @@ class ScanJob(object):
             'MetadataContainerId': metadata_container_id
         }
         # This returns an ID, and must be re-queried until it's finishd
-        result = requests.post(url, headers=self.headers, json=data)
+        result = self.governor.post(url, json=data)
         return result.json().get('id')
 
 
+    def set_phase(self, phase, progress):
+        """
+        Record the phase of the scan, and the API calls made so far, for status checks
+        """
+        self.record_api_calls()
+        self.job.set_phase(phase, progress, api_calls=self.job.api_calls)
+
+
+    def set_loading_progress(self, class_count):
+        """
+        Loading the classes runs from 5% to 30% of the scan, measured against the estimated size of the Org
+        """
+        if self.job.estimated_size:
+            self.set_phase('Loading classes', 5 + 25 * min(class_count, self.job.estimated_size) // self.job.estimated_size)
+
+
     def get_compile_status(self, compile_id):
         """
         Check the status of the compile job
         """
         url = '%ssobjects/ContainerAsyncRequest/%s' % (self.tooling_url, compile_id)
-        result = requests.get(url, headers=self.headers)
+        result = self.governor.get(url)
         return result.json()
 
 
-    def get_symbol_table_for_class(self, class_member_id):
+    def save_symbol_tables(self, metadata_container_id):
+        """
+        Retrieves the symbol tables for all classes and triggers in the container, in as few calls as possible,
+        and saves each one against its class or trigger as it arrives
         """
-        Retrieves the symbol table for a class
+        for member_type, records_for_job, id_field in [
+            ('ApexClassMember', self.job.apexclass_set, 'class_id'),
+            ('ApexTriggerMember', self.job.apextrigger_set, 'trigger_id'),
+        ]:
+            symbol_table_pages = self.query_pages(
+                'SELECT+ContentEntityId,SymbolTable+FROM+%s+WHERE+MetadataContainerId=\'%s\'' % (member_type, metadata_container_id)
+            )
+            for records in symbol_table_pages:
+                for record in records:
+                    records_for_job.filter(**{id_field: record.get('ContentEntityId')}).update(
+                        symbol_table_json=json.dumps(record.get('SymbolTable'))
+                    )
+
+
+    def check_api_budget(self):
         """
-        url = '%ssobjects/ApexClassMember/%s' % (self.tooling_url, class_member_id)
-        result = requests.get(url, headers=self.headers)
-        return json.dumps(result.json().get('SymbolTable'))
+        Make sure the Org has enough API calls left to run the scan before starting.
+        Each trigger needs its own API call, the same as each class
+        """
+        member_count = (self.get_class_count() or 0) + (self.get_class_count('ApexTrigger') or 0)
+        self.governor.check_budget(governor.estimate_api_calls(member_count))
 
 
     def get_class_to_vf_usage_dict(self):
@@ -195,7 +409,7 @@ class ScanJob(object):
         """
         apex_to_vf = {}
 
-        for visualforce in self.job.visualforce():
+        for visualforce in iter_chunked(self.job.visualforce().filter(controller__isnull=False), ['name', 'type', 'controller', 'body']):
 
             # If there was a controller found, add it to the dictionary
             if visualforce.controller:
@@ -220,6 +434,9 @@ class ScanJob(object):
         But we want to flip that around and for each class, work out what external classess call "this" class
         So, what we do is go through all the classes and methods that a class calls, and then built a dict and map this
         back to the each class, and store it on that class to display in the UI later
+
+        Decoding and walking each SymbolTable is independent per class, so that is sharded across
+        the executor and the flat list of references from each class is merged back together here
         """
 
         # First things first, we're going to go through all the Apex Pages and Components
@@ -228,192 +445,80 @@ class ScanJob(object):
         # We can go through the methods and properties later on
         apex_to_vf = self.get_class_to_vf_usage_dict()
 
-        references_dict = {}
-        
-        # Iterate over the classes
-        for apex_class in self.job.classes():
-
-            if apex_class.symbol_table_json:
-
-                # Load the JSON SymbolTable into a Python dict. 
-                # We need to traverse this to build a dict of all the external references, and 
-                # map back to the class
-                symbol_table = json.loads(apex_class.symbol_table_json)
-
-                # Create an empty reference object to populate all the references to
-                reference_object = {
-                    'visualforce': [],
-                    'classes': {},
-                    'methods': {},
-                    'variables': {},
-                    'properties': {},
-                }
-
-                # Add any VF pages as class references
-                if apex_class.name in apex_to_vf:
-
-                    # Add the VF references to the class
-                    for visualforce in apex_to_vf.get(apex_class.name):
-                        # Add the list of references to the class
-                        reference_object['visualforce'].append(self.get_vf_name(visualforce))
-
-                    # Let's see what methods are used in VisualForce
-                    if symbol_table and symbol_table.get('methods'):
-
-                        for method in symbol_table.get('methods'):
-
-                            # Get the VF method name
-                            method_vf_name = '{!' + method.get('name') + '}'
-
-                            for visualforce in apex_to_vf.get(apex_class.name):
-
-                                vf_name = visualforce.name + ' (' + visualforce.type + ')'
-
-                                # Determine if the method name is found in the VF page
-                                if method_vf_name in visualforce.body:
-
-                                    # Need to determine if a key for the method already exists
-                                    if method.get('name') in reference_object.get('methods'):
-                                        method_references = reference_object.get('methods').get(method.get('name'))
-                                    else:
-                                        method_references = {}
-
-                                    # Add the VisualForce page as a method reference
-                                    if self.get_vf_name(visualforce) not in method_references:
-                                        method_references[self.get_vf_name(visualforce)] = []
-
-                                    reference_object['methods'][method.get('name')] = method_references
-
-                    # And now do the properties
-                    if symbol_table and symbol_table.get('properties'):
-                        
-                        for apex_property in symbol_table.get('properties'):
-
-                            # Get the VF method name
-                            property_vf_name = '{!' + apex_property.get('name') + '}'
-
-                            for visualforce in apex_to_vf.get(apex_class.name):
-
-                                # Determine if the method name is found in the VF page
-                                if property_vf_name in visualforce.body:
-
-                                    # Need to determine if a key for the method already exists
-                                    if apex_property.get('name') in reference_object.get('properties'):
-                                        property_references = reference_object.get('properties').get(apex_property.get('name'))
-                                    else:
-                                        property_references = []
-
-                                    # Add the VisualForce page as a method reference
-                                    if self.get_vf_name(visualforce) not in property_references:
-                                        property_references.append(self.get_vf_name(visualforce))
-
-                                    reference_object['properties'][apex_property.get('name')] = property_references
-
-
-                    # Push back into the Dict
-                    references_dict[apex_class.name] = reference_object
-
-                # Now, load any external references for the class.
-                # This is all Apex that this class CALLS OUT to, not what references it
-                if symbol_table and symbol_table.get('externalReferences'):
-
-                    # Iterate over each external reference for the class
-                    for external_reference in symbol_table.get('externalReferences'):
-
-                        # We don't want to include anything with a namespace
-                        if not external_reference.get('namespace'):
-
-                            # If the reference already exists, take the existing dict
-                            if external_reference.get('name') in references_dict:
-                                reference_object = references_dict.get(external_reference.get('name'))
-
-                            # Now add in the line and method references
-                            # These are any references to a class that isn't a method or property
-                            # Eg. Calling the class or constructor: MyClass myClass = new MyClass();
-                            for line in external_reference.get('references', []):
-
-                                references = [self.get_line_description(line)]
-
-                                # If the class already exists, add the new reference as a child
-                                if apex_class.name in reference_object['classes']:
-                                    references = reference_object['classes'][apex_class.name]
-                                    references.append(self.get_line_description(line))
-
-                                # Add the list of references to the class
-                                reference_object['classes'][apex_class.name] = references
-
-                            # Now iterate over all the methods to determine the references
-                            # For each method
-                            for method in external_reference.get('methods', []):
-
-                                method_references = {}
-
-                                # Need to determine if a key for the method already exists
-                                if method.get('name') in reference_object.get('methods'):
-                                    method_references = reference_object.get('methods').get(method.get('name'))
-
-                                lines = []
-                                if apex_class.name in method_references:
-                                    lines = method_references.get(apex_class.name)
-
-                                for line in method.get('references', []):
-                                    lines.append(self.get_line_description(line))
-
-                                method_references[apex_class.name] = lines
-
-                                # Add back to the object map
-                                reference_object['methods'][method.get('name')] = method_references
+        # Build the compact input for each class. Only the VisualForce that uses
+        # the class is sent along with it, and the class bodies are never loaded
+        class_inputs = (
+            (
+                apex_class.name,
+                apex_class.symbol_table_json,
+                [(self.get_vf_name(visualforce), visualforce.body) for visualforce in apex_to_vf.get(apex_class.name, [])]
+            )
+            for apex_class in iter_chunked(self.job.classes().filter(symbol_table_json__isnull=False), ['name', 'symbol_table_json'])
+        )
 
+        # Triggers call out to classes the same way, so their references are mapped after the classes
+        trigger_inputs = (
+            (analysis.get_trigger_caller(apex_trigger.name), apex_trigger.symbol_table_json, [])
+            for apex_trigger in iter_chunked(self.job.triggers().filter(symbol_table_json__isnull=False), ['name', 'symbol_table_json'])
+        )
 
-                            # Now process the variables
-                            for variable in external_reference.get('variables', []):
+        # The Lightning components are already down to the Apex they use, so are cheap enough to map here
+        lightning_references = itertools.chain.from_iterable(
+            analysis.map_lightning_references((analysis.get_lightning_caller(name, bundle_type), json.loads(decompress(apex_methods_json) or '[]')))
+            for name, bundle_type, apex_methods_json in self.job.lightning().values_list('name', 'type', 'apex_methods_json')
+        )
 
-                                print(variable)
+        with executor.get_executor(self.job.apexclass_set.count() + self.job.apextrigger_set.count()) as pool:
+            references_dict = analysis.reduce_references(itertools.chain(
+                executor.flat_map_batched(pool, analysis.map_class_references, itertools.chain(class_inputs, trigger_inputs), settings.SCANNER_QUERY_CHUNK_SIZE),
+                lightning_references,
+            ))
 
-                                variable_references = {}
-                                
-                                # Need to determine if a key for the method already exists
-                                if variable.get('name') in reference_object.get('variables'):
-                                    variable_references = reference_object.get('variables').get(variable.get('name'))
-                               
-                                lines = []
-                                if apex_class.name in variable_references:
-                                    lines = variable_references.get(apex_class.name)
+        # Every name in the references is stored once against the job, and referred to by position
+        string_table = analysis.StringTable(analysis.get_reference_strings(references_dict))
+        empty_references = analysis.dumps_references(analysis.encode_references(analysis.get_empty_references(), string_table))
 
-                                for line in variable.get('references', []):
-                                    lines.append(self.get_line_description(line))
+        # Now, map back to the ApexClasses
+        # Only the changed columns are written, in a single transaction
+        # Set on the loaded job too, so it isn't lost when the job is saved at the end of the scan
+        self.job.reference_strings_json = json.dumps(string_table.strings)
 
-                                variable_references[apex_class.name] = lines
+        with transaction.atomic():
+            Job.objects.filter(pk=self.job.pk).update(reference_strings_json=self.job.reference_strings_json)
 
-                                print(variable_references)
+            for class_id, class_name in self.job.classes().values_list('id', 'name'):
 
-                                # Add back to the object map
-                                reference_object['variables'][variable.get('name')] = variable_references
+                # If the Apex Class is referenced external, dump the references
+                if class_name in references_dict:
+                    ApexClass.objects.filter(pk=class_id).update(
+                        is_referenced_externally=True,
+                        referenced_by_json=analysis.dumps_references(
+                            analysis.encode_references(references_dict.get(class_name), string_table)
+                        ),
+                        **analysis.count_references(references_dict.get(class_name))
+                    )
 
+                # Else dump in an empty array
+                else:
+                    ApexClass.objects.filter(pk=class_id).update(
+                        referenced_by_json=empty_references
+                    )
 
-                        # Push back into the Dict
-                        references_dict[external_reference.get('name')] = reference_object
+        # Now the references are stored, index the symbols in the job for searching
+        self.set_phase('Indexing symbols', 90)
+        symbols.build_symbol_index(self.job)
 
-        # Now, map back to the ApexClasses
-        for apex_class in self.job.classes():
+        # And find any classes and methods that depend on each other
+        self.set_phase('Finding cycles', 95)
+        cycles.build_cycles(self.job)
 
-            # If the Apex Class is referenced external, dump the references
-            if apex_class.name in references_dict:
-                apex_class.is_referenced_externally = True
-                apex_class.referenced_by_json = json.dumps(references_dict.get(apex_class.name))
+        # And any classes that have been copied and pasted
+        self.set_phase('Finding duplicates', 97)
+        duplicates.build_duplicates(self.job)
 
-            # Else dump in an empty array
-            else:
-                apex_class.referenced_by_json = json.dumps({
-                    'visualforce': [],
-                    'classes': {},
-                    'methods': {},
-                    'variables': {},
-                    'properties': {},
-                })
-
-            # Save the class
-            apex_class.save()
+        # And which pages and components are used
+        self.set_phase('Finding Visualforce usage', 98)
+        usage.build_usage(self.job)
 
 
     def get_vf_name(self, visualforce):
@@ -434,7 +539,7 @@ class ScanJob(object):
         """
         Build the line description for each reference
         """
-        return 'Line %d Column %d' % (line.get('line'), line.get('column'))
+        return analysis.get_line_description((line.get('line'), line.get('column')))
 
 
     def scan_org(self):
@@ -442,41 +547,70 @@ class ScanJob(object):
         Execute all the logic to scan the Org
         """
 
+        # Make sure the Org can afford the scan
+        self.set_phase('Checking API limits', 0)
+        self.check_api_budget()
+
         # Delete any existing classes
         self.job.classes().delete()
+        self.job.triggers().delete()
         self.job.visualforce().delete()
+        self.job.lightning().delete()
 
         # Create the metadata container
         metadata_container_id = self.get_metadata_container_id()
 
-        classes = []
+        class_count = 0
+        self.set_phase('Loading classes', 5)
+
+        # Query for and get all classes, a page at a time
+        for records in self.get_record_pages('ApexClass'):
+
+            new_classes = []
 
-        # Query for and get all classes
-        for apex_class in self.get_all_records('ApexClass'):
+            for apex_class in records:
 
-            # Create the new class
-            new_class = ApexClass()
-            new_class.job = self.job
-            new_class.class_id = apex_class.get('Id')
-            new_class.name = apex_class.get('Name')
-            new_class.body = apex_class.get('Body')
-            new_class.save()
+                # Create the new class
+                new_class = ApexClass()
+                new_class.job = self.job
+                new_class.class_id = apex_class.get('Id')
+                new_class.name = apex_class.get('Name')
+                new_class.body = apex_class.get('Body')
+                new_class.line_offsets = snippets.pack_line_offsets(snippets.get_line_offsets(new_class.body))
 
-            # Create a ApexClassMember for the class
-            new_class.class_member_id = self.create_class_member(metadata_container_id, new_class)
-            new_class.save()
+                # Create a ApexClassMember for the class
+                new_class.class_member_id = self.create_class_member(metadata_container_id, new_class)
 
-            classes.append(new_class)
+                new_classes.append(new_class)
+
+                # Each class needs its own API call, so loading them is a good part of the scan
+                if (class_count + len(new_classes)) % 100 == 0:
+                    self.set_loading_progress(class_count + len(new_classes))
+
+            ApexClass.objects.bulk_create(new_classes)
+            class_count += len(new_classes)
+
+
+        # Load the triggers the same way. Their calls into classes are references like any other
+        self.set_phase('Loading triggers', 30)
+        self.get_triggers(metadata_container_id)
 
 
         # Load all the Apex Pages and Apex Components as well
+        self.set_phase('Loading Visualforce', 32)
         self.get_visualforce('ApexPage')
         self.get_visualforce('ApexComponent')
 
         # Now we have created a ApexClassMember for each class, we need to "compile" all the classes
         # This runs to build the symbol table
+        self.set_phase('Compiling', 35)
         compile_request_id = self.create_container_request(metadata_container_id)
 
+        # The compile runs in Salesforce, so load the Lightning components while waiting for it
+        self.set_phase('Loading Lightning components', 35)
+        self.get_lightning()
+        self.set_phase('Compiling', 40)
+
         # Continue to check for the compile results
         compile_complete = False
         compile_status = None
@@ -502,25 +636,66 @@ class ScanJob(object):
                     errors.append(component.get('fullName') + ': ' + component.get('problem'))
 
             self.job.error = 'Code compilation error:\n- %s' % ('\n- '.join(errors))
+            self.record_api_calls()
             self.job.save()
             return
 
         # Once complete, we can now pull the SymbolTable for each ApexClass
-        for apex_class in classes:
-            apex_class.symbol_table_json = self.get_symbol_table_for_class(apex_class.class_member_id)
-            apex_class.save()
+        # These are queried in bulk from the container, rather than making a call per class
+        self.set_phase('Loading symbol tables', 55)
+        self.save_symbol_tables(metadata_container_id)
 
 
         # Re-query for the job, to load all new child references
         self.job = Job.objects.get(pk=self.job.pk)
 
+        self.set_phase('Building references', 65)
+
+        # Very large Orgs have their references built across the Celery workers instead.
+        # The job is finished off by the last reducer task
+        if self.is_distributed(class_count):
+            self.start_distributed_references()
+            return
+
         # For each Apex Class, now process all the external references
         # Basically, the SymbolTable returns all the classes and methods that "this" class references
         # But we want to flip that around and for each class, work out what external classess call "this" class
         self.process_external_references()
 
+        self.finish()
+
+
+    def is_distributed(self, class_count):
+        """
+        Determine if the references should be built across the Celery workers
+        """
+        return bool(settings.SCANNER_DISTRIBUTED_THRESHOLD) and class_count >= settings.SCANNER_DISTRIBUTED_THRESHOLD
+
+
+    def start_distributed_references(self):
+        """
+        Kick off the mapper tasks to build the references across the Celery workers
+        """
+        # Imported here as the tasks module depends on this one
+        from .tasks import build_references_distributed
+
+        self.record_api_calls()
+        self.job.save()
+
+        build_references_distributed(self.job.id)
+
+
+    def finish(self):
+        """
+        Mark the job as complete
+        """
         self.job.finished_date = timezone.now()
         self.job.status = 'Finished'
+        self.job.phase = 'Finished'
+        self.job.progress = 100
+        self.record_api_calls()
         self.job.save()
-            
+
+        # Keep a snapshot of the results, to compare with later scans of the Org
+        snapshots.create_snapshot(self.job)
 
@@ -0,0 +1,256 @@
+"""
+Schedules jobs onto the Celery queues.
+
+Jobs are sized up front with a cheap COUNT of the classes in the Org, and routed onto a
+small or large queue (each with its own worker pool) so a big Org doesn't hold up every
+small scan behind it. Each Org and user can only have a limited number of jobs running at
+once, and anything over the limit waits as 'Queued' until a slot frees up.
+
+Requests to scan an Org that already has a job in flight are coalesced onto that job, and
+callers that can accept slightly stale results can be given a recently finished job instead.
+"""
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import Job
+from .scanner import ScanJob
+
+from datetime import timedelta
+
+
+def estimate_job_size(job):
+    """
+    Get the number of classes in the Org. Returns None if the Org couldn't be queried.
+    This runs while handling a web request, so it's tried once with a short timeout, and a job
+    that can't be sized goes on the small queue
+    """
+    scan_job = ScanJob(job)
+    try:
+        return scan_job.get_class_count(timeout=settings.SALESFORCE_WEB_REQUEST_TIMEOUT, retry=False)
+    except Exception:
+        return None
+    finally:
+        scan_job.record_api_calls()
+
+
+def get_queue(size):
+    """
+    Get the queue for a job of the given size. If the size is unknown treat it as small
+    """
+    if size is not None and size >= settings.SCANNER_LARGE_JOB_THRESHOLD:
+        return settings.SCANNER_LARGE_QUEUE
+    return settings.SCANNER_SMALL_QUEUE
+
+
+def get_stale_cutoff():
+    """
+    Running jobs that haven't been updated since this are assumed to have had their worker die mid
+    job (eg. killed for running out of memory), as they would have finished by now otherwise.
+    Queued jobs are never stale, as they can wait any amount of time for a slot
+    """
+    return timezone.now() - timedelta(seconds=settings.SCANNER_STALE_JOB_AGE)
+
+
+def get_stale_jobs():
+    """
+    Jobs that are still running, but haven't been updated since the stale cutoff
+    """
+    return Job.objects.filter(
+        status='Processing',
+        updated_date__lt=get_stale_cutoff()
+    )
+
+
+def get_running_jobs():
+    """
+    Jobs that are taking up a slot. Stale jobs are ignored, in case a worker died mid job
+    """
+    return Job.objects.filter(
+        status='Processing',
+        updated_date__gte=get_stale_cutoff()
+    )
+
+
+def can_start(job, running_jobs):
+    """
+    Determine if the org and user for the job have a free slot
+    """
+    if job.org_id and len([running for running in running_jobs if running.org_id == job.org_id]) >= settings.SCANNER_MAX_JOBS_PER_ORG:
+        return False
+
+    if job.username and len([running for running in running_jobs if running.username == job.username]) >= settings.SCANNER_MAX_JOBS_PER_USER:
+        return False
+
+    return True
+
+
+def get_coalesce_key(job):
+    """
+    The key identifying the Org for a job. Falls back to the instance URL if the Org Id couldn't be found
+    """
+    if job.org_id:
+        return 'org:%s' % job.org_id
+    return 'url:%s' % job.instance_url.strip().rstrip('/').lower()
+
+
+def get_existing_job(coalesce_key, max_age=None):
+    """
+    Get a job for the Org that is still running, or finished within max_age seconds
+    """
+    existing_job = Job.objects.filter(
+        coalesce_key=coalesce_key,
+        status__in=Job.IN_FLIGHT_STATUSES
+    ).exclude(
+        pk__in=get_stale_jobs().values('pk')
+    ).first()
+
+    if not existing_job and max_age:
+        existing_job = Job.objects.filter(
+            coalesce_key=coalesce_key,
+            status='Finished',
+            finished_date__gte=timezone.now() - timedelta(seconds=max_age)
+        ).order_by('-finished_date').first()
+
+    return existing_job
+
+
+def fail_stale_jobs(coalesce_key):
+    """
+    Mark any stale jobs still in flight for the Org as errored. Otherwise new requests for the Org
+    would be coalesced onto them, and no new job could be started until they're cleared
+    """
+
+    # Imported here as the tasks module depends on this one
+    from .tasks import send_job_callbacks
+
+    stale_jobs = get_stale_jobs().filter(coalesce_key=coalesce_key)
+
+    for job_id in list(stale_jobs.values_list('pk', flat=True)):
+
+        # Only if it's still stale, in case it finished or moved on in the meantime
+        failed = get_stale_jobs().filter(pk=job_id).update(
+            status='Error',
+            error='The job stopped responding. Please try running the scan again.'
+        )
+
+        # Anything waiting on the job through the API is told it failed
+        if failed:
+            send_job_callbacks.delay(job_id)
+
+
+def schedule_job(job, max_age=None):
+    """
+    Size the job and queue it to run.
+    If the Org already has a job in flight (or one finished within max_age seconds), the new job is
+    discarded and the existing job is returned. Otherwise the job itself is returned
+    """
+    job.coalesce_key = get_coalesce_key(job)
+    fail_stale_jobs(job.coalesce_key)
+
+    existing_job = get_existing_job(job.coalesce_key, max_age)
+    if existing_job:
+        return coalesce_job(job, existing_job)
+
+    job.estimated_size = estimate_job_size(job)
+    job.queue = get_queue(job.estimated_size)
+    job.queued_date = timezone.now()
+    job.status = 'Queued'
+
+    # Only one job per Org can be in flight, so if another request got in first, use its job
+    try:
+        with transaction.atomic():
+            job.save()
+    except IntegrityError:
+        existing_job = get_existing_job(job.coalesce_key, max_age)
+        if existing_job:
+            return coalesce_job(job, existing_job)
+        raise
+
+    dispatch_queued_jobs()
+
+    return job
+
+
+def coalesce_job(job, existing_job):
+    """
+    Discard a job in favour of an existing one for the same Org
+    """
+    if job.pk:
+        job.delete()
+    return existing_job
+
+
+def dispatch_queued_jobs():
+    """
+    Send any queued jobs with a free slot to the workers, oldest first.
+    Jobs for an org or user that is at its limit are skipped over, rather than holding up everyone else
+    """
+
+    # Imported here as the tasks module depends on this one
+    from .tasks import scan_code
+
+    running_jobs = list(get_running_jobs().only('org_id', 'username'))
+    dispatched = 0
+
+    for job in Job.objects.filter(status='Queued').order_by('queued_date'):
+
+        if not can_start(job, running_jobs):
+            continue
+
+        # Claim the job, so it's only ever sent once even if dispatching happens in parallel
+        if not Job.objects.filter(pk=job.pk, status='Queued').update(status='Processing', updated_date=timezone.now()):
+            continue
+
+        scan_code.apply_async((job.id,), queue=job.queue or settings.SCANNER_SMALL_QUEUE)
+
+        running_jobs.append(job)
+        dispatched += 1
+
+    return dispatched
+
+
+def get_broker_queue_depth(queue):
+    """
+    The number of messages waiting on the broker for a queue. None if the broker can't be reached
+    """
+    from sfcodeclean.celery import app
+
+    try:
+        with app.connection_for_read() as connection:
+            return connection.default_channel.queue_declare(queue=queue, passive=True).message_count
+    except Exception:
+        return None
+
+
+def get_metrics():
+    """
+    Queue depth and wait time for each queue
+    """
+    now = timezone.now()
+    last_hour = now - timedelta(hours=1)
+
+    metrics = {}
+
+    for queue in [settings.SCANNER_SMALL_QUEUE, settings.SCANNER_LARGE_QUEUE]:
+
+        jobs = Job.objects.filter(queue=queue)
+        waiting = jobs.filter(status='Queued').aggregate(oldest=Min('queued_date'))
+
+        # Averaged here rather than in the database, as SQLite can't average dates
+        waits = [
+            (started_date - queued_date).total_seconds()
+            for queued_date, started_date in jobs.filter(started_date__gte=last_hour, queued_date__isnull=False).values_list('queued_date', 'started_date')
+        ]
+
+        metrics[queue] = {
+            'brokerDepth': get_broker_queue_depth(queue),
+            'waiting': jobs.filter(status='Queued').count(),
+            'running': get_running_jobs().filter(queue=queue).count(),
+            'oldestWaitSeconds': (now - waiting['oldest']).total_seconds() if waiting['oldest'] else 0,
+            'averageWaitSeconds': sum(waits) / len(waits) if waits else 0,
+        }
+
+    return metrics
@@ -0,0 +1,179 @@
+"""
+Snapshots of job results, for comparing scans of the same Org over time.
+
+When a job finishes, a compact fingerprint of its results is kept: a hash of each class,
+method, property and variable in the job (built from the symbol search index), along with
+how many classes and pages use it. Snapshots are kept long after clear_jobs deletes the job
+itself, so a scan can be compared with the one before it by set operations over the hashes,
+without either job's results.
+"""
+
+from django.core import signing
+from django.db import transaction
+
+from .fields import decompress
+from .models import Job, JobSnapshot
+from . import backfill
+from . import symbols
+
+import hashlib
+import json
+
+
+# Snapshots are listed with a signed id rather than the job's slug, as the slug gives access to
+# all of the job's results. The id only identifies the snapshot, and can't be guessed
+SNAPSHOT_ID_SALT = 'codescanner.snapshots'
+
+
+class SnapshotPending(Exception):
+    """
+    The snapshot for a finished job can't be taken until its symbol index has been built
+    """
+    pass
+
+
+def get_symbol_hash(kind, name):
+    """
+    A 64 bit hash identifying a symbol
+    """
+    return int.from_bytes(hashlib.blake2b(('%s:%s' % (kind, name)).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def create_snapshot(job):
+    """
+    Take the snapshot for a finished job. Replaces any existing snapshot for the job
+    """
+
+    # Imported here as the scheduler depends on the scanner, which creates the snapshots
+    from .scheduler import get_coalesce_key
+
+    index = symbols.get_symbol_index(job)
+
+    fingerprint = sorted(
+        [get_symbol_hash(kind, name), kind, name, callers]
+        for name, kind, class_name, class_id, line, callers in index['symbols']
+    )
+
+    # Replaced in place, as two requests (or a finishing scan and a backfill) can take the same
+    # snapshot at once. update_or_create locks the row, and re-reads it if the other one created it first
+    with transaction.atomic():
+        snapshot, created = JobSnapshot.objects.update_or_create(
+            job=job,
+            defaults={
+                'job_slug': job.slug,
+                'coalesce_key': job.coalesce_key or get_coalesce_key(job),
+                'org_id': job.org_id,
+                'username': job.username,
+                'finished_date': job.finished_date,
+                'class_count': len([symbol for symbol in fingerprint if symbol[1] == 'class']),
+                'member_count': len([symbol for symbol in fingerprint if symbol[1] != 'class']),
+                'unreferenced_count': len([symbol for symbol in fingerprint if not symbol[3]]),
+                'fingerprint_json': json.dumps(fingerprint, separators=(',', ':')),
+            },
+        )
+
+    return snapshot
+
+
+def get_snapshot(job_slug):
+    """
+    Get the snapshot for a job. Taken now for finished jobs from before snapshots existed, once
+    their symbol index has been built (raising SnapshotPending until then).
+    Returns None if there isn't one
+    """
+    snapshot = JobSnapshot.objects.defer('fingerprint_json').filter(job_slug=job_slug).first()
+
+    if not snapshot:
+        job = Job.objects.without_results().filter(slug=job_slug, status='Finished').first()
+        if job:
+            if symbols.get_symbol_index(job) is None:
+                backfill.request_build(job, 'symbols')
+                raise SnapshotPending(job)
+            snapshot = create_snapshot(job)
+
+    return snapshot
+
+
+def get_snapshot_id(snapshot):
+    return signing.Signer(salt=SNAPSHOT_ID_SALT).sign(str(snapshot.pk))
+
+
+def get_snapshot_by_id(snapshot_id):
+    """
+    Get a snapshot from its signed id. Returns None if the id isn't valid
+    """
+    try:
+        pk = int(signing.Signer(salt=SNAPSHOT_ID_SALT).unsign(snapshot_id))
+    except (signing.BadSignature, ValueError):
+        return None
+    return JobSnapshot.objects.defer('fingerprint_json').filter(pk=pk).first()
+
+
+def get_previous_snapshot(snapshot):
+    """
+    Get the snapshot taken before this one for the same Org
+    """
+    return (
+        JobSnapshot.objects
+        .filter(coalesce_key=snapshot.coalesce_key, finished_date__lt=snapshot.finished_date)
+        .exclude(pk=snapshot.pk)
+        .order_by('-finished_date')
+        .first()
+    )
+
+
+def load_fingerprint(snapshot):
+    """
+    Get a dict of symbol hash => (kind, name, callers) for a snapshot
+    """
+    fingerprint_json = JobSnapshot.objects.filter(pk=snapshot.pk).values_list('fingerprint_json', flat=True)[0]
+    return dict(
+        (symbol_hash, (kind, name, callers))
+        for symbol_hash, kind, name, callers in json.loads(decompress(fingerprint_json))
+    )
+
+
+def diff_snapshots(old_snapshot, new_snapshot):
+    """
+    Compare the results of two jobs
+    """
+    old = load_fingerprint(old_snapshot)
+    new = load_fingerprint(new_snapshot)
+
+    added = new.keys() - old.keys()
+    removed = old.keys() - new.keys()
+    common = new.keys() & old.keys()
+
+    def describe(fingerprint, hashes, kinds):
+        return [
+            {'name': name, 'kind': kind}
+            for kind, name in sorted(
+                (fingerprint[symbol_hash][0], fingerprint[symbol_hash][1])
+                for symbol_hash in hashes
+                if fingerprint[symbol_hash][0] in kinds
+            )
+        ]
+
+    members = ['method', 'property', 'variable']
+
+    return {
+        'from': get_snapshot_details(old_snapshot),
+        'to': get_snapshot_details(new_snapshot),
+        'addedClasses': [symbol['name'] for symbol in describe(new, added, ['class'])],
+        'removedClasses': [symbol['name'] for symbol in describe(old, removed, ['class'])],
+        'addedMembers': describe(new, added, members),
+        'removedMembers': describe(old, removed, members),
+        # Symbols in both jobs that lost, or gained, all their callers
+        'newlyUnreferenced': describe(new, [symbol_hash for symbol_hash in common if old[symbol_hash][2] and not new[symbol_hash][2]], ['class'] + members),
+        'newlyReferenced': describe(new, [symbol_hash for symbol_hash in common if not old[symbol_hash][2] and new[symbol_hash][2]], ['class'] + members),
+    }
+
+
+def get_snapshot_details(snapshot):
+    return {
+        'id': get_snapshot_id(snapshot),
+        'finishedDate': snapshot.finished_date,
+        'classes': snapshot.class_count,
+        'members': snapshot.member_count,
+        'unreferenced': snapshot.unreferenced_count,
+    }
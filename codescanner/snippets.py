@@ -0,0 +1,154 @@
+"""
+Snippets of class bodies, for showing the code around a reference or symbol definition.
+
+Each class body has a line offset index built during the scan: a packed array of ints holding
+the position each line starts at. Any range of lines is then a single slice of the body, rather
+than splitting a multi-thousand line class on every request. The body and index for each class
+are cached once loaded, as a page of results will ask for many snippets from the same classes.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import analysis
+
+from array import array
+
+import sys
+
+
+def get_line_offsets(body):
+    """
+    Get the position in the body that each line starts at
+    """
+    body = body or ''
+    offsets = [0]
+
+    position = body.find('\n')
+    while position != -1 and position + 1 < len(body):
+        offsets.append(position + 1)
+        position = body.find('\n', position + 1)
+
+    return offsets
+
+
+def pack_line_offsets(offsets):
+    """
+    Pack the line offsets into 4 bytes per line, little-endian
+    """
+    packed = array('I', offsets)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_line_offsets(data):
+    """
+    Get the line offsets back from their packed bytes
+    """
+    offsets = array('I')
+    offsets.frombytes(bytes(data))
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return offsets
+
+
+def get_line_slice(body, offsets, start, end):
+    """
+    Get the text of lines start to end (1 based and inclusive), with their line endings
+    """
+    start = max(start, 1)
+    end = min(end, len(offsets))
+
+    if start > end:
+        return ''
+
+    return body[offsets[start - 1]:offsets[end] if end < len(offsets) else len(body)]
+
+
+def get_lines(body, offsets, start, end):
+    """
+    Get the list of lines start to end (1 based and inclusive)
+    """
+    text = get_line_slice(body, offsets, start, end)
+    if not text:
+        return []
+
+    lines = text.split('\n')
+    if text.endswith('\n'):
+        lines.pop()
+
+    return [line.rstrip('\r') for line in lines]
+
+
+def get_cache_key(job, class_name):
+    # Trigger names have spaces, which memcached doesn't allow in keys
+    return 'snippets:%d:%s' % (job.pk, class_name.replace(' ', '_'))
+
+
+def get_class_lines(job, class_names):
+    """
+    Get a dict of class name => (body, line offsets) for the given classes in a job. Triggers are
+    given by their caller name in the references (eg. AccountTrigger (Trigger)).
+    Classes scanned before the index existed have it built here
+    """
+    keys = dict((get_cache_key(job, class_name), class_name) for class_name in class_names)
+    class_lines = dict((keys[key], value) for key, value in cache.get_many(list(keys)).items())
+
+    missing = [class_name for class_name in class_names if class_name not in class_lines]
+    if missing:
+
+        triggers = dict(
+            (class_name[:-len(analysis.TRIGGER_CALLER_SUFFIX)], class_name)
+            for class_name in missing if analysis.is_trigger_caller(class_name)
+        )
+
+        rows = list(job.apexclass_set.filter(name__in=missing).values_list('name', 'body', 'line_offsets'))
+        if triggers:
+            rows.extend(
+                (triggers[name], body, line_offsets)
+                for name, body, line_offsets in job.apextrigger_set.filter(name__in=list(triggers)).values_list('name', 'body', 'line_offsets')
+            )
+
+        loaded = {}
+        for class_name, body, line_offsets in rows:
+            body = body.text if body is not None else ''
+            offsets = unpack_line_offsets(line_offsets) if line_offsets else array('I', get_line_offsets(body))
+            loaded[class_name] = (body, offsets)
+
+        cache.set_many(
+            dict((get_cache_key(job, class_name), value) for class_name, value in loaded.items()),
+            settings.SCANNER_SNIPPET_CACHE_TIMEOUT
+        )
+        class_lines.update(loaded)
+
+    return class_lines
+
+
+def get_snippets(job, references, context):
+    """
+    Get the lines around each (class name, line) reference, with context lines either side
+    """
+    class_lines = get_class_lines(job, set(class_name for class_name, line in references))
+
+    snippets = []
+
+    for class_name, line in references:
+
+        if class_name not in class_lines:
+            snippets.append({'class': class_name, 'line': line, 'error': 'Class not found'})
+            continue
+
+        body, offsets = class_lines[class_name]
+        start = max(line - context, 1)
+        end = min(line + context, len(offsets))
+
+        snippets.append({
+            'class': class_name,
+            'line': line,
+            'start': start,
+            'end': end,
+            'lines': get_lines(body, offsets, start, end),
+        })
+
+    return snippets
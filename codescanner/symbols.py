@@ -0,0 +1,198 @@
+"""
+Symbol search across a job.
+
+Once the references for a job have been built, every class and each of its methods and
+properties is indexed by name, along with where it's defined and how many classes and pages
+use it. Each symbol is indexed under its normalised (lower case) member name and its full
+Class.member name, in one sorted array. Autocomplete is then a binary search for the start
+of the prefix, and a scan along the run of names that match it.
+
+The index is stored compressed against the job, and the most recently used are kept in
+memory once loaded, as the index for a big Org can hold 100k+ symbols.
+"""
+
+from django.conf import settings
+
+from .fields import decompress
+from .models import Job, iter_chunked
+from . import analysis
+from . import executor
+
+import bisect
+import collections
+import json
+
+
+# The kind of symbol each type of reference is a use of
+REFERENCE_KINDS = [
+    ('methods', 'method'),
+    ('variables', 'variable'),
+    ('properties', 'property'),
+]
+
+# Loaded indexes, keyed by job id, oldest first
+_loaded_indexes = collections.OrderedDict()
+
+
+def normalise(name):
+    return (name or '').strip().lower()
+
+
+def get_class_symbols(job):
+    """
+    Get a dict of (class name, kind, member name) => line the symbol is defined on, for every
+    symbol defined in the job. Decoding the SymbolTables is sharded across the scan executor
+    """
+    symbols = collections.OrderedDict()
+
+    class_inputs = (
+        (apex_class.name, apex_class.symbol_table_json)
+        for apex_class in iter_chunked(job.classes().filter(symbol_table_json__isnull=False), ['name', 'symbol_table_json'])
+    )
+
+    with executor.get_executor(job.apexclass_set.count()) as pool:
+        for class_name, kind, member, line in executor.flat_map_batched(pool, analysis.map_class_symbols, class_inputs, settings.SCANNER_QUERY_CHUNK_SIZE):
+            symbols[(class_name, kind, member)] = line
+
+    return symbols
+
+
+def build_symbol_index(job):
+    """
+    Build and store the symbol index for a job. Run once the references for the job have been written
+    """
+    lines = get_class_symbols(job)
+
+    # Count the distinct callers of each symbol from the stored references
+    callers = {}
+    class_ids = {}
+    string_table = analysis.StringTable(job.get_reference_strings())
+
+    for class_id, class_name, referenced_by_json in job.classes().values_list('id', 'name', 'referenced_by_json').iterator():
+
+        class_ids[class_name] = class_id
+        lines.setdefault((class_name, 'class', None), None)
+
+        references = json.loads(decompress(referenced_by_json)) if referenced_by_json else None
+        if not references:
+            continue
+
+        # Jobs scanned before the compact format are upgraded, adding their names to the string table
+        references = analysis.upgrade_references(references, string_table)
+
+        class_callers = set(references['visualforce'])
+        class_callers.update(caller for caller, locations in references['classes'])
+
+        for reference_type, kind in REFERENCE_KINDS:
+            for member, member_callers in references[reference_type]:
+                if reference_type == 'properties':
+                    member_callers = set(member_callers)
+                else:
+                    member_callers = set(caller for caller, locations in member_callers)
+
+                key = (class_name, kind, string_table.strings[member])
+                lines.setdefault(key, None)
+                callers.setdefault(key, set()).update(member_callers)
+                class_callers.update(member_callers)
+
+        callers[(class_name, 'class', None)] = class_callers
+
+    # Variables used from other classes are fields, which the SymbolTable declares with the properties.
+    # Each takes the line of its declaration, which is only kept as a property if it's used as one
+    for class_name, kind, member in list(lines):
+        property_key = (class_name, 'property', member)
+        if kind == 'variable' and property_key in lines:
+            lines[(class_name, kind, member)] = lines[property_key]
+            if property_key not in callers:
+                del lines[property_key]
+
+    # Build the list of symbols, and the sorted names to search them by
+    symbols = []
+    names = []
+
+    for (class_name, kind, member), line in lines.items():
+
+        if class_name not in class_ids:
+            continue
+
+        name = class_name if member is None else '%s.%s' % (class_name, member)
+
+        names.append((normalise(name), len(symbols)))
+        if member is not None:
+            names.append((normalise(member), len(symbols)))
+
+        symbols.append([name, kind, class_name, class_ids[class_name], line, len(callers.get((class_name, kind, member), ()))])
+
+    names.sort()
+
+    job.symbol_index_json = json.dumps({
+        'symbols': symbols,
+        'names': [name for name, position in names],
+        'positions': [position for name, position in names],
+    }, separators=(',', ':'))
+
+    Job.objects.filter(pk=job.pk).update(symbol_index_json=job.symbol_index_json)
+    _loaded_indexes.pop(job.pk, None)
+
+    return len(symbols)
+
+
+def get_symbol_index(job):
+    """
+    Load the symbol index for a job. Returns None if it hasn't been built, for jobs that haven't
+    finished or were scanned before the index existed (see backfill.py)
+    """
+    if job.pk in _loaded_indexes:
+        _loaded_indexes.move_to_end(job.pk)
+        return _loaded_indexes[job.pk]
+
+    data = Job.objects.filter(pk=job.pk).values_list('symbol_index_json', flat=True).first()
+
+    if data is None:
+        return None
+
+    index = json.loads(decompress(data))
+
+    _loaded_indexes[job.pk] = index
+    while len(_loaded_indexes) > settings.SCANNER_SYMBOL_INDEX_CACHE_SIZE:
+        _loaded_indexes.popitem(last=False)
+
+    return index
+
+
+def search_symbols(index, query, limit, exact=False):
+    """
+    Find the symbols with a name (or Class.name) starting with the query, or matching it exactly
+    """
+    query = normalise(query)
+    names = index['names']
+
+    found = []
+    seen = set()
+
+    position = bisect.bisect_left(names, query)
+
+    while position < len(names) and len(found) < limit and names[position].startswith(query):
+
+        # Exact matches sort before anything longer, so stop at the first that isn't
+        if exact and names[position] != query:
+            break
+
+        symbol = index['positions'][position]
+        if symbol not in seen:
+            seen.add(symbol)
+            found.append(index['symbols'][symbol])
+
+        position += 1
+
+    return [
+        {
+            'name': name,
+            'kind': kind,
+            'class': class_name,
+            'DatabaseId': class_id,
+            'line': line,
+            'callers': callers,
+        }
+        for name, kind, class_name, class_id, line, callers in found
+    ]
@@ -1,10 +1,15 @@
 from __future__ import absolute_import, unicode_literals
-from celery import shared_task
+from celery import shared_task, chord
 
 from django.conf import settings
+from django.utils import timezone
 
 from . import models
 from . import utils
+from . import distributed
+from . import scheduler
+from . import callbacks
+from . import backfill
 from .scanner import ScanJob
 
 import requests
@@ -24,20 +29,217 @@ def scan_code(job_id):
     # Load the job from the database
     job = models.Job.objects.get(pk=job_id)
     job.status = 'Processing'
+    job.started_date = timezone.now()
     job.save()
 
+    # Init the scan job
+    scan_job = ScanJob(job)
+
     try:
-        # Init the scan job and run
-        scan_job = ScanJob(job) 
+        # Run the scan
         scan_job.scan_org()
 
-        # If the user wants the result emailed
-        if job.email_result:
-            utils.send_finished_email(job)
-
     except Exception as ex:
 
+        # The scan may have reloaded the job, so carry on with its copy
+        job = scan_job.job
         job.status = 'Error'
         job.error = str(ex)
         job.stack_trace = traceback.format_exc()
+        scan_job.record_api_calls(job)
         job.save()
+
+    finally:
+        # Whether it finished or failed, the job has freed its slot, so start anything waiting on it.
+        # If the references are being built across the workers, the job is finished off later
+        if scan_job.job.status != 'Processing':
+            job_complete(scan_job.job)
+
+
+def job_complete(job):
+    """
+    Run anything that needs to happen once a job has finished
+    """
+
+    # If the user wants the result emailed
+    if job.email_result:
+        utils.send_finished_email(job)
+
+    # This frees up a slot for the org and user, so start anything waiting on it
+    dispatch_queued_jobs.delay()
+
+    # Let anything that started the job through the API know it's done
+    send_job_callbacks.delay(job.pk)
+
+
+@shared_task
+def dispatch_queued_jobs():
+    """
+    Send any queued jobs with a free slot to the workers
+    Also runs periodically, in case a worker dies before finishing a job
+    """
+    return scheduler.dispatch_queued_jobs()
+
+
+@shared_task
+def send_job_callbacks(job_id):
+    """
+    Send the completion notice to every callback registered for a job
+    """
+    for callback_id in callbacks.claim_callbacks(job_id):
+        deliver_job_callback.delay(callback_id)
+
+
+@shared_task
+def requeue_stale_callbacks():
+    """
+    Send the callbacks that lost their worker again (run by celery beat)
+    """
+    for job_id in callbacks.requeue_stale_callbacks():
+        send_job_callbacks.delay(job_id)
+
+
+@shared_task(bind=True, max_retries=settings.SCANNER_CALLBACK_MAX_RETRIES)
+def deliver_job_callback(self, callback_id):
+    """
+    POST the completion notice to a callback, retrying with backoff while the receiver is unavailable
+    """
+    callback = models.JobCallback.objects.select_related('job').defer(
+        *['job__%s' % field for field in models.Job.RESULT_FIELDS]
+    ).get(pk=callback_id)
+
+    try:
+        callbacks.deliver(callback)
+
+    except callbacks.CallbackError as ex:
+
+        if ex.retry and self.request.retries < self.max_retries:
+            callbacks.record_error(callback, ex)
+            raise self.retry(countdown=callbacks.get_retry_delay(self.request.retries))
+
+        callbacks.mark_failed(callback, ex)
+
+    except Exception as ex:
+        # The callback has been claimed, so anything unexpected would otherwise leave it sending forever
+        callbacks.mark_failed(callback, ex)
+        raise
+
+
+@shared_task
+def build_job_result(job_id, result):
+    """
+    Build a result for a finished job scanned before the result existed (see backfill.py)
+    """
+    job = models.Job.objects.get(pk=job_id)
+    backfill.build(job, result)
+
+
+def build_references_distributed(job_id):
+    """
+    Build the references for a job across the workers.
+    Runs all the mappers, then all the reducers, and then finishes the job
+    """
+
+    job = models.Job.objects.get(pk=job_id)
+    partitions = settings.SCANNER_REDUCE_PARTITIONS
+
+    # Keep all the work for the job on the job's queue, so it doesn't hold up smaller jobs
+    queue = job.queue or settings.SCANNER_LARGE_QUEUE
+
+    mappers = [
+        map_references.si(job_id, offset, class_ids, partitions).set(queue=queue)
+        for offset, class_ids in distributed.get_shards(job)
+    ]
+    mappers.extend(
+        map_trigger_references.si(job_id, offset, trigger_ids, partitions).set(queue=queue)
+        for offset, trigger_ids in distributed.get_trigger_shards(job)
+    )
+    mappers.extend(
+        map_lightning_references.si(job_id, offset, component_ids, partitions).set(queue=queue)
+        for offset, component_ids in distributed.get_lightning_shards(job)
+    )
+
+    chord(mappers)(
+        start_reducers.si(job_id, partitions, queue).set(queue=queue).on_error(distributed_references_failed.s(job_id))
+    )
+
+
+@shared_task
+def map_references(job_id, offset, class_ids, partitions):
+    """
+    Stage the references for a shard of classes
+    """
+    job = models.Job.objects.get(pk=job_id)
+    return distributed.map_references(job, offset, class_ids, partitions)
+
+
+@shared_task
+def map_trigger_references(job_id, offset, trigger_ids, partitions):
+    """
+    Stage the references for a shard of triggers
+    """
+    job = models.Job.objects.get(pk=job_id)
+    return distributed.map_trigger_references(job, offset, trigger_ids, partitions)
+
+
+@shared_task
+def map_lightning_references(job_id, offset, component_ids, partitions):
+    """
+    Stage the references for a shard of Lightning components
+    """
+    job = models.Job.objects.get(pk=job_id)
+    return distributed.map_lightning_references(job, offset, component_ids, partitions)
+
+
+@shared_task
+def start_reducers(job_id, partitions, queue):
+    """
+    Once all mappers are complete, build the string table and run a reducer for each partition
+    """
+    job = models.Job.objects.get(pk=job_id)
+    job.set_phase('Reducing references', 75)
+    distributed.build_reference_strings(job)
+
+    reducers = [
+        reduce_references.si(job_id, partition, partitions).set(queue=queue)
+        for partition in range(partitions)
+    ]
+
+    chord(reducers)(
+        finish_references.si(job_id).set(queue=queue).on_error(distributed_references_failed.s(job_id))
+    )
+
+
+@shared_task
+def reduce_references(job_id, partition, partitions):
+    """
+    Build the references for every class in a partition
+    """
+    job = models.Job.objects.get(pk=job_id)
+    return distributed.reduce_references(job, partition, partitions)
+
+
+@shared_task
+def finish_references(job_id):
+    """
+    Once all the reducers are complete, finish the job
+    """
+    scan_job = ScanJob(models.Job.objects.get(pk=job_id))
+    scan_job.job.set_phase('Indexing symbols', 90)
+    distributed.finish_references(scan_job.job)
+    scan_job.finish()
+    job_complete(scan_job.job)
+
+
+@shared_task
+def distributed_references_failed(request, exc, exc_traceback, job_id):
+    """
+    Error callback for when any of the mappers or reducers fail
+    """
+    job = models.Job.objects.get(pk=job_id)
+    job.status = 'Error'
+    job.error = 'Error building references: %s' % exc
+    job.save()
+
+    models.StagedReference.objects.filter(job=job).delete()
+    job_complete(job)
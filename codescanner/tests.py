@@ -1,6 +1,1461 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import NotSupportedError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 
-# Create your tests here.
+from .fields import FORMAT_RAW, FORMAT_ZLIB, CompressedData, compress, decompress, json_contains
+from . import analysis
+from . import callbacks
+from . import cycles
+from . import distributed
+from . import duplicates
+from . import executor
+from . import governor
+from . import graph
+from . import queries
+from . import scheduler
+from . import snippets
+from . import tasks
+from . import usage
+from . import views
+from .models import ApexClass, ApexPageComponent, ApexTrigger, Job, JobCallback, LightningComponent, StagedReference, iter_json_contains
+from .scanner import ScanJob
+
+from datetime import timedelta
+from unittest import mock
+
+import gzip
+import io
+import itertools
+import json
+import os
+import random
+import requests
+import socket
+import string
+import threading
+import time
+import tracemalloc
+import zlib
+
+
+def create_job(**fields):
+    """
+    Create a job to hang classes and pages off
+    """
+    fields.setdefault('org_id', '00D000000000001')
+    fields.setdefault('access_token', 'token')
+    fields.setdefault('instance_url', 'https://example.my.salesforce.com')
+    return Job.objects.create(**fields)
+
+
+def get_symbol_table(methods=(), constructors=(), properties=(), external_references=()):
+    """
+    Build a SymbolTable as the Tooling API returns it, from (name, line) for each method and
+    constructor, names of properties, and dicts for each external reference
+    """
+    return json.dumps({
+        'tableDeclaration': {'location': {'line': 1, 'column': 14}},
+        'constructors': [{'name': name, 'location': {'line': line, 'column': 12}} for name, line in constructors],
+        'methods': [{'name': name, 'location': {'line': line, 'column': 12}} for name, line in methods],
+        'properties': [{'name': name, 'location': {'line': 2, 'column': 12}} for name in properties],
+        'variables': [],
+        'externalReferences': list(external_references),
+    })
+
+
+def get_external_reference(name, lines=(), methods=None, variables=None, namespace=None):
+    """
+    Build an external reference from a SymbolTable, with the (line, column) of each use of the
+    class, and a dict of name => [(line, column)] for the methods and variables used
+    """
+    def get_locations(locations):
+        return [{'line': line, 'column': column} for line, column in locations]
+
+    return {
+        'name': name,
+        'namespace': namespace,
+        'references': get_locations(lines),
+        'methods': [{'name': method, 'references': get_locations(locations)} for method, locations in (methods or {}).items()],
+        'variables': [{'name': variable, 'references': get_locations(locations)} for variable, locations in (variables or {}).items()],
+    }
+
+
+def get_response(status_code=200, body=b'{}', headers=None):
+    """
+    Build a response as requests would return it
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = requests.status_codes._codes[status_code][0].upper()
+    response.headers.update(headers or {})
+    response._content = body
+    return response
+
+
+def get_process_id(item):
+    """
+    Run in the executor, to see which process each item was handled in
+    """
+    return (item, os.getpid())
+
+
+class ExecutorTests(TestCase):
+    """
+    The executor the CPU bound phases of a scan are sharded across
+    """
+
+    def get_class_inputs(self, count):
+        return [
+            ('Class%03d' % number, get_symbol_table(methods=[('method%d' % method, method * 10 + 5) for method in range(number % 4)]))
+            for number in range(count)
+        ]
+
+    def test_pool_matches_serial(self):
+        class_inputs = self.get_class_inputs(40)
+
+        with executor.ProcessPoolExecutor(3) as pool:
+            pooled = list(executor.flat_map(pool, analysis.map_class_methods, class_inputs, chunksize=3))
+
+        with executor.SerialExecutor() as pool:
+            serial = list(executor.flat_map(pool, analysis.map_class_methods, class_inputs))
+
+        self.assertEqual(pooled, serial)
+        self.assertEqual(len(serial), sum(number % 4 for number in range(40)))
+
+    def test_pool_runs_in_child_processes(self):
+        with executor.ProcessPoolExecutor(2) as pool:
+            results = list(pool.map(get_process_id, range(20), chunksize=2))
+
+        # In order, and none of it run in this process
+        self.assertEqual([item for item, process_id in results], list(range(20)))
+        self.assertNotIn(os.getpid(), set(process_id for item, process_id in results))
+
+    def test_batched_matches_unbatched(self):
+        class_inputs = self.get_class_inputs(25)
+
+        with executor.ProcessPoolExecutor(2) as pool:
+            batched = list(executor.flat_map_batched(pool, analysis.map_class_methods, iter(class_inputs), 7, chunksize=2))
+
+        self.assertEqual(batched, list(executor.flat_map(executor.SerialExecutor(), analysis.map_class_methods, class_inputs)))
+
+    def test_pool_is_terminated_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with executor.ProcessPoolExecutor(2) as pool:
+                raise RuntimeError('Failed mid scan')
+
+        # The workers are stopped rather than waited on
+        self.assertFalse(any(process.is_alive() for process in pool.pool._pool))
+
+    def test_get_executor(self):
+        with override_settings(SCANNER_WORKERS=1):
+            self.assertIsInstance(executor.get_executor(10000), executor.SerialExecutor)
+
+        with override_settings(SCANNER_WORKERS=4, SCANNER_CHUNK_SIZE=50):
+
+            # Not worth starting a pool for
+            self.assertIsInstance(executor.get_executor(50), executor.SerialExecutor)
+
+            with executor.get_executor(1000) as pool:
+                self.assertIsInstance(pool, executor.ProcessPoolExecutor)
+                self.assertEqual(pool.workers, 4)
+
+
+@override_settings(SCANNER_WORKERS=1)
+class DistributedReferencesTests(TestCase):
+    """
+    Building the references with map-reduce tasks gives the same results as a local scan
+    """
+
+    def setUp(self):
+        self.job = create_job()
+
+        # Each class uses a few of the others, some methods and variables, and a namespaced class
+        for number in range(30):
+            uses = [(number * 7 + offset) % 30 for offset in (1, 2, 5)]
+            ApexClass.objects.create(
+                job=self.job,
+                class_id='01p%015d' % number,
+                name='Class%02d' % number,
+                body='public class Class%02d {}' % number,
+                symbol_table_json=get_symbol_table(
+                    methods=[('run', 3), ('save', 9)],
+                    properties=['name'],
+                    external_references=[
+                        get_external_reference(
+                            'Class%02d' % target,
+                            lines=[(4, target), (4, target)],
+                            methods={'run': [(5, 1)], 'save': []},
+                            variables={'count': [(6, 2)]},
+                        )
+                        for target in uses
+                    ] + [get_external_reference('Managed', lines=[(7, 1)], namespace='ns')],
+                ),
+            )
+
+        ApexPageComponent.objects.create(job=self.job, sf_id='066000000000001', name='Edit', body='<apex:page>{!save} {!name}</apex:page>', controller='Class03,Class04', type='Page')
+        ApexTrigger.objects.create(job=self.job, trigger_id='01q000000000001', name='AccountTrigger', body='trigger AccountTrigger on Account (before insert) {}', symbol_table_json=get_symbol_table(
+            external_references=[get_external_reference('Class01', lines=[(2, 5)], methods={'run': [(3, 5)]})],
+        ))
+        LightningComponent.objects.create(job=self.job, bundle_id='0Rb000000000001', name='accountList', type='LWC', apex_methods_json=json.dumps([['Class02', 'save'], ['Missing', 'go']]))
+
+    def get_results(self):
+        """
+        Get the references of each class, decoded with the job's string table, along with the counts
+        """
+        job = Job.objects.get(pk=self.job.pk)
+        strings = job.get_reference_strings()
+
+        return dict(
+            (name, (analysis.decode_references(json.loads(decompress(references)), strings), is_referenced, counts))
+            for name, references, is_referenced, *counts in job.classes().values_list(
+                'name', 'referenced_by_json', 'is_referenced_externally',
+                'visualforce_count', 'classes_count', 'methods_count', 'variables_count', 'properties_count',
+            )
+        )
+
+    def test_distributed_matches_local(self):
+        ScanJob(self.job).process_external_references()
+        local = self.get_results()
+
+        Job.objects.filter(pk=self.job.pk).update(reference_strings_json=None)
+        self.job.apexclass_set.update(
+            referenced_by_json=None, is_referenced_externally=False,
+            visualforce_count=0, classes_count=0, methods_count=0, variables_count=0, properties_count=0,
+        )
+
+        partitions = 4
+        with override_settings(SCANNER_MAP_SHARD_SIZE=7):
+
+            # The mappers can run in any order, so run them backwards
+            for offset, class_ids in reversed(distributed.get_shards(self.job)):
+                distributed.map_references(self.job, offset, class_ids, partitions)
+            for offset, trigger_ids in distributed.get_trigger_shards(self.job):
+                distributed.map_trigger_references(self.job, offset, trigger_ids, partitions)
+            for offset, component_ids in distributed.get_lightning_shards(self.job):
+                distributed.map_lightning_references(self.job, offset, component_ids, partitions)
+
+        distributed.build_reference_strings(self.job)
+        for partition in reversed(range(partitions)):
+            distributed.reduce_references(self.job, partition, partitions)
+        distributed.finish_references(self.job)
+
+        self.assertEqual(self.get_results(), local)
+        self.assertFalse(StagedReference.objects.filter(job=self.job).exists())
+
+        # Spot check the references themselves
+        # Lightning components are stored with the pages
+        references = local['Class02'][0]
+        self.assertEqual(references['visualforce'], ['accountList (LWC)'])
+        self.assertIn('accountList (LWC)', references['methods']['save'])
+        self.assertEqual(local['Class01'][0]['classes']['AccountTrigger (Trigger)'], ['Line 2 Column 5'])
+        self.assertEqual(local['Class03'][0]['visualforce'], ['Edit (Page)'])
+        self.assertEqual(local['Class03'][0]['properties'], {'name': ['Edit (Page)']})
+
+
+@override_settings(SCANNER_MAX_JOBS_PER_ORG=1, SCANNER_MAX_JOBS_PER_USER=2, SCANNER_LARGE_JOB_THRESHOLD=1000)
+class SchedulerTests(TestCase):
+    """
+    Jobs are routed by size, and each Org and user only gets so many running at once
+    """
+
+    def setUp(self):
+        patcher = mock.patch('codescanner.tasks.scan_code.apply_async')
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue_job(self, org_id, username, minutes_ago, **fields):
+        return create_job(
+            org_id=org_id,
+            username=username,
+            status='Queued',
+            queue='scans-small',
+            queued_date=timezone.now() - timedelta(minutes=minutes_ago),
+            **fields
+        )
+
+    def get_dispatched(self):
+        return [call[0][0][0] for call in self.apply_async.call_args_list]
+
+    def test_get_queue(self):
+        self.assertEqual(scheduler.get_queue(None), 'scans-small')
+        self.assertEqual(scheduler.get_queue(999), 'scans-small')
+        self.assertEqual(scheduler.get_queue(1000), 'scans-large')
+
+    def test_schedule_job_routes_by_size(self):
+        with mock.patch('codescanner.scheduler.estimate_job_size', return_value=5000):
+            job = scheduler.schedule_job(create_job())
+
+        self.assertEqual(job.estimated_size, 5000)
+        self.assertEqual(job.queue, 'scans-large')
+        self.apply_async.assert_called_once_with((job.id,), queue='scans-large')
+
+        # An Org that can't be sized is treated as small
+        with mock.patch('codescanner.scheduler.estimate_job_size', return_value=None):
+            job = scheduler.schedule_job(create_job(org_id='00D000000000002'))
+
+        self.assertEqual(job.queue, 'scans-small')
+
+    def test_busy_users_and_orgs_are_skipped(self):
+        busy = [self.queue_job('00D00000000000%d' % number, 'busy@example.com', 30 - number) for number in range(3)]
+        same_org = self.queue_job(busy[0].org_id, 'other@example.com', 20)
+        newest = self.queue_job('00D000000000009', 'new@example.com', 1)
+
+        self.assertEqual(scheduler.dispatch_queued_jobs(), 3)
+
+        # The busy user's third job and the second job for the Org wait, without holding up the newest job
+        self.assertEqual(self.get_dispatched(), [busy[0].id, busy[1].id, newest.id])
+        self.assertEqual(Job.objects.get(pk=busy[2].pk).status, 'Queued')
+        self.assertEqual(Job.objects.get(pk=same_org.pk).status, 'Queued')
+
+        # Nothing is sent twice, and the waiting jobs go once a slot frees up
+        self.assertEqual(scheduler.dispatch_queued_jobs(), 0)
+        Job.objects.filter(pk=busy[0].pk).update(status='Finished')
+        self.assertEqual(scheduler.dispatch_queued_jobs(), 2)
+        self.assertEqual(self.get_dispatched()[3:], [busy[2].id, same_org.id])
+
+    def test_stale_jobs_free_their_slot(self):
+        running = create_job(username='user@example.com', status='Processing')
+        waiting = self.queue_job(running.org_id, 'user@example.com', 5)
+
+        self.assertEqual(scheduler.dispatch_queued_jobs(), 0)
+
+        # A job that hasn't moved on in a long time has lost its worker
+        with override_settings(SCANNER_STALE_JOB_AGE=60):
+            Job.objects.filter(pk=running.pk).update(updated_date=timezone.now() - timedelta(minutes=5))
+            self.assertEqual(list(scheduler.get_stale_jobs()), [running])
+            self.assertEqual(scheduler.dispatch_queued_jobs(), 1)
+
+        self.assertEqual(self.get_dispatched(), [waiting.id])
+
+
+@override_settings(SALESFORCE_MAX_RETRIES=2, SALESFORCE_API_RESERVE=0.1, SALESFORCE_API_THROTTLE_RATIO=0.8, SALESFORCE_API_THROTTLE_DELAY=2)
+class RequestGovernorTests(TestCase):
+    """
+    The governor reads the Org's API usage from Sforce-Limit-Info, and keeps the job within it
+    """
+
+    def setUp(self):
+        self.governor = governor.RequestGovernor({'Authorization': 'Bearer token'})
+
+        patcher = mock.patch('codescanner.governor.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, responses, method='GET', **kwargs):
+        with mock.patch.object(self.governor.session, 'request', side_effect=responses) as request:
+            try:
+                return self.governor.request(method, 'https://example.my.salesforce.com/services/data/', **kwargs)
+            finally:
+                self.request_count = request.call_count
+
+    def test_reads_limit_info(self):
+        self.send([get_response(headers={'Sforce-Limit-Info': 'api-usage=18/5000'})])
+        self.assertEqual((self.governor.api_usage, self.governor.api_limit, self.governor.get_remaining()), (18, 5000, 4982))
+
+        # The connected app's own usage isn't the Org's, whichever comes first, and responses
+        # without the header leave the usage as it was
+        self.send([get_response(headers={'Sforce-Limit-Info': 'per-app-api-usage=2/250(appName=sfcodeclean); api-usage=19/5000'})])
+        self.send([get_response()])
+        self.assertEqual((self.governor.api_usage, self.governor.api_limit), (19, 5000))
+        self.assertEqual(self.governor.calls, 3)
+
+    def test_unknown_usage(self):
+        self.assertIsNone(self.governor.get_remaining())
+
+        # Nothing to go on, so anything goes
+        self.governor.check_budget(1000000)
+        self.governor.throttle()
+        self.sleep.assert_not_called()
+
+    def test_throttles_near_the_limit(self):
+        self.governor.api_usage, self.governor.api_limit = 700, 1000
+        self.governor.throttle()
+        self.sleep.assert_not_called()
+
+        # Halfway between the throttle ratio and the limit waits half the delay
+        self.governor.api_usage = 850
+        self.governor.throttle()
+        self.assertAlmostEqual(self.sleep.call_args[0][0], 0.5)
+
+        # And it stops before using the calls kept in reserve
+        self.governor.api_usage = 900
+        with self.assertRaises(governor.ApiLimitError):
+            self.governor.throttle()
+
+    def test_check_budget(self):
+        self.governor.api_usage, self.governor.api_limit = 4000, 5000
+
+        self.governor.check_budget(500)
+        with self.assertRaises(governor.ApiLimitError):
+            self.governor.check_budget(501)
+
+    def test_retries_idempotent_requests(self):
+        response = self.send([
+            get_response(503, headers={'Retry-After': '3'}),
+            get_response(429),
+            get_response(200, b'{"size": 1}'),
+        ])
+
+        self.assertEqual(response.json(), {'size': 1})
+        self.assertEqual(self.request_count, 3)
+        self.assertEqual(self.governor.calls, 3)
+
+        # Retry-After is honoured, and otherwise the backoff doubles
+        self.assertEqual([call[0][0] for call in self.sleep.call_args_list], [3.0, 2.0])
+
+    def test_retries_connection_errors(self):
+        response = self.send([requests.ConnectionError('reset'), get_response()])
+        self.assertEqual(response.status_code, 200)
+
+        # Only the calls that reached Salesforce are counted
+        self.assertEqual(self.governor.calls, 1)
+
+        with self.assertRaisesRegex(governor.ApiRequestError, 'Could not connect'):
+            self.send([requests.Timeout('slow')] * 3)
+
+    def test_does_not_retry_posts(self):
+        with self.assertRaises(governor.ApiRequestError):
+            self.send([get_response(503), get_response()], method='POST')
+        self.assertEqual(self.request_count, 1)
+
+        with self.assertRaises(governor.ApiRequestError):
+            self.send([get_response(503), get_response()], retry=False)
+        self.assertEqual(self.request_count, 1)
+
+    def test_error_messages(self):
+        with self.assertRaisesRegex(governor.ApiRequestError, '^REQUEST_LIMIT_EXCEEDED: TotalRequests Limit exceeded.$'):
+            self.send([get_response(403, b'[{"errorCode": "REQUEST_LIMIT_EXCEEDED", "message": "TotalRequests Limit exceeded."}]')])
+
+        with self.assertRaisesRegex(governor.ApiRequestError, '^Salesforce returned 404 NOT_FOUND$'):
+            self.send([get_response(404, b'<html>Not Found</html>')])
+
+
+class CoalescingTests(TestCase):
+    """
+    Requests to scan an Org that's already being scanned (or was recently) share a job
+    """
+
+    def setUp(self):
+        for target, attribute in [('codescanner.tasks.scan_code.apply_async', 'apply_async'), ('codescanner.tasks.send_job_callbacks.delay', 'send_callbacks'), ('codescanner.scheduler.estimate_job_size', 'estimate_job_size')]:
+            patcher = mock.patch(target)
+            setattr(self, attribute, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.estimate_job_size.return_value = 10
+
+    def test_requests_share_the_running_job(self):
+        first = scheduler.schedule_job(create_job())
+        second_request = create_job()
+        second = scheduler.schedule_job(second_request)
+
+        self.assertEqual(second, first)
+        self.assertFalse(Job.objects.filter(pk=second_request.pk).exists())
+        self.assertEqual(self.apply_async.call_count, 1)
+
+        # Orgs without an Org Id are matched on their instance URL
+        first = scheduler.schedule_job(create_job(org_id='', instance_url='https://Other.my.salesforce.com/'))
+        self.assertEqual(first.coalesce_key, 'url:https://other.my.salesforce.com')
+        self.assertEqual(scheduler.schedule_job(create_job(org_id='', instance_url='https://other.my.salesforce.com')), first)
+
+    def test_finished_jobs_within_max_age(self):
+        finished = create_job(status='Finished', coalesce_key='org:00D000000000001', finished_date=timezone.now() - timedelta(minutes=10))
+
+        self.assertEqual(scheduler.schedule_job(create_job(), max_age=3600), finished)
+
+        # Too old, or the caller wants a fresh scan
+        job = scheduler.schedule_job(create_job(), max_age=60)
+        self.assertNotEqual(job, finished)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, 'Processing')
+
+    def test_stale_jobs_are_failed(self):
+        with override_settings(SCANNER_STALE_JOB_AGE=3600):
+            stale = scheduler.schedule_job(create_job())
+            Job.objects.filter(pk=stale.pk).update(updated_date=timezone.now() - timedelta(hours=2))
+
+            job = scheduler.schedule_job(create_job())
+
+        self.assertNotEqual(job, stale)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, 'Error')
+        self.send_callbacks.assert_called_once_with(stale.pk)
+
+    def test_staleness_is_from_the_last_update(self):
+        with override_settings(SCANNER_STALE_JOB_AGE=3600):
+
+            # Queued a long time ago, but only just dispatched
+            job = scheduler.schedule_job(create_job())
+            Job.objects.filter(pk=job.pk).update(created_date=timezone.now() - timedelta(hours=5), queued_date=timezone.now() - timedelta(hours=5))
+
+            self.assertEqual(scheduler.schedule_job(create_job()), job)
+
+            # A job still waiting for a slot is never stale
+            Job.objects.filter(pk=job.pk).update(status='Queued', updated_date=timezone.now() - timedelta(hours=5))
+            self.assertEqual(scheduler.schedule_job(create_job()), job)
+
+    def test_api_rejects_bad_max_age(self):
+        for max_age in ['soon', -1, 1.5, True, [60]]:
+            response = Client().post('/api/job/', json.dumps({
+                'instanceUrl': 'https://example.my.salesforce.com',
+                'accessToken': 'token',
+                'maxAge': max_age,
+            }), content_type='application/json')
+
+            self.assertEqual(response.status_code, 400, max_age)
+            self.assertEqual(response.json()['error'], 'maxAge must be a whole number of seconds')
+
+
+class ProjectedIterationTests(TestCase):
+    """
+    The hot paths read only the columns they need, a chunk of rows at a time, rather than every
+    class body in the job. Peak memory is measured with tracemalloc, with and without the projection
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.job = create_job(status='Finished')
+
+        # Bodies of random text, so they don't compress away to nothing
+        generator = random.Random(31)
+        ApexClass.objects.bulk_create([
+            ApexClass(
+                job=cls.job,
+                class_id='01p%015d' % number,
+                name='Class%03d' % number,
+                body=''.join(generator.choices(string.ascii_letters + string.digits + ' ;(){}', k=20000)),
+                symbol_table_json=get_symbol_table(methods=[('run', 3)]),
+                referenced_by_json=analysis.dumps_references(analysis.encode_references(analysis.get_empty_references(), analysis.StringTable())),
+            )
+            for number in range(200)
+        ])
+
+        cls.body_size = sum(len(body) for body in ApexClass.objects.values_list('body', flat=True))
+
+    def get_peak_memory(self, function):
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_projected_iteration(self):
+        loaded = self.get_peak_memory(lambda: [(apex_class.name, apex_class.symbol_table_json) for apex_class in self.job.classes()])
+        projected = self.get_peak_memory(lambda: [(apex_class.name, apex_class.symbol_table_json) for apex_class in self.job.iter_classes('name', 'symbol_table_json')])
+
+        # Loading every row holds all the (compressed) bodies at once
+        self.assertGreater(loaded, self.body_size)
+        self.assertLess(projected * 5, loaded, 'Peak of %d bytes projected, %d bytes loaded' % (projected, loaded))
+
+    def test_chunked_iteration(self):
+        loaded = self.get_peak_memory(lambda: [len(apex_class.body) for apex_class in self.job.classes()])
+        chunked = self.get_peak_memory(lambda: [len(apex_class.body) for apex_class in self.job.iter_classes('name', 'body', chunk_size=20)])
+
+        # Only a chunk of bodies is held at a time, even where they're read
+        self.assertLess(chunked * 4, loaded, 'Peak of %d bytes chunked, %d bytes loaded' % (chunked, loaded))
+
+    def test_job_json_does_not_load_bodies(self):
+        client = Client()
+        url = '/api/job/%s/' % self.job.slug
+
+        client.get(url)
+        peak = self.get_peak_memory(lambda: client.get(url))
+
+        # Making every body four times the size doesn't change how much the results take to build
+        generator = random.Random(32)
+        classes = list(self.job.apexclass_set.only('id'))
+        for apex_class in classes:
+            apex_class.body = ''.join(generator.choices(string.ascii_letters + string.digits + ' ;(){}', k=80000))
+        ApexClass.objects.bulk_update(classes, ['body'], batch_size=50)
+
+        added_size = sum(len(body) for body in ApexClass.objects.values_list('body', flat=True)) - self.body_size
+        larger_peak = self.get_peak_memory(lambda: client.get(url))
+
+        self.assertLess(larger_peak - peak, added_size / 20, 'Peak went from %d to %d bytes, with %d bytes added to the bodies' % (peak, larger_peak, added_size))
+
+
+class CompressedTextFieldTests(TestCase):
+    """
+    Large text is stored compressed, and behaves like text on the model
+    """
+
+    def test_storage_format(self):
+        job = create_job()
+        short_body = 'public class Short {}'
+        long_body = 'public class Long {\n' + '    // Ünïcödé comment\n' * 100 + '}'
+
+        ApexClass.objects.create(job=job, class_id='01p000000000001', name='Short', body=short_body)
+        ApexClass.objects.create(job=job, class_id='01p000000000002', name='Long', body=long_body)
+
+        stored = dict(job.apexclass_set.values_list('name', 'body'))
+
+        # Short values aren't worth compressing
+        self.assertIsInstance(stored['Short'], CompressedData)
+        self.assertEqual(stored['Short'].format, FORMAT_RAW)
+        self.assertEqual(stored['Long'].format, FORMAT_ZLIB)
+        self.assertLess(len(stored['Long']), len(long_body.encode('utf-8')) / 10)
+
+        self.assertEqual(stored['Short'].text, short_body)
+        self.assertEqual(decompress(stored['Long']), long_body)
+        self.assertEqual(job.apexclass_set.get(name='Long').body, long_body)
+
+    def test_streams(self):
+        for text in ['x' * 10, 'Ünïcödé ' * 100]:
+            data = compress(text)
+            self.assertEqual(zlib.decompress(data.get_zlib_stream()).decode('utf-8'), text)
+            self.assertEqual(gzip.decompress(data.get_gzip_stream()).decode('utf-8'), text)
+
+    def test_unchanged_values_are_not_compressed_again(self):
+        job = create_job()
+        apex_class = ApexClass.objects.create(job=job, class_id='01p000000000001', name='Saved', body='a' * 1000)
+        stored = ApexClass.objects.values_list('body', flat=True).get(pk=apex_class.pk)
+
+        with mock.patch('codescanner.fields.compress') as compress_text:
+            apex_class = ApexClass.objects.get(pk=apex_class.pk)
+            apex_class.name = 'Renamed'
+            apex_class.save()
+        compress_text.assert_not_called()
+
+        self.assertEqual(ApexClass.objects.values_list('body', flat=True).get(pk=apex_class.pk), stored)
+
+    def test_decompress(self):
+        self.assertIsNone(decompress(None))
+        self.assertEqual(decompress('plain text'), 'plain text')
+        self.assertEqual(decompress(b''), '')
+        self.assertEqual(decompress(memoryview(compress('y' * 500))), 'y' * 500)
+
+        with self.assertRaises(ValueError):
+            decompress(b'\x07data')
+
+
+class MigrationTestCase(TransactionTestCase):
+    """
+    Runs the data migrations against rows created with the models as they were before them
+    """
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([('codescanner', target)])
+        return executor.loader.project_state([('codescanner', target)]).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+
+class CompressedTextMigrationTests(MigrationTestCase):
+    """
+    0017 moves the bodies, SymbolTables and references into compressed columns, in batches
+    """
+
+    def test_compress_and_back(self):
+        apps = self.migrate('0016_job_coalesce_key')
+        Job = apps.get_model('codescanner', 'Job')
+        ApexClass = apps.get_model('codescanner', 'ApexClass')
+        ApexPageComponent = apps.get_model('codescanner', 'ApexPageComponent')
+
+        job = Job.objects.create(org_id='00D000000000001', access_token='token', instance_url='https://example.my.salesforce.com')
+
+        # More than a batch of rows, some without SymbolTables or references
+        rows = dict(
+            (
+                'Class%03d' % number,
+                (
+                    'public class Class%03d { Ünïcödé }' % number * (number % 20 + 1),
+                    json.dumps({'methods': [{'name': 'run%d' % number}]}) if number % 3 else None,
+                    json.dumps({'classes': {'Caller': ['Line 1 Column 1']}}) if number % 4 else None,
+                )
+            )
+            for number in range(450)
+        )
+        for name, (body, symbol_table_json, referenced_by_json) in rows.items():
+            ApexClass.objects.create(job=job, class_id='01p000000000001', name=name, body=body, symbol_table_json=symbol_table_json, referenced_by_json=referenced_by_json)
+        ApexPageComponent.objects.create(job=job, sf_id='066000000000001', name='Edit', body='<apex:page/>' * 50, type='Page')
+
+        apps = self.migrate('0017_compressed_text')
+        ApexClass = apps.get_model('codescanner', 'ApexClass')
+        ApexPageComponent = apps.get_model('codescanner', 'ApexPageComponent')
+
+        compressed = dict(
+            (name, (decompress(body), decompress(symbol_table_json), decompress(referenced_by_json)))
+            for name, body, symbol_table_json, referenced_by_json in ApexClass.objects.values_list('name', 'body', 'symbol_table_json', 'referenced_by_json')
+        )
+        self.assertEqual(compressed, rows)
+        self.assertEqual(ApexPageComponent.objects.values_list('body', flat=True).get().format, FORMAT_ZLIB)
+
+        apps = self.migrate('0016_job_coalesce_key')
+        ApexClass = apps.get_model('codescanner', 'ApexClass')
+
+        restored = dict(
+            (name, (body, symbol_table_json, referenced_by_json))
+            for name, body, symbol_table_json, referenced_by_json in ApexClass.objects.values_list('name', 'body', 'symbol_table_json', 'referenced_by_json')
+        )
+        self.assertEqual(restored, rows)
+
+
+class CompactReferencesTests(TestCase):
+    """
+    The v2 references use a per-job string table and [line, column] locations, and decode back to
+    the legacy format with 'Line X Column Y' descriptions
+    """
+
+    def get_references_dict(self):
+        class_inputs = [
+            ('AccountService', get_symbol_table(external_references=[
+                get_external_reference('AccountSelector', lines=[(12, 9), (4, 20), (12, 9)], methods={'selectById': [(12, 30)], 'selectAll': []}),
+                get_external_reference('Util', variables={'LIMIT_SIZE': [(7, 5)]}),
+            ]), []),
+            ('AccountController', get_symbol_table(properties=['accounts'], external_references=[
+                get_external_reference('AccountSelector', methods={'selectById': [(3, 1)]}),
+            ]), [('AccountPage (Page)', '<apex:page>{!accounts}</apex:page>')]),
+        ]
+        return analysis.reduce_references(itertools.chain.from_iterable(map(analysis.map_class_references, class_inputs)))
+
+    def test_round_trip(self):
+        references_dict = self.get_references_dict()
+        string_table = analysis.StringTable(analysis.get_reference_strings(references_dict))
+
+        stored = dict(
+            (target, json.loads(analysis.dumps_references(analysis.encode_references(reference_object, string_table))))
+            for target, reference_object in references_dict.items()
+        )
+        strings = string_table.strings
+
+        # Names are positions in the string table, and locations are sorted and de-duplicated
+        selector = stored['AccountSelector']
+        self.assertEqual(selector['v'], analysis.REFERENCES_VERSION)
+        self.assertEqual(selector['classes'], [[strings.index('AccountService'), [[4, 20], [12, 9]]]])
+
+        self.assertEqual(analysis.decode_references(selector, strings), {
+            'visualforce': [],
+            'classes': {'AccountService': ['Line 4 Column 20', 'Line 12 Column 9']},
+            'methods': {
+                'selectById': {'AccountService': ['Line 12 Column 30'], 'AccountController': ['Line 3 Column 1']},
+                'selectAll': {'AccountService': []},
+            },
+            'variables': {},
+            'properties': {},
+        })
+        self.assertEqual(analysis.decode_references(stored['AccountController'], strings), {
+            'visualforce': ['AccountPage (Page)'],
+            'classes': {},
+            'methods': {},
+            'variables': {},
+            'properties': {'accounts': ['AccountPage (Page)']},
+        })
+        self.assertEqual(analysis.decode_references(stored['Util'], strings)['variables'], {'LIMIT_SIZE': {'AccountService': ['Line 7 Column 5']}})
+
+    def test_upgrade_legacy_references(self):
+        legacy = {
+            'visualforce': ['AccountPage (Page)'],
+            'classes': {'AccountService': ['Line 12 Column 9', 'Line 4 Column 20']},
+            'methods': {'selectById': {'AccountService': ['Line 12 Column 30']}},
+            'variables': {},
+            'properties': {'accounts': ['AccountPage (Page)']},
+        }
+
+        # Legacy references are passed through as they are, and any names not in the string table are added
+        string_table = analysis.StringTable(['AccountPage (Page)'])
+        self.assertIs(analysis.decode_references(legacy, string_table.strings), legacy)
+
+        upgraded = analysis.upgrade_references(legacy, string_table)
+        self.assertEqual(upgraded['v'], analysis.REFERENCES_VERSION)
+        self.assertEqual(string_table.strings, ['AccountPage (Page)', 'AccountService', 'selectById', 'accounts'])
+        self.assertIs(analysis.upgrade_references(upgraded, string_table), upgraded)
+
+        # Locations come back sorted
+        legacy['classes']['AccountService'].sort(key=analysis.parse_line_description)
+        self.assertEqual(analysis.decode_references(upgraded, string_table.strings), legacy)
+
+    def test_api_formats(self):
+        job = create_job(status='Finished')
+        ApexClass.objects.create(job=job, class_id='01p000000000001', name='AccountService', body='public class AccountService {}', symbol_table_json=get_symbol_table(
+            external_references=[get_external_reference('AccountSelector', lines=[(4, 20)])],
+        ))
+        ApexClass.objects.create(job=job, class_id='01p000000000002', name='AccountSelector', body='public class AccountSelector {}', symbol_table_json=get_symbol_table())
+
+        with override_settings(SCANNER_WORKERS=1):
+            ScanJob(job).process_external_references()
+
+        legacy = Client().get('/api/job/%s/' % job.slug).json()
+        compact = Client().get('/api/job/%s/?format=v2' % job.slug).json()
+
+        self.assertNotIn('strings', legacy)
+        self.assertEqual(legacy['classes'][0]['ReferencedBy']['classes'], {'AccountService': ['Line 4 Column 20']})
+
+        self.assertEqual(compact['format'], analysis.REFERENCES_VERSION)
+        self.assertEqual(compact['classes'][0]['ReferencedBy']['classes'], [[compact['strings'].index('AccountService'), [[4, 20]]]])
+        self.assertEqual(analysis.decode_references(compact['classes'][0]['ReferencedBy'], compact['strings']), legacy['classes'][0]['ReferencedBy'])
+
+
+class ApexClassBodyTests(TestCase):
+    """
+    Class bodies are served cached, conditionally, compressed and by line range
+    """
+
+    def setUp(self):
+        self.job = create_job(status='Finished')
+        self.body = ''.join('    System.debug(\'Line %d\');\n' % line for line in range(1, 101))
+        self.apex_class = ApexClass.objects.create(
+            job=self.job,
+            class_id='01p000000000001',
+            name='Logger',
+            body=self.body,
+            line_offsets=snippets.pack_line_offsets(snippets.get_line_offsets(self.body)),
+        )
+        self.url = '/apexclass/%d/' % self.apex_class.pk
+        self.client = Client()
+
+    def test_get_line_range(self):
+        self.assertIsNone(views.get_line_range(None))
+        self.assertIsNone(views.get_line_range(''))
+        self.assertEqual(views.get_line_range('10'), (10, 10))
+        self.assertEqual(views.get_line_range('10-40'), (10, 40))
+
+        for value in ['0', '0-5', '40-10', 'ten', '1-2-3']:
+            with self.assertRaises(ValueError, msg=value):
+                views.get_line_range(value)
+
+    def test_cached_and_conditional(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.content.decode('utf-8'), self.body)
+        self.assertRegex(response['ETag'], r'^"[0-9a-f]{40}"$')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+        # Cached for as long as the job is kept, which is a day by default
+        self.assertRegex(response['Cache-Control'], r'^private, max-age=\d+, immutable$')
+        self.assertAlmostEqual(int(response['Cache-Control'].split('=')[1].split(',')[0]), 24 * 60 * 60, delta=60)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"something-else"').status_code, 200)
+        self.assertEqual(self.client.get('/apexclass/%d/' % (self.apex_class.pk + 1)).status_code, 404)
+
+    def test_compressed(self):
+        identity_etag = self.client.get(self.url)['ETag']
+
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content).decode('utf-8'), self.body)
+        self.assertEqual(response['ETag'], identity_etag[:-1] + '-gzip"')
+        gzip_etag = response['ETag']
+
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip;q=0.5, deflate')
+        self.assertEqual(response['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.content).decode('utf-8'), self.body)
+
+        # The ETag is for the encoding, so a client that only has the plain body gets the compressed one
+        self.assertEqual(self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=identity_etag).status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=gzip_etag).status_code, 304)
+
+        self.assertNotIn('Content-Encoding', self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip;q=0, br'))
+
+    def test_line_range(self):
+        full_etag = self.client.get(self.url)['ETag']
+
+        response = self.client.get(self.url, {'lines': '10-12'})
+        self.assertEqual(response.content.decode('utf-8'), "    System.debug('Line 10');\n    System.debug('Line 11');\n    System.debug('Line 12');\n")
+        self.assertEqual(response['X-Line-Range'], '10-12/100')
+        self.assertEqual(response['ETag'], full_etag[:-1] + '-10-12"')
+        self.assertEqual(self.client.get(self.url, {'lines': '10-12'}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        # Ranges running past the end are cut short, and ranges past the end are empty
+        response = self.client.get(self.url, {'lines': '99-150'})
+        self.assertEqual(response.content.decode('utf-8'), "    System.debug('Line 99');\n    System.debug('Line 100');\n")
+        self.assertEqual(response['X-Line-Range'], '99-100/100')
+
+        response = self.client.get(self.url, {'lines': '101'})
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['X-Line-Range'], '*/100')
+
+        self.assertEqual(self.client.get(self.url, {'lines': '12-10'}).status_code, 400)
+
+    def test_line_range_without_index(self):
+        # Classes scanned before the line offsets were indexed
+        ApexClass.objects.filter(pk=self.apex_class.pk).update(line_offsets=None)
+
+        response = self.client.get(self.url, {'lines': '100'})
+        self.assertEqual(response.content.decode('utf-8'), "    System.debug('Line 100');\n")
+        self.assertEqual(response['X-Line-Range'], '100-100/100')
+
+
+class CallbackTests(TestCase):
+    """
+    Completion notices are signed, and only sent to public addresses
+    """
+
+    def setUp(self):
+        # Loaded back, as the callbacks are sent from a worker
+        self.job = Job.objects.get(pk=create_job(status='Finished', finished_date=timezone.now()).pk)
+
+    def get_callback(self, url='https://hooks.example.com/notify', **fields):
+        return JobCallback.objects.create(job=self.job, url=url, secret=fields.pop('secret', 'secret'), status='Sending', **fields)
+
+    def resolve_to(self, *addresses):
+        return mock.patch('socket.getaddrinfo', return_value=[(socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, 0)) for address in addresses])
+
+    def test_signature(self):
+        timestamp = str(int(time.time()))
+        body = b'{"event":"job.finished"}'
+        signature = callbacks.get_signature('secret', timestamp, body)
+
+        self.assertRegex(signature, r'^sha256=[0-9a-f]{64}$')
+        self.assertTrue(callbacks.verify_signature('secret', timestamp, body, signature))
+
+        self.assertFalse(callbacks.verify_signature('other secret', timestamp, body, signature))
+        self.assertFalse(callbacks.verify_signature('secret', timestamp, body + b' ', signature))
+        self.assertFalse(callbacks.verify_signature('secret', str(int(timestamp) + 1), body, signature))
+        self.assertFalse(callbacks.verify_signature('secret', None, body, signature))
+        self.assertFalse(callbacks.verify_signature('secret', timestamp, body, None))
+
+        # Old notices can't be replayed
+        timestamp = str(int(time.time()) - 600)
+        self.assertFalse(callbacks.verify_signature('secret', timestamp, body, callbacks.get_signature('secret', timestamp, body)))
+
+    @override_settings(SCANNER_CALLBACK_ALLOW_PRIVATE=False)
+    def test_only_public_addresses(self):
+        with self.resolve_to('93.184.216.34'):
+            self.assertEqual(callbacks.check_url('https://hooks.example.com/notify'), '93.184.216.34')
+
+        for address in ['10.0.0.5', '127.0.0.1', '169.254.169.254', '100.64.0.1', '0.0.0.0', '224.0.0.1', '::1', 'fe80::1%eth0', 'fd00::1', '::ffff:10.0.0.5']:
+            with self.resolve_to(address), self.assertRaises(callbacks.CallbackError, msg=address) as raised:
+                callbacks.check_url('https://hooks.example.com/notify')
+            self.assertFalse(raised.exception.retry)
+
+        # Every address has to be public, not just the first
+        with self.resolve_to('93.184.216.34', '10.0.0.5'), self.assertRaises(callbacks.CallbackError):
+            callbacks.check_url('https://hooks.example.com/notify')
+
+        # DNS failures might be temporary
+        with mock.patch('socket.getaddrinfo', side_effect=socket.gaierror('Name or service not known')):
+            with self.assertRaises(callbacks.CallbackError) as raised:
+                callbacks.check_url('https://hooks.example.com/notify')
+        self.assertTrue(raised.exception.retry)
+
+    @override_settings(SCANNER_CALLBACK_ALLOW_PRIVATE=False)
+    def test_sent_to_the_checked_address(self):
+        callback = self.get_callback('https://hooks.example.com:8443/notify?source=scanner')
+
+        # The host resolves somewhere else by the time requests would look it up
+        with self.resolve_to('93.184.216.34'), mock.patch('requests.adapters.HTTPAdapter.send', autospec=True, return_value=get_response()) as send:
+            callbacks.deliver(callback)
+
+        adapter, request = send.call_args[0][:2]
+        self.assertEqual(request.url, 'https://93.184.216.34:8443/notify?source=scanner')
+        self.assertEqual(request.headers['Host'], 'hooks.example.com:8443')
+
+        # The certificate is still checked against the host
+        self.assertIsInstance(adapter, callbacks.PinnedAddressAdapter)
+        self.assertEqual(adapter.host, 'hooks.example.com')
+
+        self.assertEqual(JobCallback.objects.get(pk=callback.pk).status, 'Delivered')
+
+    def test_pinned_connections_verify_the_host(self):
+        adapter = callbacks.PinnedAddressAdapter('hooks.example.com')
+        self.assertEqual(adapter.poolmanager.connection_pool_kw['server_hostname'], 'hooks.example.com')
+        self.assertEqual(adapter.poolmanager.connection_pool_kw['assert_hostname'], 'hooks.example.com')
+
+    def test_retries(self):
+        callback = self.get_callback()
+
+        for response, retry in [(get_response(503), True), (get_response(429), True), (requests.ConnectionError('refused'), True), (get_response(404), False), (get_response(302), False)]:
+            with mock.patch('codescanner.callbacks.check_url', return_value='93.184.216.34'), mock.patch('codescanner.callbacks.post', side_effect=[response]):
+                with self.assertRaises(callbacks.CallbackError) as raised:
+                    callbacks.deliver(callback)
+            self.assertEqual(raised.exception.retry, retry, response)
+
+        self.assertEqual(JobCallback.objects.get(pk=callback.pk).attempts, 5)
+
+    def test_receiver(self):
+        """
+        Send notices to the callback_receiver command, through a host name that only resolves to
+        it because the address is pinned
+        """
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+
+        output = io.StringIO()
+        receiver = threading.Thread(target=call_command, args=('callback_receiver',), kwargs={'port': port, 'secret': 'secret', 'count': 1, 'stdout': output}, daemon=True)
+        receiver.start()
+
+        url = 'http://hooks.example.test:%d/notify' % port
+        resolved = []
+        getaddrinfo = socket.getaddrinfo
+
+        def record_getaddrinfo(host, *args, **kwargs):
+            resolved.append(host)
+            return getaddrinfo(host, *args, **kwargs)
+
+        def deliver(callback):
+            # Wait for the receiver to start listening
+            for attempt in range(50):
+                try:
+                    return callbacks.deliver(callback)
+                except callbacks.CallbackError as ex:
+                    if not ex.retry:
+                        raise
+                    time.sleep(0.1)
+
+        try:
+            with mock.patch('codescanner.callbacks.check_url', return_value='127.0.0.1'), mock.patch('socket.getaddrinfo', side_effect=record_getaddrinfo):
+
+                # Signed with the wrong secret, so it's rejected
+                with self.assertRaisesRegex(callbacks.CallbackError, 'Receiver returned 401') as raised:
+                    deliver(self.get_callback(url, secret='wrong secret'))
+                self.assertFalse(raised.exception.retry)
+
+                callback = self.get_callback(url)
+                deliver(callback)
+        finally:
+            receiver.join(10)
+
+        self.assertFalse(receiver.is_alive())
+        self.assertNotIn('hooks.example.test', resolved)
+
+        callback.refresh_from_db()
+        self.assertEqual((callback.status, callback.attempts, callback.last_error), ('Delivered', 1, None))
+
+        output = output.getvalue()
+        self.assertIn('(signature INVALID)', output)
+        self.assertIn('(signature valid)', output)
+        self.assertIn('"id": "%s"' % self.job.slug, output)
+        self.assertIn('"event": "job.finished"', output)
+
+    @override_settings(SCANNER_CALLBACK_MAX_RETRIES=3, SCANNER_CALLBACK_RETRY_BACKOFF=30)
+    def test_stale_claims_are_released(self):
+        # The longest wait between retries is 4 minutes, so claims are stale after 8
+        lost = self.get_callback(attempts=1, attempted_date=timezone.now() - timedelta(minutes=9))
+        exhausted = self.get_callback(attempts=4, attempted_date=timezone.now() - timedelta(minutes=9))
+        recent = self.get_callback(attempts=1, attempted_date=timezone.now() - timedelta(minutes=7))
+
+        with mock.patch('codescanner.tasks.send_job_callbacks.delay') as send_job_callbacks:
+            tasks.requeue_stale_callbacks()
+
+        send_job_callbacks.assert_called_once_with(self.job.pk)
+        statuses = dict(JobCallback.objects.values_list('pk', 'status'))
+        self.assertEqual([statuses[lost.pk], statuses[exhausted.pk], statuses[recent.pk]], ['Pending', 'Failed', 'Sending'])
+
+        # And claimed again to be sent
+        self.assertEqual(callbacks.claim_callbacks(self.job.pk), [lost.pk])
+        self.assertGreater(JobCallback.objects.get(pk=lost.pk).attempted_date, timezone.now() - timedelta(minutes=1))
+
+
+class StronglyConnectedComponentsTests(TestCase):
+    """
+    Cycles are the strongly connected components of the reference graph, found with an iterative Tarjan's algorithm
+    """
+
+    def get_groups(self, adjacency):
+        component, component_count = graph.get_components(adjacency)
+        groups = [[] for _ in range(component_count)]
+        for node, node_component in enumerate(component):
+            groups[node_component].append(node)
+        return sorted(groups)
+
+    def get_reachable(self, adjacency, start):
+        reachable = {start}
+        frontier = [start]
+        while frontier:
+            node = frontier.pop()
+            for target in adjacency[node]:
+                if target not in reachable:
+                    reachable.add(target)
+                    frontier.append(target)
+        return reachable
+
+    def test_components(self):
+        # 0 -> 1 -> 2 -> 0 is a cycle, which uses the 3 <-> 4 cycle, and 5 is on its own
+        adjacency = [[1], [2], [0, 3], [4], [3], []]
+        self.assertEqual(self.get_groups(adjacency), [[0, 1, 2], [3, 4], [5]])
+
+        # Components are numbered dependencies first
+        component, component_count = graph.get_components(adjacency)
+        self.assertLess(component[3], component[0])
+
+    def test_matches_reachability(self):
+        generator = random.Random(45)
+
+        for size in [1, 5, 20, 60]:
+            adjacency = [generator.sample(range(size), generator.randint(0, min(size, 3))) for _ in range(size)]
+            reachable = [self.get_reachable(adjacency, node) for node in range(size)]
+
+            # Two nodes are in the same component if each can reach the other
+            expected = sorted(
+                sorted(node for node in range(size) if node in reachable[root] and root in reachable[node])
+                for root in range(size)
+                if min(node for node in range(size) if node in reachable[root] and root in reachable[node]) == root
+            )
+            self.assertEqual(self.get_groups(adjacency), expected)
+
+    def test_deep_graphs(self):
+        # Far deeper than the recursion limit
+        size = 100000
+        self.assertEqual(graph.get_components([[node + 1] for node in range(size - 1)] + [[0]]), ([0] * size, 1))
+
+        component, component_count = graph.get_components([[node + 1] for node in range(size - 1)] + [[]])
+        self.assertEqual(component_count, size)
+
+    def test_find_cycles(self):
+        names = ['A', 'B', 'C', 'D', 'E', 'F', 'G']
+        edges = [(0, 0), (0, 1), (1, 0), (2, 3), (3, 4), (4, 2), (5, 6)]
+
+        # Largest first, and a node using itself isn't a cycle
+        self.assertEqual(cycles.find_cycles(names, edges), [['C', 'D', 'E'], ['A', 'B']])
+
+    @override_settings(SCANNER_WORKERS=1)
+    def test_build_cycles(self):
+        job = create_job()
+
+        # AccountService.load calls AccountSelector.select, which calls back into AccountService.load.
+        # AccountController uses both, but nothing uses it
+        ApexClass.objects.create(job=job, class_id='01p000000000001', name='AccountService', body='-', symbol_table_json=get_symbol_table(
+            methods=[('load', 3), ('save', 20)],
+            external_references=[get_external_reference('AccountSelector', methods={'select': [(5, 9)]})],
+        ))
+        ApexClass.objects.create(job=job, class_id='01p000000000002', name='AccountSelector', body='-', symbol_table_json=get_symbol_table(
+            methods=[('select', 2)],
+            external_references=[get_external_reference('AccountService', methods={'load': [(8, 4)]})],
+        ))
+        ApexClass.objects.create(job=job, class_id='01p000000000003', name='AccountController', body='-', symbol_table_json=get_symbol_table(
+            methods=[('init', 2)],
+            external_references=[
+                get_external_reference('AccountService', methods={'save': [(4, 1)]}),
+                get_external_reference('AccountSelector', methods={'select': [(5, 1)]}),
+            ],
+        ))
+        ApexPageComponent.objects.create(job=job, sf_id='066000000000001', name='AccountPage', body='{!init}', controller='AccountController', type='Page')
+
+        ScanJob(job).process_external_references()
+
+        self.assertEqual(cycles.get_cycles(job), {
+            'classes': [['AccountSelector', 'AccountService']],
+            'members': [['AccountSelector.select', 'AccountService.load']],
+        })
+
+
+class DuplicatesTests(TestCase):
+    """
+    Near duplicate classes are found with MinHash signatures of their shingles, and LSH over the signatures
+    """
+
+    def get_body(self, seed, length=400):
+        generator = random.Random(seed)
+        words = ['Account', 'insert', 'update', 'for', 'if', 'List', 'String', 'return', 'null', 'size', 'Map', 'Id']
+        return '\n'.join(
+            '    %s %s%d = %s(%d);' % (generator.choice(words), generator.choice(words).lower(), generator.randint(0, 50), generator.choice(words), generator.randint(0, 9))
+            for _ in range(length // 8)
+        )
+
+    def get_signature(self, body):
+        return analysis.map_class_minhash(('Class', body))[0]
+
+    def test_tokens(self):
+        self.assertEqual(
+            analysis.get_apex_tokens("Integer  count = 1; // Counts\n/* Block\n comment */ String s = 'It\\'s';"),
+            ['integer', 'count', '=', '1', ';', 'string', 's', '=', "'it\\'s'", ';'],
+        )
+
+    def test_formatting_is_ignored(self):
+        body = self.get_body(1)
+        reformatted = '// Copied from elsewhere\n' + body.upper().replace(' ', '   ').replace(';', ' ;\n')
+        self.assertEqual(self.get_signature(body)[2], self.get_signature(reformatted)[2])
+
+    def test_signature_estimates_similarity(self):
+        body = self.get_body(2)
+        lines = body.split('\n')
+
+        for changed in [2, 10, 25]:
+            edited = '\n'.join(line if number % (len(lines) // changed) else self.get_body(number + 100, 8) for number, line in enumerate(lines))
+
+            first = self.get_signature(body)
+            second = self.get_signature(edited)
+
+            shingles = set(first[3]), set(second[3])
+            similarity = len(shingles[0] & shingles[1]) / float(len(shingles[0] | shingles[1]))
+            estimate = sum(1 for first_value, second_value in zip(first[2], second[2]) if first_value == second_value) / float(analysis.MINHASH_SIZE)
+
+            self.assertAlmostEqual(estimate, similarity, delta=0.12, msg=changed)
+
+    def test_signatures_match_across_processes(self):
+        class_inputs = [('Class%d' % number, self.get_body(number)) for number in range(6)]
+
+        with executor.ProcessPoolExecutor(2) as pool:
+            pooled = list(executor.flat_map(pool, analysis.map_class_minhash, class_inputs, chunksize=1))
+
+        self.assertEqual([signature[2] for signature in pooled], [self.get_signature(body)[2] for name, body in class_inputs])
+
+    def test_short_classes(self):
+        self.assertEqual(analysis.map_class_minhash(('Empty', 'class A {')), [])
+
+        # Fewer shingles than bins still gives a full signature
+        self.assertEqual(len(self.get_signature('public class Tiny { Integer x = 1; }')[2]), analysis.MINHASH_SIZE)
+
+    def test_candidates(self):
+        body = self.get_body(3)
+        signatures = [
+            ('Original', 0, self.get_signature(body)[2], ()),
+            ('Copy', 0, self.get_signature(body.replace('= Map(', '= List(', 1))[2], ()),
+            ('Other', 0, self.get_signature(self.get_body(4))[2], ()),
+        ]
+        self.assertEqual(duplicates.get_candidates(signatures), {(0, 1)})
+
+    def test_groups(self):
+        pairs = [('A', 'B', 0.9, 100, 100), ('C', 'D', 0.9, 100, 100), ('B', 'E', 0.85, 100, 100), ('F', 'G', 0.8, 100, 100), ('G', 'H', 0.8, 100, 100)]
+        self.assertEqual(duplicates.get_groups(pairs), [['A', 'B', 'E'], ['F', 'G', 'H'], ['C', 'D']])
+
+    @override_settings(SCANNER_WORKERS=1, SCANNER_DUPLICATE_THRESHOLD=0.8, SCANNER_DUPLICATE_MIN_TOKENS=50)
+    def test_build_duplicates(self):
+        job = create_job()
+        body = self.get_body(5)
+
+        for name, class_body in [
+            ('AccountService', body),
+            ('AccountServiceCopy', '// Copy\n' + body.replace('= Map(', '= List(', 1)),
+            ('ContactService', self.get_body(6)),
+            ('Tiny', 'public class Tiny {}'),
+        ]:
+            ApexClass.objects.create(job=job, class_id='01p000000000001', name=name, body=class_body)
+
+        duplicates.build_duplicates(job)
+        report = duplicates.get_duplicates(job)
+
+        # The tiny class is too short to compare
+        self.assertEqual(report['classes'], 3)
+        self.assertEqual(report['pairCount'], 1)
+        self.assertEqual(report['pairs'][0][:2], ['AccountService', 'AccountServiceCopy'])
+        self.assertGreater(report['pairs'][0][2], 0.9)
+        self.assertEqual(report['groups'], [['AccountService', 'AccountServiceCopy']])
+
+
+class UsageTests(TestCase):
+    """
+    Everything a page, component or class uses is found by a single pattern over its body
+    """
+
+    def get_usages(self, map_usage, body):
+        return [(vf_type, name) for caller, vf_type, name in map_usage(('Caller', body))]
+
+    def test_visualforce_usage(self):
+        body = """
+            <apex:page controller="AccountController">
+                <c:AccountHeader title="Accounts"/>
+                <C:AccountFooter />
+                <apex:outputLink value="{!URLFOR($Page.AccountDetail)}">Detail</apex:outputLink>
+                <a href="/apex/AccountEdit?id={!account.Id}">Edit</a>
+                <apex:include pageName="AccountSidebar"/>
+                <apex:composition template='AccountLayout'>
+                <!-- <c:OldHeader/> and $Page.OldDetail are no longer used -->
+                <apex:commandButton action="{!save}" value="Save"/>
+            </apex:page>
+        """
+        self.assertEqual(self.get_usages(analysis.map_visualforce_usage, body), [
+            ('Component', 'accountfooter'),
+            ('Component', 'accountheader'),
+            ('Page', 'accountdetail'),
+            ('Page', 'accountedit'),
+            ('Page', 'accountlayout'),
+            ('Page', 'accountsidebar'),
+        ])
+
+    def test_class_usage(self):
+        body = """
+            public class AccountController {
+                // return Page.OldDetail;
+                /* Component.c.OldHeader
+                   and Page.OldEdit */
+                public PageReference view() {
+                    return Page.AccountDetail;
+                }
+                public PageReference edit() {
+                    return new PageReference('/apex/AccountEdit?retURL=' + EncodingUtil.urlEncode('https://example.com/apex/AccountList', 'UTF-8'));
+                }
+                public Component.Apex.OutputPanel getPanel() {
+                    Object header = new Component.c.AccountHeader();
+                    String label = 'See page.AccountHelp // not code';
+                    String quoted = 'It\\'s Page.Quoted';
+                    return null;
+                }
+            }
+        """
+        self.assertEqual(self.get_usages(analysis.map_class_usage, body), [
+            ('Component', 'accountheader'),
+            ('Page', 'accountdetail'),
+            ('Page', 'accountedit'),
+            ('Page', 'accountlist'),
+        ])
+
+    def test_empty_bodies(self):
+        self.assertEqual(analysis.map_visualforce_usage(('Page', None)), [])
+        self.assertEqual(analysis.map_class_usage(('Class', '')), [])
+
+    @override_settings(SCANNER_WORKERS=1)
+    def test_build_usage(self):
+        job = create_job()
+
+        for name, vf_type, body in [
+            ('AccountDetail', 'Page', '<apex:page><c:AccountHeader/><a href="/apex/AccountDetail">Reload</a></apex:page>'),
+            ('AccountList', 'Page', '<apex:page><a href="{!URLFOR($Page.AccountDetail)}">Detail</a></apex:page>'),
+            ('AccountHeader', 'Component', '<apex:component>Header</apex:component>'),
+            ('Unused', 'Page', '<apex:page><a href="/apex/Missing">Missing</a></apex:page>'),
+        ]:
+            ApexPageComponent.objects.create(job=job, sf_id='066000000000001', name=name, type=vf_type, body=body)
+
+        ApexClass.objects.create(job=job, class_id='01p000000000001', name='AccountController', body='public class AccountController { PageReference p = Page.AccountList; }')
+
+        self.assertFalse(usage.is_built(job))
+        self.assertEqual(usage.build_usage(job), 3)
+        self.assertTrue(usage.is_built(job))
+
+        used_by = {vf['Name']: vf['ReferencedBy'] for vf in usage.get_visualforce(job)}
+
+        # A page linking to itself doesn't count as a use, and pages not in the Org are ignored
+        self.assertEqual(used_by, {
+            'AccountDetail': {'visualforce': ['AccountList (Page)'], 'classes': []},
+            'AccountHeader': {'visualforce': ['AccountDetail (Page)'], 'classes': []},
+            'AccountList': {'visualforce': [], 'classes': ['AccountController']},
+            'Unused': {'visualforce': [], 'classes': []},
+        })
+        self.assertEqual([vf['Name'] for vf in usage.get_visualforce(job, unused_only=True)], ['Unused'])
+
+
+class JSONTextFieldTests(TestCase):
+    """
+    SymbolTables and references are JSONB on Postgres, and compressed elsewhere with containment checked in Python
+    """
+
+    def test_json_contains(self):
+        document = {
+            'name': 'AccountService',
+            'methods': [{'name': 'run', 'parameters': ['Id']}, {'name': 'stop', 'parameters': []}],
+            'classes': [[0, [1, 2]], [3, [4]]],
+            'count': 2,
+        }
+
+        for value, expected in [
+            ({}, True),
+            ({'name': 'AccountService'}, True),
+            ({'name': 'accountservice'}, False),
+            ({'methods': [{'name': 'run'}]}, True),
+            ({'methods': [{'name': 'stop'}, {'name': 'run'}]}, True),
+            ({'methods': [{'name': 'run', 'parameters': []}]}, True),
+            ({'methods': [{'name': 'missing'}]}, False),
+            ({'methods': {'name': 'run'}}, False),
+            ({'classes': [[3]]}, True),
+            ({'classes': [[0, [2]]]}, True),
+            ({'classes': [[1]]}, False),
+            ({'count': 2}, True),
+            ({'count': '2'}, False),
+            ({'missing': None}, False),
+        ]:
+            self.assertEqual(json_contains(document, value), expected, value)
+
+        # An array contains a scalar only as an item of an array, and a scalar doesn't contain an array
+        self.assertFalse(json_contains([1, 2], 1))
+        self.assertFalse(json_contains(1, [1]))
+
+    def test_stored_compressed(self):
+        job = create_job()
+        symbol_table = json.dumps({'name': 'AccountService', 'methods': [{'name': 'run%d' % number} for number in range(200)]})
+        ApexClass.objects.create(job=job, class_id='01p000000000001', name='AccountService', body='public class AccountService {}', symbol_table_json=symbol_table)
+
+        stored = ApexClass.objects.values_list('symbol_table_json', flat=True).get()
+        self.assertEqual(stored.format, FORMAT_ZLIB)
+        self.assertEqual(decompress(stored), symbol_table)
+        self.assertEqual(ApexClass.objects.get().symbol_table_json, symbol_table)
+
+    def test_lookup_only_on_postgres(self):
+        with self.assertRaises(NotSupportedError):
+            list(ApexClass.objects.filter(symbol_table_json__json_contains={'name': 'AccountService'}))
+
+    @override_settings(SCANNER_QUERY_CHUNK_SIZE=2)
+    def test_iter_json_contains(self):
+        job = create_job()
+        for number in range(7):
+            ApexClass.objects.create(
+                job=job, class_id='01p000000000001', name='Class%d' % number, body='public class Class%d {}' % number,
+                symbol_table_json=json.dumps({
+                    'methods': [{'name': 'run'}] if number % 2 else [],
+                    'innerClasses': [{'methods': [{'name': 'run'}]}] if number == 4 else [],
+                }) if number != 6 else None,
+            )
+
+        self.assertEqual(
+            list(iter_json_contains(job.classes(), 'symbol_table_json', [{'methods': [{'name': 'run'}]}], ['name'])),
+            [('Class1',), ('Class3',), ('Class5',)],
+        )
+        self.assertEqual(
+            [name for name, in queries.get_declaring_classes(job, 'run')],
+            ['Class1', 'Class3', 'Class4', 'Class5'],
+        )
+        self.assertEqual(list(queries.get_declaring_classes(job, 'run', kind='property')), [])
+
+
+class JSONStorageMigrationTests(MigrationTestCase):
+    """
+    0030 copies the SymbolTables and references into their JSON columns, in batches
+    """
+
+    def test_copy_and_back(self):
+        apps = self.migrate('0029_lightningcomponent')
+        Job = apps.get_model('codescanner', 'Job')
+        ApexClass = apps.get_model('codescanner', 'ApexClass')
+        ApexTrigger = apps.get_model('codescanner', 'ApexTrigger')
+
+        job = Job.objects.create(org_id='00D000000000001', access_token='token', instance_url='https://example.my.salesforce.com')
+
+        # More than a batch of rows, some without SymbolTables or references
+        classes = dict(
+            (
+                'Class%03d' % number,
+                (
+                    json.dumps({'methods': [{'name': 'run%d' % number}], 'name': 'Ünïcödé'}) if number % 3 else None,
+                    json.dumps({'classes': [[number, [[1, 1]]]]}) if number % 4 else None,
+                )
+            )
+            for number in range(450)
+        )
+        for name, (symbol_table_json, referenced_by_json) in classes.items():
+            ApexClass.objects.create(job=job, class_id='01p000000000001', name=name, body='public class %s {}' % name, symbol_table_json=symbol_table_json, referenced_by_json=referenced_by_json)
+
+        triggers = dict(
+            ('Trigger%03d' % number, json.dumps({'name': 'Trigger%03d' % number}) if number % 5 else None)
+            for number in range(250)
+        )
+        for name, symbol_table_json in triggers.items():
+            ApexTrigger.objects.create(job=job, trigger_id='01q000000000001', name=name, body='trigger %s on Account (before insert) {}' % name, symbol_table_json=symbol_table_json)
+
+        apps = self.migrate('0030_json_storage')
+        ApexClass = apps.get_model('codescanner', 'ApexClass')
+        ApexTrigger = apps.get_model('codescanner', 'ApexTrigger')
+
+        copied = dict(
+            (name, (symbol_table_json and decompress(symbol_table_json), referenced_by_json and decompress(referenced_by_json)))
+            for name, symbol_table_json, referenced_by_json in ApexClass.objects.values_list('name', 'symbol_table_json', 'referenced_by_json')
+        )
+        self.assertEqual(copied, classes)
+        self.assertEqual(
+            dict((name, symbol_table_json and decompress(symbol_table_json)) for name, symbol_table_json in ApexTrigger.objects.values_list('name', 'symbol_table_json')),
+            triggers,
+        )
+
+        apps = self.migrate('0029_lightningcomponent')
+        ApexClass = apps.get_model('codescanner', 'ApexClass')
+        ApexTrigger = apps.get_model('codescanner', 'ApexTrigger')
+
+        restored = dict(
+            (name, (symbol_table_json and decompress(symbol_table_json), referenced_by_json and decompress(referenced_by_json)))
+            for name, symbol_table_json, referenced_by_json in ApexClass.objects.values_list('name', 'symbol_table_json', 'referenced_by_json')
+        )
+        self.assertEqual(restored, classes)
+        self.assertEqual(
+            dict((name, symbol_table_json and decompress(symbol_table_json)) for name, symbol_table_json in ApexTrigger.objects.values_list('name', 'symbol_table_json')),
+            triggers,
+        )
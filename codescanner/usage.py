@@ -0,0 +1,123 @@
+"""
+Usage of the Visualforce pages and components in a job.
+
+The references only say which classes a page uses. To find the pages and components nothing
+uses, every page, component and class body is read once (sharded across the scan executor),
+and everything it uses is pulled out by a single pattern (see analysis.map_visualforce_usage
+and analysis.map_class_usage):
+
+    - <c:Name> tags use a component, as does Component.c.Name in Apex
+    - $Page.Name (eg. in URLFOR), apex:include pageName, apex:composition template and
+      /apex/Name links use a page, as does Page.Name in Apex
+
+The usages are then matched to the pages and components in the job by name, in a single
+dict lookup each, rather than searching every body for every name. Each page and component
+has the pages, components and classes that use it stored against it.
+
+Pages can also be used from outside of code (tabs, buttons, Sites and so on), which isn't
+part of the scan, so pages listed as unused should be checked before they're deleted.
+"""
+
+from django.conf import settings
+from django.db import transaction
+
+from .fields import decompress
+from .models import ApexPageComponent
+from . import analysis
+from . import executor
+
+import json
+
+
+def get_vf_name(name, vf_type):
+    return '%s (%s)' % (name, vf_type)
+
+
+def build_usage(job):
+    """
+    Find and store what uses each page and component in a job
+    """
+
+    # The pages and components in the job, by type and lower cased name
+    targets = {}
+    used_by = {}
+
+    for vf_id, name, vf_type in job.visualforce().values_list('id', 'name', 'type'):
+        targets[(vf_type, name.lower())] = (vf_id, get_vf_name(name, vf_type))
+        used_by[vf_id] = {'visualforce': set(), 'classes': set()}
+
+    if not targets:
+        return 0
+
+    chunk_size = settings.SCANNER_QUERY_CHUNK_SIZE
+
+    visualforce_inputs = (
+        (get_vf_name(name, vf_type), decompress(body))
+        for name, vf_type, body in job.visualforce().values_list('name', 'type', 'body').iterator(chunk_size=chunk_size)
+    )
+    class_inputs = (
+        (name, decompress(body))
+        for name, body in job.classes().values_list('name', 'body').iterator(chunk_size=chunk_size)
+    )
+
+    with executor.get_executor(len(targets) + job.apexclass_set.count()) as pool:
+        for caller_type, map_usage, inputs in [('visualforce', analysis.map_visualforce_usage, visualforce_inputs), ('classes', analysis.map_class_usage, class_inputs)]:
+            for caller, vf_type, name in executor.flat_map_batched(pool, map_usage, inputs, chunk_size):
+
+                target = targets.get((vf_type, name))
+
+                # Anything not in the Org is ignored, as is a page linking to itself
+                if target and target[1] != caller:
+                    used_by[target[0]][caller_type].add(caller)
+
+    empty_usage = json.dumps({'visualforce': [], 'classes': []})
+
+    # Everything is cleared first, then only the pages and components that are used are written
+    used = 0
+    with transaction.atomic():
+        job.apexpagecomponent_set.update(is_referenced_externally=False, referenced_by_json=empty_usage)
+
+        for vf_id, callers in used_by.items():
+            if callers['visualforce'] or callers['classes']:
+                ApexPageComponent.objects.filter(pk=vf_id).update(
+                    is_referenced_externally=True,
+                    referenced_by_json=json.dumps({
+                        'visualforce': sorted(callers['visualforce']),
+                        'classes': sorted(callers['classes']),
+                    }),
+                )
+                used += 1
+
+    return used
+
+
+def is_built(job):
+    """
+    Whether the usage of the pages and components in a job has been found. Jobs scanned before
+    usage was indexed have it built on a worker (see backfill.py)
+    """
+    return not job.apexpagecomponent_set.filter(referenced_by_json__isnull=True).exists()
+
+
+def get_visualforce(job, unused_only=False):
+    """
+    Get the pages and components in a job, with what uses each of them
+    """
+    visualforce = job.visualforce()
+    if unused_only:
+        visualforce = visualforce.filter(is_referenced_externally=False)
+
+    rows = visualforce.values_list('id', 'sf_id', 'name', 'type', 'controller', 'is_referenced_externally', 'referenced_by_json')
+
+    return [
+        {
+            'DatabaseId': vf_id,
+            'Id': sf_id,
+            'Name': name,
+            'Type': vf_type,
+            'Controller': controller,
+            'IsReferenced': is_referenced,
+            'ReferencedBy': json.loads(decompress(referenced_by_json)) if referenced_by_json else None,
+        }
+        for vf_id, sf_id, name, vf_type, controller, is_referenced, referenced_by_json in rows.iterator(chunk_size=settings.SCANNER_QUERY_CHUNK_SIZE)
+    ]
@@ -50,6 +50,24 @@ def get_user_with_no_id(instance_url, access_token):
     return result.json()
 
 
+def get_org_id(instance_url, access_token):
+    """
+    Get the Id of the Org an access token is for, so API jobs can be matched to other jobs for the Org.
+    Returns None if the Org couldn't be queried
+    """
+    url = '%s%squery/' % (instance_url, REST_URL)
+    try:
+        result = requests.get(
+            url,
+            headers=get_headers(access_token),
+            params={'q': 'SELECT Id FROM Organization'},
+            timeout=settings.SALESFORCE_WEB_REQUEST_TIMEOUT
+        )
+        return result.json()['records'][0]['Id']
+    except Exception:
+        return None
+
+
 def send_finished_email(job):
     """
     Send email notifying of finished job
@@ -5,23 +5,179 @@ from django.shortcuts import render, get_object_or_404
 from django.views.generic.base import TemplateView
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import FormView, CreateView
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.conf import settings
 from django.views import View
 from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.utils import timezone
+from django.utils.http import parse_etags
+from django.db.models import Count, Q
 
 from . import models
 from . import forms
 from . import utils
-from .tasks import scan_code
-
+from . import scheduler
+from . import analysis
+from . import snippets
+from . import snapshots
+from . import symbols
+from . import callbacks
+from . import exports
+from . import graph
+from . import cycles
+from . import duplicates
+from . import usage
+from . import queries
+from . import backfill
+from .fields import CompressedData, FORMAT_ZLIB
+
+import collections
 import requests
 import urllib
+import hashlib
 import json
 import traceback
 
+
+def get_line_range(value):
+    """
+    Parse a line range parameter (eg. 10-40, or 10 for a single line) into a (start, end) tuple.
+    Returns None if there's no range, and raises ValueError if it's not valid
+    """
+    if not value:
+        return None
+
+    start, _, end = value.partition('-')
+    start = int(start)
+    end = int(end) if end else start
+
+    if start < 1 or end < start:
+        raise ValueError('Invalid line range %s' % value)
+
+    return (start, end)
+
+
+def get_status_data(job):
+    """
+    Build the status response for a job, from a dict of its STATUS_FIELDS
+    """
+    return {
+        'status': job['status'],
+        'done': job['status'] in ['Finished', 'Error'],
+        'success': job['status'] == 'Finished',
+        'phase': job['phase'],
+        'progress': job['progress'],
+        'error': job['error'],
+        'apiCalls': job['api_calls'],
+    }
+
+
+def get_building_response():
+    """
+    The response for results that are still being built. The client should try again shortly
+    """
+    response = JsonResponse({
+        'building': True,
+        'message': 'The results for this job are still being built. Please try again in a few seconds.',
+    }, status=202)
+    response['Retry-After'] = '5'
+    return response
+
+
+def get_pending_response(job, result):
+    """
+    The response for a result that hasn't been built for a job. Finished jobs scanned before the
+    result existed have it built on a worker (see backfill.py)
+    """
+    if job.status != 'Finished':
+        return JsonResponse({'error': 'The job has not finished'}, status=409)
+
+    backfill.request_build(job, result)
+    return get_building_response()
+
+
+def get_accepted_encodings(header):
+    """
+    Parse an Accept-Encoding header into a dict of content coding => quality (0 to 1), eg.
+    "gzip;q=0.5, deflate" is {'gzip': 0.5, 'deflate': 1.0}. A quality of 0 means not acceptable
+    """
+    encodings = {}
+
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    quality = 0.0
+
+        encodings[coding] = quality
+
+    return encodings
+
+
+def get_response_encoding(request, encodings=('gzip', 'deflate')):
+    """
+    Pick the encoding the client most prefers out of the given ones, with gzip first on a tie.
+    Returns None if the client accepts none of them
+    """
+    accepted = get_accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+
+    best_encoding = None
+    best_quality = 0.0
+
+    for encoding in encodings:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best_encoding = encoding
+            best_quality = quality
+
+    return best_encoding
+
+
+def get_compressed_response(request, data, content_type, etag=None):
+    """
+    Build a response for stored CompressedData (or text).
+    The stored zlib stream is sent as-is to clients accepting deflate, re-wrapped for clients
+    accepting gzip, and decompressed for anyone else.
+    If an ETag is given, it's made specific to the encoding, and a 304 is returned if the client already has it
+    """
+    encoding = None
+    if isinstance(data, CompressedData) and data.format == FORMAT_ZLIB:
+        encoding = get_response_encoding(request)
+
+    if etag:
+        etag = '"%s%s"' % (etag, '-' + encoding if encoding else '')
+
+    if etag and etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    elif encoding == 'gzip':
+        response = HttpResponse(data.get_gzip_stream(), content_type=content_type)
+    elif encoding == 'deflate':
+        response = HttpResponse(data.get_zlib_stream(), content_type=content_type)
+    else:
+        response = HttpResponse(data.text if isinstance(data, CompressedData) else data, content_type=content_type)
+
+    if encoding and response.status_code == 200:
+        response['Content-Encoding'] = encoding
+    if etag:
+        response['ETag'] = etag
+    response['Vary'] = 'Accept-Encoding'
+
+    return response
+
+
 class IndexView(FormView):
     """
     Home page
@@ -139,7 +295,7 @@ class JobProcessingView(DetailView):
     """
     The loading page to display while the job processes
     """
-    model = models.Job
+    queryset = models.Job.objects.without_results()
     template_name = 'scanning.html'
 
     def get(self, request, *args, **kwargs):
@@ -147,8 +303,10 @@ class JobProcessingView(DetailView):
         # Start the job if it hasn't already been started
         job = self.get_object()
         if job.status == 'Not Started':
-            # Run the job
-            scan_code.delay(job.id)
+            # Queue the job to run. If the Org is already being scanned, follow that job instead
+            scheduled_job = scheduler.schedule_job(job)
+            if scheduled_job.pk != job.pk:
+                return HttpResponseRedirect(reverse('job-scanning', kwargs={'slug': scheduled_job.slug}))
 
         return super(JobProcessingView, self).get(request, *args, **kwargs)
 
@@ -162,24 +320,74 @@ class JobStatusView(View):
         """
         Return the status of the Job in JSON
         """
-        job = get_object_or_404(models.Job, slug=self.kwargs.get('slug'))
+        job = models.Job.objects.filter(slug=self.kwargs.get('slug')).values(*models.Job.STATUS_FIELDS).first()
+        if not job:
+            raise Http404
+
+        return JsonResponse(get_status_data(job))
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class JobStatusBatchView(View):
+    """
+    Return the status of many jobs in one call, from a single query.
+    Takes the job ids as ?ids=<job id>,<job id> or, for long lists, a POST of {"ids": [...]}
+    """
+
+    def get(self, request, *args, **kwargs):
+        return self.get_statuses(request.GET.get('ids', '').split(','))
+
+    def post(self, request, *args, **kwargs):
+        try:
+            slugs = json.loads(request.body).get('ids')
+        except (ValueError, AttributeError):
+            return HttpResponseBadRequest('Send a JSON object with a list of ids')
+
+        if not isinstance(slugs, list):
+            return HttpResponseBadRequest('ids should be a list of job ids')
+
+        return self.get_statuses(slugs)
+
+    def get_statuses(self, slugs):
+
+        # Drop any blanks and duplicates, keeping the order
+        slugs = list(collections.OrderedDict.fromkeys(str(slug).strip() for slug in slugs if str(slug).strip()))
+
+        if not slugs:
+            return HttpResponseBadRequest('ids is required')
+
+        if len(slugs) > settings.SCANNER_STATUS_BATCH_LIMIT:
+            return HttpResponseBadRequest('No more than %d ids can be checked at once' % settings.SCANNER_STATUS_BATCH_LIMIT)
+
+        jobs = {
+            job['slug']: get_status_data(job)
+            for job in models.Job.objects.filter(slug__in=slugs).values(*models.Job.STATUS_FIELDS)
+        }
 
         return JsonResponse({
-            'status': job.status,
-            'done': job.status in ['Finished', 'Error'],
-            'success': job.status == 'Finished',
-            'error': job.error
+            'jobs': jobs,
+            'missing': [slug for slug in slugs if slug not in jobs],
         })
 
 
 
+class SchedulerMetricsView(View):
+    """
+    Return the queue depth and wait times for the job queues
+    """
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({'queues': scheduler.get_metrics()})
+
+
+
 class JobView(DetailView):
     """
     The job to display
     """ 
 
     context_object_name = 'job'
-    model = models.Job
+    queryset = models.Job.objects.without_results()
     template_name = 'job.html'
 
     # If the job hasn't started or is processing, display the loading page
@@ -188,7 +396,7 @@ class JobView(DetailView):
         job = self.get_object()
 
         # If not started or processing, go to the processing page
-        if job.status in ['Not Started', 'Processing']:
+        if job.status in ['Not Started', 'Queued', 'Processing']:
             return HttpResponseRedirect(reverse('job-scanning', kwargs={'slug': job.slug}))
 
         # Else return the job
@@ -205,41 +413,501 @@ class JobJsonView(View):
         """
         Return the status of the Job in JSON
         """
-        job = get_object_or_404(models.Job, slug=self.kwargs.get('slug'))
+        job = get_object_or_404(models.Job.objects.without_results('reference_strings_json'), slug=self.kwargs.get('slug'))
+
+        # The compact format refers to names by their position in the job's string table
+        compact = self.request.GET.get('format') == 'v2'
+        string_table = analysis.StringTable(job.get_reference_strings())
 
         classes = []
 
-        for apex_class in job.classes():
+        # The class bodies aren't part of the response, so don't load them
+        class_fields = ['id', 'class_id', 'name', 'is_referenced_externally', 'symbol_table_json', 'referenced_by_json']
+
+        for apex_class in job.iter_classes(*class_fields):
+
+            references = json.loads(apex_class.referenced_by_json) if apex_class.referenced_by_json else None
+            if compact:
+                references = analysis.upgrade_references(references, string_table)
+            else:
+                references = analysis.decode_references(references, string_table.strings)
+
             classes.append({
                 'DatabaseId': apex_class.id,
                 'ApexClassId': apex_class.class_id,
                 'Name': apex_class.name,
                 'IsReferenced': apex_class.is_referenced_externally,
                 'SymbolTable': json.loads(apex_class.symbol_table_json) if apex_class.symbol_table_json else None,
-                'ReferencedBy': json.loads(apex_class.referenced_by_json) if apex_class.referenced_by_json else None,
+                'ReferencedBy': references,
             })
 
-        return JsonResponse(
-            {
-                'id': job.slug,
-                'username': job.username,
-                'instanceUrl': job.instance_url,
-                'status': job.status,
-                'error': job.error,
-                'classes': classes
-            }, 
-            safe=False
+        result = {
+            'id': job.slug,
+            'username': job.username,
+            'instanceUrl': job.instance_url,
+            'status': job.status,
+            'error': job.error,
+            'classes': classes,
+            # Triggers are only ever callers, so have no references of their own
+            'triggers': [
+                {'DatabaseId': trigger_id, 'ApexTriggerId': sf_id, 'Name': name, 'Object': object_name}
+                for trigger_id, sf_id, name, object_name in job.triggers().values_list('id', 'trigger_id', 'name', 'object_name')
+            ],
+            # The Aura and LWC bundles, with the Apex each of them uses
+            'lightning': [
+                {'DatabaseId': component_id, 'BundleId': bundle_id, 'Name': name, 'Type': bundle_type, 'Controller': controller, 'ApexMethods': json.loads(apex_methods_json.text) if apex_methods_json else []}
+                for component_id, bundle_id, name, bundle_type, controller, apex_methods_json in job.lightning().values_list('id', 'bundle_id', 'name', 'type', 'controller', 'apex_methods_json')
+            ],
+            # The pages and components, with what uses each of them
+            'visualforce': [],
+        }
+
+        # Jobs scanned before usage was indexed have it built on a worker, and null until then
+        if job.status == 'Finished':
+            if usage.is_built(job):
+                result['visualforce'] = usage.get_visualforce(job)
+            else:
+                backfill.request_build(job, 'usage')
+                result['visualforce'] = None
+
+        if compact:
+            result['format'] = analysis.REFERENCES_VERSION
+            result['strings'] = string_table.strings
+
+        return JsonResponse(result, safe=False)
+
+
+class JobTreeView(View):
+    """
+    Return a page of the classes for a job, with a count of each type of reference.
+    Used to draw the top level of the results tree, with each class's references only
+    loaded (from the class references view) when it's expanded
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        job = get_object_or_404(models.Job.objects.without_results(), slug=self.kwargs.get('slug'))
+
+        try:
+            offset = max(int(request.GET.get('offset', 0)), 0)
+        except ValueError:
+            offset = 0
+        limit = settings.SCANNER_TREE_PAGE_SIZE
+
+        count_fields = ['%s_count' % reference_type for reference_type in analysis.REFERENCE_TYPES]
+
+        # Fetch one extra row to tell if there is another page
+        rows = list(job.classes().values_list('id', 'class_id', 'name', 'is_referenced_externally', *count_fields)[offset:offset + limit + 1])
+
+        classes = []
+        for row in rows[:limit]:
+            classes.append({
+                'DatabaseId': row[0],
+                'ApexClassId': row[1],
+                'Name': row[2],
+                'IsReferenced': row[3],
+                'Counts': dict(zip(analysis.REFERENCE_TYPES, row[4:])),
+            })
+
+        return JsonResponse({
+            'id': job.slug,
+            'status': job.status,
+            'classes': classes,
+            # Offset for the next page, or None if this is the last
+            'next': offset + limit if len(rows) > limit else None,
+        })
+
+
+class ApexClassBodyView(View):
+    """
+    Retrieve the ApexClass body.
+    Bodies never change once scanned, so can be cached by the browser for as long as the job is kept.
+    Pass ?lines=start-end (1 based and inclusive) to only get those lines
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        # Load only the stored body, without decompressing it
+        rows = models.ApexClass.objects.filter(pk=self.kwargs.get('pk')).values_list('body', 'line_offsets', 'job__created_date')
+        if not rows:
+            raise Http404
+        body, line_offsets, created_date = rows[0]
+
+        try:
+            line_range = get_line_range(request.GET.get('lines'))
+        except ValueError:
+            return HttpResponseBadRequest('lines should be a line number or range of line numbers, eg. 10-40')
+
+        etag = hashlib.sha1(body).hexdigest()
+
+        if line_range:
+            start, end = line_range
+            text = body.text
+            offsets = snippets.unpack_line_offsets(line_offsets) if line_offsets else snippets.get_line_offsets(text)
+            body = snippets.get_line_slice(text, offsets, start, end)
+            etag += '-%d-%d' % (start, end)
+
+        response = get_compressed_response(request, body, 'text/plain; charset=utf-8', etag)
+
+        # The lines sent and the number of lines in the class, or */count if it has no lines in the range
+        if line_range:
+            if start > len(offsets):
+                response['X-Line-Range'] = '*/%d' % len(offsets)
+            else:
+                response['X-Line-Range'] = '%d-%d/%d' % (start, min(end, len(offsets)), len(offsets))
+
+        max_age = int((models.Job(created_date=created_date).get_expiry_date() - timezone.now()).total_seconds())
+        response['Cache-Control'] = 'private, max-age=%d, immutable' % max(max_age, 0)
+
+        return response
+
+
+class JobSnippetsView(View):
+    """
+    Return the lines of code around references, for any number of references in one call.
+    Each reference is a class name and line, eg. ?ref=AccountController:12&ref=AccountService:40&context=3
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        job = get_object_or_404(models.Job.objects.without_results(), slug=self.kwargs.get('slug'))
+
+        try:
+            references = []
+            for reference in request.GET.getlist('ref')[:settings.SCANNER_SNIPPET_MAX_REFERENCES]:
+                class_name, line = reference.rsplit(':', 1)
+                references.append((class_name, int(line)))
+            context = min(max(int(request.GET.get('context', 3)), 0), settings.SCANNER_SNIPPET_MAX_CONTEXT)
+        except ValueError:
+            return HttpResponseBadRequest('Each ref should be a class name and line, eg. AccountController:12')
+
+        return JsonResponse({'snippets': snippets.get_snippets(job, references, context)})
+
+
+class JobExportView(View):
+    """
+    Download every reference in a job as one flat row per use, streamed as it's read from the database.
+    NDJSON by default, or pass ?format=csv
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        job = get_object_or_404(models.Job.objects.without_results('reference_strings_json'), slug=self.kwargs.get('slug'))
+
+        export_format = request.GET.get('format', 'ndjson')
+        if export_format not in exports.CONTENT_TYPES:
+            return HttpResponseBadRequest('format should be one of %s' % ', '.join(sorted(exports.CONTENT_TYPES)))
+
+        if job.status != 'Finished':
+            return JsonResponse({'error': 'The job has not finished'}, status=409)
+
+        response = StreamingHttpResponse(exports.export(job, export_format), content_type=exports.CONTENT_TYPES[export_format])
+        response['Content-Disposition'] = 'attachment; filename="%s-references.%s"' % (job.slug, export_format)
+        return response
+
+
+class JobSymbolSearchView(View):
+    """
+    Search for classes, methods and properties in a job by name, for autocomplete.
+    Matches the start of the member name or the full Class.member name, eg. ?q=AccountService.upd
+    Pass exact=1 to only return symbols with exactly that name
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        # The index is loaded separately, and only if it's not already in memory
+        job = get_object_or_404(
+            models.Job.objects.without_results(),
+            slug=self.kwargs.get('slug')
+        )
+
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return HttpResponseBadRequest('q is required')
+
+        try:
+            limit = min(int(request.GET.get('limit', 20)), settings.SCANNER_SYMBOL_SEARCH_LIMIT)
+        except ValueError:
+            return HttpResponseBadRequest('limit should be a number')
+
+        index = symbols.get_symbol_index(job)
+        if index is None:
+            return get_pending_response(job, 'symbols')
+
+        return JsonResponse({
+            'query': query,
+            'symbols': symbols.search_symbols(index, query, limit, exact=request.GET.get('exact') in ('1', 'true')),
+        })
+
+
+class JobImpactView(View):
+    """
+    List everything that depends on a class, directly or through other classes, eg. ?name=AccountService.
+    Each dependent has its depth (1 for direct callers) and a sample path back to the class.
+    Pass depth to only go so many levels out, and limit for the number of dependents listed
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        job = get_object_or_404(models.Job.objects.without_results('reference_strings_json'), slug=self.kwargs.get('slug'))
+
+        name = request.GET.get('name', '').strip()
+        if not name:
+            return HttpResponseBadRequest('name is required')
+
+        try:
+            limit = min(int(request.GET.get('limit', 100)), settings.SCANNER_IMPACT_LIMIT)
+            max_depth = int(request.GET['depth']) if request.GET.get('depth') else None
+        except ValueError:
+            return HttpResponseBadRequest('limit and depth should be numbers')
+
+        if job.status != 'Finished':
+            return JsonResponse({'error': 'The job has not finished'}, status=409)
+
+        impact = graph.get_graph(job).get_impact(name, limit, max_depth)
+        if impact is None:
+            return JsonResponse({'error': 'There is no class named %s in the job' % name}, status=404)
+
+        return JsonResponse(impact)
+
+
+class JobClassQueryView(View):
+    """
+    List the classes in a job that declare a member, eg. ?declares=updateOwners (with &kind=property,
+    variable or constructor for other members), or that a class, trigger, page or Lightning component
+    uses, eg. ?usedBy=AccountController. Answered in the database on Postgres (see queries.py)
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        job = get_object_or_404(models.Job.objects.without_results('reference_strings_json'), slug=self.kwargs.get('slug'))
+
+        declares = request.GET.get('declares', '').strip()
+        used_by = request.GET.get('usedBy', '').strip()
+        kind = request.GET.get('kind', 'method')
+
+        if not declares and not used_by:
+            return HttpResponseBadRequest('declares or usedBy is required')
+        if kind not in queries.DECLARATION_KINDS:
+            return HttpResponseBadRequest('kind should be one of %s' % ', '.join(sorted(queries.DECLARATION_KINDS)))
+
+        if job.status != 'Finished':
+            return JsonResponse({'error': 'The job has not finished'}, status=409)
+
+        fields = ['id', 'class_id', 'name', 'is_referenced_externally']
+        if declares:
+            rows = list(queries.get_declaring_classes(job, declares, kind, fields))
+        else:
+            rows = list(queries.get_used_classes(job, used_by, fields))
+
+        return JsonResponse({
+            'count': len(rows),
+            'classes': [
+                {'DatabaseId': class_id, 'ApexClassId': sf_id, 'Name': name, 'IsReferenced': is_referenced}
+                for class_id, sf_id, name, is_referenced in rows
+            ],
+        })
+
+
+class JobCyclesView(View):
+    """
+    List the dependency cycles in a job, largest first.
+    Cycles are between classes by default, or pass ?level=members for cycles between methods
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        job = get_object_or_404(models.Job.objects.without_results(), slug=self.kwargs.get('slug'))
+
+        level = request.GET.get('level', 'classes')
+        if level not in cycles.LEVELS:
+            return HttpResponseBadRequest('level should be one of %s' % ', '.join(cycles.LEVELS))
+
+        try:
+            limit = max(min(int(request.GET.get('limit', 100)), settings.SCANNER_CYCLE_LIMIT), 0)
+        except ValueError:
+            return HttpResponseBadRequest('limit should be a number')
+
+        job_cycles = cycles.get_cycles(job)
+        if job_cycles is None:
+            return get_pending_response(job, 'cycles')
+
+        level_cycles = job_cycles[level]
+
+        return JsonResponse({
+            'level': level,
+            'cycleCount': len(level_cycles),
+            'nodeCount': sum(len(cycle) for cycle in level_cycles),
+            'cycles': [{'size': len(cycle), 'members': cycle} for cycle in level_cycles[:limit]],
+        })
+
+
+class JobDuplicatesView(View):
+    """
+    List the pairs of near duplicate classes in a job, most similar first, and the groups of classes
+    they link together. Pass min to only list pairs at least that similar (eg. ?min=0.95)
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        job = get_object_or_404(models.Job.objects.without_results(), slug=self.kwargs.get('slug'))
+
+        try:
+            limit = max(min(int(request.GET.get('limit', 100)), settings.SCANNER_DUPLICATE_REPORT_LIMIT), 0)
+            min_similarity = float(request.GET.get('min', 0))
+        except ValueError:
+            return HttpResponseBadRequest('limit and min should be numbers')
+
+        report = duplicates.get_duplicates(job)
+        if report is None:
+            return get_pending_response(job, 'duplicates')
+
+        # Every stored pair is at least as similar as the threshold, so the stored counts and
+        # groups only hold without a higher minimum. Otherwise they're found from the pairs left
+        if min_similarity <= report['threshold']:
+            pairs = report['pairs']
+            pair_count = report['pairCount']
+            groups = report['groups']
+        else:
+            pairs = [pair for pair in report['pairs'] if pair[2] >= min_similarity]
+            pair_count = len(pairs)
+            groups = duplicates.get_groups(pairs)
+
+        return JsonResponse({
+            'threshold': report['threshold'],
+            'classesCompared': report['classes'],
+            'pairCount': pair_count,
+            'pairs': [
+                {'classes': [first, second], 'similarity': similarity, 'tokens': [first_tokens, second_tokens]}
+                for first, second, similarity, first_tokens, second_tokens in pairs[:limit]
+            ],
+            'groups': [{'size': len(group), 'classes': group} for group in groups[:limit]],
+        })
+
+
+class JobVisualforceView(View):
+    """
+    List the Visualforce pages and components in a job, with the pages, components and classes that
+    use each of them. Pass ?unused=1 to only list the ones nothing uses
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        job = get_object_or_404(models.Job.objects.without_results(), slug=self.kwargs.get('slug'))
+
+        if job.status != 'Finished' or not usage.is_built(job):
+            return get_pending_response(job, 'usage')
+
+        counts = job.apexpagecomponent_set.aggregate(
+            pages=Count('pk', filter=Q(type='Page')),
+            components=Count('pk', filter=Q(type='Component')),
+            unused=Count('pk', filter=Q(is_referenced_externally=False)),
         )
 
+        return JsonResponse({
+            'pageCount': counts['pages'],
+            'componentCount': counts['components'],
+            'unusedCount': counts['unused'],
+            'visualforce': usage.get_visualforce(job, unused_only=request.GET.get('unused') in ('1', 'true')),
+        })
+
+
+class JobDiffView(View):
+    """
+    Compare the results of a job with an earlier job for the same Org.
+    Works from the job snapshots, so either job can have been cleared already.
+    Compares with the previous scan of the Org, unless ?from=<snapshot id> is given
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            return self.get_diff(request)
+        except snapshots.SnapshotPending:
+            return get_building_response()
+
+    def get_diff(self, request):
+
+        snapshot = snapshots.get_snapshot(self.kwargs.get('slug'))
+        if not snapshot:
+            raise Http404
+
+        if request.GET.get('from'):
+            old_snapshot = snapshots.get_snapshot_by_id(request.GET.get('from'))
+            if not old_snapshot:
+                raise Http404
+            if old_snapshot.coalesce_key != snapshot.coalesce_key:
+                return HttpResponseBadRequest('Jobs can only be compared with jobs for the same Org')
+        else:
+            old_snapshot = snapshots.get_previous_snapshot(snapshot)
+            if not old_snapshot:
+                return JsonResponse({'error': 'There is no earlier scan of this Org to compare with'}, status=404)
 
-class ApexClassBodyView(DetailView):
+        return JsonResponse(snapshots.diff_snapshots(old_snapshot, snapshot))
+
+
+class JobSnapshotsView(View):
     """
-    Retrieve the ApexClass body
+    List the scans of the same Org as a job that can be compared with it.
+    Each is listed by its snapshot id, which can be passed to the diff view, and not by its job id
     """
-    model = models.ApexClass
 
     def get(self, request, *args, **kwargs):
-        return HttpResponse(self.get_object().body)
+
+        try:
+            snapshot = snapshots.get_snapshot(self.kwargs.get('slug'))
+        except snapshots.SnapshotPending:
+            return get_building_response()
+
+        if not snapshot:
+            raise Http404
+
+        org_snapshots = models.JobSnapshot.objects.defer('fingerprint_json').filter(coalesce_key=snapshot.coalesce_key)
+
+        return JsonResponse({
+            'snapshots': [snapshots.get_snapshot_details(org_snapshot) for org_snapshot in org_snapshots]
+        })
+
+
+class ApexClassJsonFieldView(View):
+    """
+    Return one of the stored JSON documents for an ApexClass.
+    The document is stored compressed, so clients that accept deflate are sent the stored bytes as-is
+    """
+    field_name = None
+
+    def get(self, request, *args, **kwargs):
+
+        # Load only the stored value, without decompressing it
+        values = models.ApexClass.objects.filter(pk=self.kwargs.get('pk')).values_list(self.field_name, flat=True)
+        if not values:
+            raise Http404
+
+        data = self.get_data(values[0])
+        if data is None:
+            data = 'null'
+
+        return get_compressed_response(request, data, 'application/json')
+
+    def get_data(self, data):
+        """
+        Get the value to send from the stored value. Either the stored value itself, or text
+        """
+        return data
+
+
+class ApexClassReferencesView(ApexClassJsonFieldView):
+    """
+    Return the references for an ApexClass.
+    In the legacy format by default, or as stored (with ?format=v2), referring to the names in the job's string table
+    """
+    field_name = 'referenced_by_json'
+
+    def get_data(self, data):
+        if data is None or self.request.GET.get('format') == 'v2':
+            return data
+
+        job = models.Job.objects.only('reference_strings_json').get(apexclass__pk=self.kwargs.get('pk'))
+        return json.dumps(analysis.decode_references(json.loads(data.text), job.get_reference_strings()))
 
 
 
@@ -265,6 +933,13 @@ class ApiJobCreateView(View):
 
             instance_url = json_body.get('instanceUrl')
             access_token = json_body.get('accessToken')
+
+            # Number of seconds old a finished scan of the same Org can be and still be returned
+            max_age = json_body.get('maxAge')
+
+            # Optional URL to POST a notice to once the job has finished, signed with the secret
+            callback_url = json_body.get('callbackUrl')
+            callback_secret = json_body.get('callbackSecret')
             print(instance_url)
             print(access_token)
             if not instance_url:
@@ -284,7 +959,45 @@ class ApiJobCreateView(View):
                     },
                     status=400
                 )
-                
+
+            if max_age is not None:
+                # Parsed from its text, so fractions (eg. 1.5) and true/false aren't taken as numbers
+                try:
+                    max_age = int(str(max_age))
+                    if max_age < 0:
+                        raise ValueError(max_age)
+                except (TypeError, ValueError):
+                    return JsonResponse(
+                        {
+                            'success': False,
+                            'error': 'maxAge must be a whole number of seconds'
+                        },
+                        status=400
+                    )
+
+            if callback_url:
+                try:
+                    URLValidator(schemes=['http', 'https'])(callback_url)
+                except ValidationError:
+                    return JsonResponse(
+                        {
+                            'success': False,
+                            'error': 'callbackUrl must be a valid http or https URL'
+                        },
+                        status=400
+                    )
+
+                try:
+                    callbacks.check_url(callback_url)
+                except callbacks.CallbackError as ex:
+                    return JsonResponse(
+                        {
+                            'success': False,
+                            'error': 'callbackUrl must be a public address. %s' % ex
+                        },
+                        status=400
+                    )
+
             # If we have an instance_url and access token, we can start the job
             # Attempt login with the details provided
             try:
@@ -312,18 +1025,28 @@ class ApiJobCreateView(View):
                 job.email_result = False
                 job.access_token = access_token
                 job.instance_url = instance_url
+
+                # With the Org Id, the job can be coalesced with jobs for the Org started from the site
+                job.org_id = utils.get_org_id(instance_url, access_token) or ''
                 job.save()
 
-                # Start the job to scan the job
-                scan_code.delay(job.id)
+                # Queue the job to scan the Org
+                # If the Org is already being scanned (or was recently enough), the existing job is returned instead
+                scheduled_job = scheduler.schedule_job(job, max_age=max_age)
 
-                return JsonResponse(
-                    {
-                        'success': True,
-                        'id': job.slug
-                    },
-                    status=200
-                )
+                response = {
+                    'success': True,
+                    'id': scheduled_job.slug,
+                    'status': scheduled_job.status,
+                    'coalesced': scheduled_job.pk != job.pk,
+                }
+
+                # The callback is added to the job doing the work, so it's still sent if the request was coalesced
+                if callback_url:
+                    callback = callbacks.register_callback(scheduled_job, callback_url, callback_secret)
+                    response['callbackSecret'] = callback.secret
+
+                return JsonResponse(response, status=200)
 
 
             except Exception as ex:
@@ -335,8 +1058,6 @@ class ApiJobCreateView(View):
                     status=401
                 )
 
-            return JsonResponse({'Hey':'There'})
-
         except Exception as ex:
             return JsonResponse(
                 {
@@ -171,6 +171,130 @@ SALESFORCE_API_VERSION = int(os.environ.get('SALESFORCE_API_VERSION', 41))
 SALESFORCE_REST_URL = '/services/data/v%d.0/' % SALESFORCE_API_VERSION
 SALESFORCE_TOOLING_URL = '%stooling/' % SALESFORCE_REST_URL
 
+# Limits for requests to Salesforce
+# Seconds to wait for a response, and times to retry idempotent requests (with the wait doubling each time)
+SALESFORCE_REQUEST_TIMEOUT = int(os.environ.get('SALESFORCE_REQUEST_TIMEOUT', 120))
+SALESFORCE_MAX_RETRIES = int(os.environ.get('SALESFORCE_MAX_RETRIES', 4))
+SALESFORCE_RETRY_BACKOFF = float(os.environ.get('SALESFORCE_RETRY_BACKOFF', 1))
+
+# Seconds to wait for calls to Salesforce made while handling a web request (eg. sizing a new job).
+# These are only tried once, so the request finishes well within the router's 30 second limit
+SALESFORCE_WEB_REQUEST_TIMEOUT = int(os.environ.get('SALESFORCE_WEB_REQUEST_TIMEOUT', 5))
+
+# Start slowing down once the Org has used this share of its daily API calls, up to the delay (seconds) per call
+SALESFORCE_API_THROTTLE_RATIO = float(os.environ.get('SALESFORCE_API_THROTTLE_RATIO', 0.8))
+SALESFORCE_API_THROTTLE_DELAY = float(os.environ.get('SALESFORCE_API_THROTTLE_DELAY', 2))
+
+# Share of the Org's daily API calls that a scan will never use
+SALESFORCE_API_RESERVE = float(os.environ.get('SALESFORCE_API_RESERVE', 0.1))
+
+# Number of processes used for the CPU bound phases of a scan
+# 0 = one per CPU, 1 = run everything in the worker process (useful for debugging)
+SCANNER_WORKERS = int(os.environ.get('SCANNER_WORKERS', 0))
+
+# Number of classes or pages sent to a child process at a time
+SCANNER_CHUNK_SIZE = int(os.environ.get('SCANNER_CHUNK_SIZE', 50))
+
+# Number of rows fetched at a time when iterating over the classes and pages for a job
+SCANNER_QUERY_CHUNK_SIZE = int(os.environ.get('SCANNER_QUERY_CHUNK_SIZE', 200))
+
+# Class and page bodies, SymbolTables and references are stored zlib compressed
+# Anything shorter than the minimum length (in bytes) is stored as is
+SCANNER_COMPRESS_LEVEL = int(os.environ.get('SCANNER_COMPRESS_LEVEL', 6))
+SCANNER_COMPRESS_MIN_LENGTH = int(os.environ.get('SCANNER_COMPRESS_MIN_LENGTH', 256))
+
+# Jobs with at least this many classes build their references across the Celery workers (0 = never)
+SCANNER_DISTRIBUTED_THRESHOLD = int(os.environ.get('SCANNER_DISTRIBUTED_THRESHOLD', 5000))
+
+# Number of classes handled by each mapper task, and number of reducer tasks, when distributed
+SCANNER_MAP_SHARD_SIZE = int(os.environ.get('SCANNER_MAP_SHARD_SIZE', 500))
+SCANNER_REDUCE_PARTITIONS = int(os.environ.get('SCANNER_REDUCE_PARTITIONS', 16))
+
+# Job scheduling. Orgs with at least SCANNER_LARGE_JOB_THRESHOLD classes are run on the large queue,
+# which has its own workers (see the Procfile)
+SCANNER_SMALL_QUEUE = os.environ.get('SCANNER_SMALL_QUEUE', 'scans-small')
+SCANNER_LARGE_QUEUE = os.environ.get('SCANNER_LARGE_QUEUE', 'scans-large')
+SCANNER_LARGE_JOB_THRESHOLD = int(os.environ.get('SCANNER_LARGE_JOB_THRESHOLD', 1000))
+
+# Maximum number of jobs running at once for a single org and a single user
+SCANNER_MAX_JOBS_PER_ORG = int(os.environ.get('SCANNER_MAX_JOBS_PER_ORG', 1))
+SCANNER_MAX_JOBS_PER_USER = int(os.environ.get('SCANNER_MAX_JOBS_PER_USER', 2))
+
+# Running jobs that haven't been updated for this long (in seconds) since they were dispatched or
+# last moved on a phase are assumed to have had their worker die. They stop taking up a slot, and
+# are failed when the Org is next scanned
+SCANNER_STALE_JOB_AGE = int(os.environ.get('SCANNER_STALE_JOB_AGE', 24 * 60 * 60))
+
+# Snippets of code around references. How long (in seconds) each class body is cached for,
+# the most lines of context either side of a reference, and the most snippets in one request
+SCANNER_SNIPPET_CACHE_TIMEOUT = int(os.environ.get('SCANNER_SNIPPET_CACHE_TIMEOUT', 60 * 60))
+SCANNER_SNIPPET_MAX_CONTEXT = int(os.environ.get('SCANNER_SNIPPET_MAX_CONTEXT', 20))
+SCANNER_SNIPPET_MAX_REFERENCES = int(os.environ.get('SCANNER_SNIPPET_MAX_REFERENCES', 200))
+
+# Number of symbol search indexes kept in memory by each process, and the most results returned by a search
+SCANNER_SYMBOL_INDEX_CACHE_SIZE = int(os.environ.get('SCANNER_SYMBOL_INDEX_CACHE_SIZE', 8))
+SCANNER_SYMBOL_SEARCH_LIMIT = int(os.environ.get('SCANNER_SYMBOL_SEARCH_LIMIT', 50))
+
+# Public address of the site, for links sent outside of a request (eg in webhook notices)
+SITE_URL = os.environ.get('SITE_URL', 'https://sfcodeclean.herokuapp.com')
+
+# Impact analysis. Number of job reference graphs kept in memory by each process, the number of
+# closures kept for each graph, and the most dependents returned by a query
+SCANNER_GRAPH_CACHE_SIZE = int(os.environ.get('SCANNER_GRAPH_CACHE_SIZE', 4))
+SCANNER_IMPACT_CLOSURE_CACHE_SIZE = int(os.environ.get('SCANNER_IMPACT_CLOSURE_CACHE_SIZE', 256))
+SCANNER_IMPACT_LIMIT = int(os.environ.get('SCANNER_IMPACT_LIMIT', 1000))
+
+# Most dependency cycles returned in one call to the cycles API
+SCANNER_CYCLE_LIMIT = int(os.environ.get('SCANNER_CYCLE_LIMIT', 1000))
+
+# Near duplicate classes. The Jaccard similarity classes need to be reported, the fewest tokens
+# a class needs to be compared, and the most pairs stored for each job
+SCANNER_DUPLICATE_THRESHOLD = float(os.environ.get('SCANNER_DUPLICATE_THRESHOLD', 0.8))
+SCANNER_DUPLICATE_MIN_TOKENS = int(os.environ.get('SCANNER_DUPLICATE_MIN_TOKENS', 50))
+SCANNER_DUPLICATE_REPORT_LIMIT = int(os.environ.get('SCANNER_DUPLICATE_REPORT_LIMIT', 5000))
+
+# Most jobs that can be checked in one call to the batch status API
+SCANNER_STATUS_BATCH_LIMIT = int(os.environ.get('SCANNER_STATUS_BATCH_LIMIT', 500))
+
+# Completion webhooks for API jobs. Seconds to wait for the receiver, the number of retries,
+# and the delay (in seconds) before the first retry, which doubles with each retry after
+SCANNER_CALLBACK_TIMEOUT = int(os.environ.get('SCANNER_CALLBACK_TIMEOUT', 10))
+SCANNER_CALLBACK_MAX_RETRIES = int(os.environ.get('SCANNER_CALLBACK_MAX_RETRIES', 8))
+SCANNER_CALLBACK_RETRY_BACKOFF = int(os.environ.get('SCANNER_CALLBACK_RETRY_BACKOFF', 30))
+
+# Callback URLs have to resolve to public addresses. Set this to allow local and private
+# addresses, eg. to try callbacks out against a receiver running locally
+SCANNER_CALLBACK_ALLOW_PRIVATE = 'SCANNER_CALLBACK_ALLOW_PRIVATE' in os.environ
+
+# How long (in seconds) jobs are kept before clear_jobs deletes them
+SCANNER_JOB_LIFETIME = int(os.environ.get('SCANNER_JOB_LIFETIME', 24 * 60 * 60))
+
+# Number of rows deleted in each statement when clear_jobs purges expired jobs
+SCANNER_PURGE_BATCH_SIZE = int(os.environ.get('SCANNER_PURGE_BATCH_SIZE', 500))
+
+# How long (in days) snapshots of job results are kept, for comparing scans
+SCANNER_SNAPSHOT_LIFETIME = int(os.environ.get('SCANNER_SNAPSHOT_LIFETIME', 365))
+
+# Number of classes returned in each page of the results tree
+SCANNER_TREE_PAGE_SIZE = int(os.environ.get('SCANNER_TREE_PAGE_SIZE', 500))
+
+# Celery
+# Chords (used to build references across the workers) need a result backend
+CELERY_RESULT_BACKEND = os.environ.get('REDIS_URL', 'redis://localhost')
+
+# Pick up any queued jobs that missed being dispatched (eg. a worker died mid job), and any
+# callbacks that stopped being sent
+CELERY_BEAT_SCHEDULE = {
+    'dispatch-queued-jobs': {
+        'task': 'codescanner.tasks.dispatch_queued_jobs',
+        'schedule': 30.0,
+    },
+    'requeue-stale-callbacks': {
+        'task': 'codescanner.tasks.requeue_stale_callbacks',
+        'schedule': 10 * 60.0,
+    },
+}
+
 # Email settings
 DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL')
 EMAIL_HOST = os.environ.get('EMAIL_HOST')
@@ -23,12 +23,14 @@ codeResultsApp.controller("CodeResultsController", function($scope, $http, $q) {
         $scope.loadClasses(slug);
     };
 
-    $scope.loadClasses = function(slug) {
+    $scope.loadClasses = function(slug, offset) {
 
-        // Get list of profiles for the page
+        // Get a page of classes for the tree. Each class's references are
+        // only loaded when it's expanded
         $http({
             method: 'GET',
-            url: '/job/json/' + $scope.slug + '/',
+            url: '/job/tree/' + $scope.slug + '/',
+            params: {offset: offset || 0},
             headers: {
                 'Content-Type': 'application/json'
             }
@@ -36,83 +38,137 @@ codeResultsApp.controller("CodeResultsController", function($scope, $http, $q) {
         .then(function successCallback(response) {
 
             // Clear the data
-            $scope.root.children.length = 0;
-
-            console.log(response.data.classes);
+            if (!offset) {
+                $scope.root.children.length = 0;
+            }
 
             // Iterate over the response
             angular.forEach(response.data.classes, function(apexClass, apexClassKey) {
 
-                // Build the child for methods and variables
-                let class_object = {
+                let referenceCount = 0;
+                for (var referenceType in apexClass.Counts) {
+                    referenceCount += apexClass.Counts[referenceType];
+                }
+
+                $scope.root.children.push({
                     name: apexClass.Name,
                     IsReferenced: apexClass.IsReferenced,
                     Id: apexClass.ApexClassId,
                     DatabaseId: apexClass.DatabaseId,
-                    TopLevel: true
-                };
+                    TopLevel: true,
+                    ReferenceCount: referenceCount,
+                    children: []
+                });
+            });
 
-                let childrenForClass = [];
+            // Display the first page straight away, and keep loading the rest
+            $scope.success = true;
+            $scope.loading = false;
 
-                // If the class has class references
-                if (apexClass.ReferencedBy.visualforce && apexClass.ReferencedBy.visualforce.length > 0) {
+            if (response.data.next) {
+                $scope.loadClasses(slug, response.data.next);
+            }
+        }, 
+        function errorCallback(response) {
 
-                    childrenForClass.push({
-                        name: 'VisualForce',
-                        children: $scope.getChildrenFromArray(apexClass.ReferencedBy.visualforce)
-                    });
-                }
+            $scope.success = false;
+            $scope.error = response;
+            $scope.loading = false;
+        });
+    };
 
-                // If the class has class references
-                if (apexClass.ReferencedBy.classes && Object.keys(apexClass.ReferencedBy.classes).length > 0) {
+    $scope.hasChildren = function(item) {
 
-                    childrenForClass.push({
-                        name: 'Class References',
-                        children: $scope.getChildrenFromObject(apexClass.ReferencedBy.classes)
-                    });
-                }
+        // Classes don't have their children until they're expanded, so use the counts
+        if (item.TopLevel) {
+            return item.ReferenceCount > 0;
+        }
+        return item.children && item.children.length > 0;
+    };
 
-                // IF there are method references
-                if (apexClass.ReferencedBy.methods && Object.keys(apexClass.ReferencedBy.methods).length > 0) {
+    $scope.toggleNode = function(item) {
 
-                    childrenForClass.push({
-                        name: 'Methods',
-                        children: $scope.getChildrenAndChildrenFromObject(apexClass.ReferencedBy.methods)
-                    });
-                }
+        // Load the references for a class the first time it's expanded
+        if (item.TopLevel && !item._loaded) {
 
-                if (apexClass.ReferencedBy.variables && Object.keys(apexClass.ReferencedBy.variables).length > 0) {
+            item._ad_loading = true;
 
-                    childrenForClass.push({
-                        name: 'Variables',
-                        children: $scope.getChildrenAndChildrenFromObject(apexClass.ReferencedBy.variables)
-                    });
-                }
+            $http({
+                method: 'GET',
+                url: '/apexclass/' + item.DatabaseId + '/references/'
+            })
+            .then(function successCallback(response) {
 
-                if (apexClass.ReferencedBy.properties && Object.keys(apexClass.ReferencedBy.properties).length > 0) {
+                item.children = $scope.getChildrenForClass(response.data);
+                item._loaded = true;
+                item._ad_loading = false;
+                item._ad_expanded = true;
+            },
+            function errorCallback(response) {
 
-                    childrenForClass.push({
-                        name: 'Properties',
-                        children: $scope.getChildrenFromObject(apexClass.ReferencedBy.properties)
-                    });
-                }
+                item._ad_loading = false;
+                $scope.success = false;
+                $scope.error = response;
+            });
+
+            return;
+        }
+
+        item._ad_expanded = !item._ad_expanded;
+    };
+
+    $scope.getChildrenForClass = function(referencedBy) {
 
-                class_object.children = childrenForClass;
+        let childrenForClass = [];
 
-                $scope.root.children.push(class_object);
+        if (!referencedBy) {
+            return childrenForClass;
+        }
+
+        // Visualforce pages and Lightning bundles are both listed under visualforce
+        if (referencedBy.visualforce && referencedBy.visualforce.length > 0) {
 
+            childrenForClass.push({
+                name: 'Visualforce and Lightning',
+                children: $scope.getChildrenFromArray(referencedBy.visualforce)
             });
+        }
 
-            //$scope.classes = response.data;
-            $scope.success = true;
-            $scope.loading = false; 
-        }, 
-        function errorCallback(response) {
+        // If the class has class references
+        if (referencedBy.classes && Object.keys(referencedBy.classes).length > 0) {
 
-            $scope.success = false;
-            $scope.error = response;
-            $scope.loading = false;
-        });
+            childrenForClass.push({
+                name: 'Class References',
+                children: $scope.getChildrenFromObject(referencedBy.classes)
+            });
+        }
+
+        // IF there are method references
+        if (referencedBy.methods && Object.keys(referencedBy.methods).length > 0) {
+
+            childrenForClass.push({
+                name: 'Methods',
+                children: $scope.getChildrenAndChildrenFromObject(referencedBy.methods)
+            });
+        }
+
+        if (referencedBy.variables && Object.keys(referencedBy.variables).length > 0) {
+
+            childrenForClass.push({
+                name: 'Variables',
+                children: $scope.getChildrenAndChildrenFromObject(referencedBy.variables)
+            });
+        }
+
+        if (referencedBy.properties && Object.keys(referencedBy.properties).length > 0) {
+
+            childrenForClass.push({
+                name: 'Properties',
+                children: $scope.getChildrenFromObject(referencedBy.properties)
+            });
+        }
+
+        return childrenForClass;
     };
 
     $scope.toggleIcons = function(class_id) {
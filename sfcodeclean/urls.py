@@ -29,11 +29,29 @@ urlpatterns = [
     re_path(r'^job/scanning/(?P<slug>[-\w]+)/$', views.JobProcessingView.as_view(), name='job-scanning'),
     re_path(r'^job/status/(?P<slug>[-\w]+)/$', views.JobStatusView.as_view(), name='job-status'),
     re_path(r'^job/json/(?P<slug>[-\w]+)/$', views.JobJsonView.as_view(), name='job-json'),
+    re_path(r'^job/tree/(?P<slug>[-\w]+)/$', views.JobTreeView.as_view(), name='job-tree'),
+    re_path(r'^job/snippets/(?P<slug>[-\w]+)/$', views.JobSnippetsView.as_view(), name='job-snippets'),
+    re_path(r'^job/symbols/(?P<slug>[-\w]+)/$', views.JobSymbolSearchView.as_view(), name='job-symbols'),
     re_path(r'^job/(?P<slug>[-\w]+)/$', views.JobView.as_view(), name='job'),
 
     re_path(r'^apexclass/(?P<pk>\d+)/$', views.ApexClassBodyView.as_view(), name='apex-class-body'),
+    re_path(r'^apexclass/(?P<pk>\d+)/symboltable/$', views.ApexClassJsonFieldView.as_view(field_name='symbol_table_json'), name='apex-class-symbol-table'),
+    re_path(r'^apexclass/(?P<pk>\d+)/references/$', views.ApexClassReferencesView.as_view(), name='apex-class-references'),
 
     re_path(r'^api/job/$', views.ApiJobCreateView.as_view(), name='api-job-create'),
+    re_path(r'^api/scheduler/metrics/$', views.SchedulerMetricsView.as_view(), name='api-scheduler-metrics'),
+    re_path(r'^api/job/status/$', views.JobStatusBatchView.as_view(), name='api-job-status-batch'),
     re_path(r'^api/job/status/(?P<slug>[-\w]+)/$', views.JobStatusView.as_view(), name='api-job-status'),
+    re_path(r'^api/job/tree/(?P<slug>[-\w]+)/$', views.JobTreeView.as_view(), name='api-job-tree'),
+    re_path(r'^api/job/snippets/(?P<slug>[-\w]+)/$', views.JobSnippetsView.as_view(), name='api-job-snippets'),
+    re_path(r'^api/job/symbols/(?P<slug>[-\w]+)/$', views.JobSymbolSearchView.as_view(), name='api-job-symbols'),
+    re_path(r'^api/job/export/(?P<slug>[-\w]+)/$', views.JobExportView.as_view(), name='api-job-export'),
+    re_path(r'^api/job/impact/(?P<slug>[-\w]+)/$', views.JobImpactView.as_view(), name='api-job-impact'),
+    re_path(r'^api/job/classes/(?P<slug>[-\w]+)/$', views.JobClassQueryView.as_view(), name='api-job-classes'),
+    re_path(r'^api/job/cycles/(?P<slug>[-\w]+)/$', views.JobCyclesView.as_view(), name='api-job-cycles'),
+    re_path(r'^api/job/duplicates/(?P<slug>[-\w]+)/$', views.JobDuplicatesView.as_view(), name='api-job-duplicates'),
+    re_path(r'^api/job/visualforce/(?P<slug>[-\w]+)/$', views.JobVisualforceView.as_view(), name='api-job-visualforce'),
+    re_path(r'^api/job/diff/(?P<slug>[-\w]+)/$', views.JobDiffView.as_view(), name='api-job-diff'),
+    re_path(r'^api/job/snapshots/(?P<slug>[-\w]+)/$', views.JobSnapshotsView.as_view(), name='api-job-snapshots'),
     re_path(r'^api/job/(?P<slug>[-\w]+)/$', views.JobJsonView.as_view(), name='api-job-json'),
 ]